@@ -2,15 +2,21 @@ from statistics import mean
 
 from loguru import logger
 from abc import ABC, abstractmethod
-import docker
+from docker_utils import get_container, exec_batch
+from orchestration import run_concurrently
+from probes import wait_for_port, wait_for_process_exit
+from watchdog import LinkStalled
+from timing import span, MEASUREMENT
 import json
-import time
 import re
 
 import os
 from dotenv import load_dotenv
 load_dotenv()
 
+# iperf3's default, where IperfBenchmark's server listens
+IPERF_PORT = 5201
+
 alexa_top_20 = [
     "https://www.google.com",
     "https://www.youtube.com",
@@ -38,6 +44,11 @@ class Benchmark(ABC):
     def __init__(self, name=""):
         self.results = {}
         self.name = name
+        # the OpenSAND probes of each measurement, filled in by the scenario's LinkStatsCollector if it has one
+        self.link_stats = []
+        self.container_failures = []
+        # the scenario's Watchdog while it runs the benchmark, if it has one
+        self.watchdog = None
 
     @abstractmethod
     def run(self):
@@ -54,39 +65,68 @@ class IperfBenchmark(Benchmark):
         super().__init__(name="IPerf")
 
     def run(self):
-        docker_client = docker.from_env()
-        terminal_workstation = docker_client.containers.get(os.getenv("WS_ST_CONTAINER_NAME"))
-        terminal_workstation.exec_run("wget http://1.1.1.1") #use this to warm up vpns/peps
+        terminal_workstation = get_container(os.getenv("WS_ST_CONTAINER_NAME"))
+        with span("iperf warm up"):
+            terminal_workstation.exec_run("wget http://1.1.1.1") #use this to warm up vpns/peps
         for i in range(0, self.iterations):
             for file_size in self.file_sizes:
                 test_results = self.run_iperf_test(file_size, self.reset_on_run)
-                result_name = "iperf_" + str(round(file_size/1000000, 3)) + "mb"
-                if result_name not in self.results.keys():
-                    self.results[result_name] = {}
-                    for key in test_results.keys():
-                        self.results[result_name][key] = [test_results[key]]
-                else:
-                    for key in test_results.keys():
-                        self.results[result_name][key].append(test_results[key])
+                attempts = 1
+                while self.watchdog is not None and test_results["failure_reason"] is not None and attempts <= self.watchdog.retries:
+                    # only this cell is repeated, after fixing whatever broke it
+                    try:
+                        repair = self.watchdog.repair(terminal_workstation, str(os.getenv("GW_NETWORK_HEAD")) + ".0.9",
+                                                      test_results["failure_reason"])
+                    except LinkStalled as error:
+                        test_results["failure_reason"] += ", repair failed: " + str(error)
+                        break
+                    logger.warning("Retrying " + self.result_name(file_size) + " after " + repair + " (" +
+                                   test_results["failure_reason"] + ")")
+                    test_results = self.run_iperf_test(file_size, self.reset_on_run)
+                    attempts += 1
+                test_results["attempts"] = attempts
+                self.add_results(self.results.setdefault(self.result_name(file_size), {}), test_results)
             print("Interim Results (Iter:", i+1, " of ", self.iterations, "):", self.results)
 
+    def result_name(self, file_size):
+        return "iperf_" + str(round(file_size/1000000, 3)) + "mb"
+
+    def add_results(self, results, test_results):
+        for key in test_results.keys():
+            results.setdefault(key, []).append(test_results[key])
+
     def run_iperf_test(self, transfer_bytes, reset_on_run, with_timeout=True, timeout=600):
-        logger.debug("Starting iperf server")
-        docker_client = docker.from_env()
-        gateway_workstation = docker_client.containers.get(os.getenv('WS_GW_CONTAINER_NAME'))
-        if reset_on_run:
-            gateway_workstation.exec_run("pkill -9 iperf3")
-            time.sleep(1)
-        gateway_workstation.exec_run("iperf3 -s", detach=True)
-        logger.debug("Starting iperf client")
-        terminal_workstation = docker_client.containers.get(os.getenv("WS_ST_CONTAINER_NAME"))
-        if reset_on_run:
-            terminal_workstation.exec_run("pkill -9 iperf3")
-            time.sleep(1)
-        if with_timeout:
-            exit_code, output = terminal_workstation.exec_run("/usr/bin/timeout --signal=SIGINT " + str(timeout) +" /usr/bin/iperf3 --no-delay -c "  + str(os.getenv("GW_NETWORK_HEAD"))+ ".0.9 -R --json -n " + str(transfer_bytes))
-        else:
-            exit_code, output = terminal_workstation.exec_run("iperf3 --no-delay -c "  + str(os.getenv("GW_NETWORK_HEAD"))+ ".0.9 -R --json -n " + str(transfer_bytes))
+        with span("iperf server restart"):
+            logger.debug("Starting iperf server")
+            gateway_workstation = get_container(os.getenv('WS_GW_CONTAINER_NAME'))
+            if reset_on_run:
+                gateway_workstation.exec_run("pkill -9 iperf3")
+                wait_for_process_exit(gateway_workstation, "iperf3")
+            gateway_workstation.exec_run("iperf3 -s", detach=True)
+            wait_for_port(gateway_workstation, IPERF_PORT)
+            logger.debug("Starting iperf client")
+            terminal_workstation = get_container(os.getenv("WS_ST_CONTAINER_NAME"))
+            if reset_on_run:
+                terminal_workstation.exec_run("pkill -9 iperf3")
+                wait_for_process_exit(terminal_workstation, "iperf3")
+        if self.watchdog is not None:
+            # the watchdog's timeout is sized to the transfer and it stops stalled transfers early
+            with span("iperf transfer", MEASUREMENT, transfer_bytes=transfer_bytes):
+                exit_code, output, failure_reason = self.watchdog.run(
+                    terminal_workstation, "/usr/bin/iperf3 --no-delay -c " + str(os.getenv("GW_NETWORK_HEAD")) + ".0.9 -R --json -n " +
+                    str(transfer_bytes), transfer_bytes, str(os.getenv("GW_NETWORK_HEAD")) + ".0.9")
+            test_results = self.parse_iperf_output(output)
+            if failure_reason is not None:
+                test_results["failure_reason"] = failure_reason
+            return test_results
+        with span("iperf transfer", MEASUREMENT, transfer_bytes=transfer_bytes):
+            if with_timeout:
+                exit_code, output = terminal_workstation.exec_run("/usr/bin/timeout --signal=SIGINT " + str(timeout) +" /usr/bin/iperf3 --no-delay -c "  + str(os.getenv("GW_NETWORK_HEAD"))+ ".0.9 -R --json -n " + str(transfer_bytes))
+            else:
+                exit_code, output = terminal_workstation.exec_run("iperf3 --no-delay -c "  + str(os.getenv("GW_NETWORK_HEAD"))+ ".0.9 -R --json -n " + str(transfer_bytes))
+        return self.parse_iperf_output(output)
+
+    def parse_iperf_output(self, output):
         json_string = output.decode('unicode_escape').rstrip('\n').replace('Linux\n', 'Linux') # there's an error in iperf3's json output here
         try:
             test_result = json.loads(json_string)
@@ -98,7 +138,8 @@ class IperfBenchmark(Benchmark):
                 "sent_bytes": 0,
                 "sent_bps": 0,
                 "received_bytes": 0,
-                "received_bps": 0
+                "received_bps": 0,
+                "failure_reason": "iperf control socket closed"
             }
         try:
             logger.debug("Iperf Result: " + str(test_result["end"]["sum_sent"]["bits_per_second"]/1000000) +
@@ -110,13 +151,15 @@ class IperfBenchmark(Benchmark):
                 "sent_bytes": 0,
                 "sent_bps": 0,
                 "received_bytes": 0,
-                "received_bps": 0
+                "received_bps": 0,
+                "failure_reason": "unparsable iperf result: " + str(test_result.get("error", ""))[:200]
             }
         return {
             "sent_bytes": test_result["end"]["sum_sent"]["bytes"],
             "sent_bps": test_result["end"]["sum_sent"]["bits_per_second"],
             "received_bytes": test_result["end"]["sum_received"]["bytes"],
             "received_bps": test_result["end"]["sum_received"]["bits_per_second"],
+            "failure_reason": None,
         }
     
     def print_results(self):
@@ -127,7 +170,121 @@ class IperfBenchmark(Benchmark):
         for result_key in self.results.keys():
             print(result_key, "sent_bps:", mean(self.results[result_key]["sent_bps"]) / 1000000)
             print(result_key, "received_bps:", mean(self.results[result_key]["received_bps"])/ 1000000)
- 
+            failures = [reason for reason in self.results[result_key].get("failure_reason", []) if reason is not None]
+            if failures:
+                print(result_key, "failures:", failures)
+
+
+def _kill_iperf(container_name):
+    # a new server may only start once the old one let go of its port
+    container = get_container(container_name)
+    container.exec_run("pkill -9 iperf3")
+    wait_for_process_exit(container, "iperf3")
+
+
+class MultiTerminalIperfBenchmark(IperfBenchmark):
+    # Runs the same iperf transfer from every terminal's workstation at once, each against an iperf3 server of its own
+    # on the gateway workstation. Results are kept per workstation and summed over all of them under "aggregate".
+    def __init__(self, file_sizes, workstations, reset_on_run=True, iterations=1, base_port=5201):
+        super().__init__(file_sizes, reset_on_run=reset_on_run, iterations=iterations)
+        self.name = "IPerf (" + str(len(workstations)) + " terminals)"
+        # e.g. [workstation for _, workstation, _ in testbed.terminals()]
+        self.workstations = list(workstations)
+        self.ports = {workstation: base_port + index for index, workstation in enumerate(self.workstations)}
+
+    def run(self):
+        with span("iperf warm up"):
+            run_concurrently({workstation: (get_container(workstation).exec_run, ("wget http://1.1.1.1",))
+                              for workstation in self.workstations}, name="Warm Up")
+        gateway_address = str(os.getenv("GW_NETWORK_HEAD")) + ".0.9"
+        for i in range(0, self.iterations):
+            for file_size in self.file_sizes:
+                test_results = self.run_iperf_test(file_size, self.reset_on_run)
+                attempts = {workstation: 1 for workstation in self.workstations}
+                failed = [workstation for workstation in self.workstations if test_results[workstation]["failure_reason"] is not None]
+                while self.watchdog is not None and failed and attempts[failed[0]] <= self.watchdog.retries:
+                    # like IperfBenchmark.run, only the terminals whose transfer failed are repeated
+                    repaired = []
+                    for workstation in failed:
+                        try:
+                            repair = self.watchdog.repair(get_container(workstation), gateway_address,
+                                                          test_results[workstation]["failure_reason"])
+                        except LinkStalled as error:
+                            test_results[workstation]["failure_reason"] += ", repair failed: " + str(error)
+                            continue
+                        logger.warning("Retrying " + self.result_name(file_size) + " on " + workstation + " after " +
+                                       repair + " (" + test_results[workstation]["failure_reason"] + ")")
+                        repaired.append(workstation)
+                    if not repaired:
+                        break
+                    test_results.update(self.run_iperf_test(file_size, self.reset_on_run, workstations=repaired))
+                    for workstation in repaired:
+                        attempts[workstation] += 1
+                    failed = [workstation for workstation in repaired if test_results[workstation]["failure_reason"] is not None]
+                for workstation in self.workstations:
+                    test_results[workstation]["attempts"] = attempts[workstation]
+                test_results["aggregate"] = self.aggregate(test_results)
+                results = self.results.setdefault(self.result_name(file_size), {})
+                for workstation, workstation_results in test_results.items():
+                    self.add_results(results.setdefault(workstation, {}), workstation_results)
+            print("Interim Results (Iter:", i+1, " of ", self.iterations, "):", self.results)
+
+    def aggregate(self, test_results):
+        return {key: sum(test_results[workstation][key] for workstation in self.workstations)
+                for key in ("sent_bytes", "sent_bps", "received_bytes", "received_bps")}
+
+    def run_iperf_test(self, transfer_bytes, reset_on_run, with_timeout=True, timeout=600, workstations=None):
+        # the transfers of workstations, all of them by default. Every iperf3 on the gateway workstation is stopped,
+        # when only some terminals are repeated the others' transfers are already over.
+        workstations = list(self.workstations if workstations is None else workstations)
+        gateway_workstation = get_container(os.getenv('WS_GW_CONTAINER_NAME'))
+        with span("iperf server restart"):
+            if reset_on_run:
+                run_concurrently({container_name: (_kill_iperf, (container_name,))
+                                  for container_name in workstations + [gateway_workstation.name]}, name="Iperf Reset")
+            logger.debug("Starting " + str(len(workstations)) + " iperf servers")
+            for workstation in workstations:
+                gateway_workstation.exec_run("iperf3 -s -p " + str(self.ports[workstation]), detach=True)
+            for workstation in workstations:
+                wait_for_port(gateway_workstation, self.ports[workstation])
+        command = "iperf3 --no-delay -c " + str(os.getenv("GW_NETWORK_HEAD")) + ".0.9 -R --json -n " + str(transfer_bytes)
+        with span("iperf transfer", MEASUREMENT, transfer_bytes=transfer_bytes, terminals=len(workstations)):
+            outcomes = run_concurrently({workstation: (self._transfer, (workstation, command + " -p " + str(self.ports[workstation]),
+                                                                        transfer_bytes, with_timeout, timeout))
+                                         for workstation in workstations}, name="Iperf")
+        test_results = {}
+        for workstation in workstations:
+            output, failure_reason = outcomes[workstation]
+            test_results[workstation] = self.parse_iperf_output(output)
+            if failure_reason is not None:
+                test_results[workstation]["failure_reason"] = failure_reason
+        if workstations == self.workstations:
+            test_results["aggregate"] = self.aggregate(test_results)
+        return test_results
+
+    def _transfer(self, workstation, command, transfer_bytes, with_timeout, timeout):
+        # (output, failure reason) of one terminal's transfer, under the watchdog if the scenario has one
+        container = get_container(workstation)
+        if self.watchdog is not None:
+            _, output, failure_reason = self.watchdog.run(container, "/usr/bin/" + command, transfer_bytes,
+                                                          str(os.getenv("GW_NETWORK_HEAD")) + ".0.9")
+            return output, failure_reason
+        if with_timeout:
+            command = "/usr/bin/timeout --signal=SIGINT " + str(timeout) + " /usr/bin/" + command
+        return container.exec_run(command).output, None
+
+    def print_results(self):
+        print("Full Results: ")
+        print(self.results)
+        print("~"*25)
+        print("Average Speeds: ")
+        for result_key in self.results.keys():
+            for workstation, results in self.results[result_key].items():
+                print(result_key, workstation, "received_bps:", mean(results["received_bps"]) / 1000000)
+            failed = sum(len([reason for reason in results["failure_reason"] if reason is not None])
+                         for workstation, results in self.results[result_key].items() if workstation != "aggregate")
+            print(result_key, "failed transfers:", failed)
+
 
 class SitespeedBenchmark(Benchmark):
     def __init__(self, hosts=alexa_top_20, iterations=1, average_only=False, scenario=None, sub_iterations=1):
@@ -142,21 +299,24 @@ class SitespeedBenchmark(Benchmark):
 
     def run(self):
         logger.debug("Launching SiteSpeed.io Tests")
-        docker_client = docker.from_env()
-        #terminal_workstation = docker_client.containers.get(os.getenv("SITESPEED_CONTAINER_NAME"))
+        #terminal_workstation = get_container(os.getenv("SITESPEED_CONTAINER_NAME"))
         #terminal_workstation.exec_run("ip route del default")
         #terminal_workstation.exec_run("ip route add default via " + str(os.getenv("ST_NETWORK_HEAD"))+".0.4")
         
         host_string = ''
         for i in range(0, self.iterations):
-            terminal_workstation = docker_client.containers.get(os.getenv("WS_ST_CONTAINER_NAME"))
+            terminal_workstation = get_container(os.getenv("WS_ST_CONTAINER_NAME"))
             #Connect sitespeed container to satellite network
-            terminal_workstation.exec_run("ip route del default")
-            terminal_workstation.exec_run("ip route add default via " + str(os.getenv("ST_NETWORK_HEAD"))+".0.4")
-            terminal_workstation.exec_run("wget http://1.1.1.1") #use this to warm up vpns/peps
+            with span("sitespeed route and warm up"):
+                exec_batch(terminal_workstation, [
+                    "ip route del default",
+                    "ip route add default via " + str(os.getenv("ST_NETWORK_HEAD"))+".0.4",
+                    "wget http://1.1.1.1", #use this to warm up vpns/peps
+                ])
             for host in self.hosts:
                 host_string = host + " "
-                host_result = terminal_workstation.exec_run('/usr/bin/browsertime -n ' + str(self.sub_iterations) +' --headless --xvfb --browser firefox --cacheClearRaw  --firefox.geckodriverPath /usr/bin/geckodriver --firefox.preference network.dns.disableIPv6:true --video=false --visualMetrics=false --visualElements=false ' + str(host_string))
+                with span("browsertime", MEASUREMENT, host=host):
+                    host_result = terminal_workstation.exec_run('/usr/bin/browsertime -n ' + str(self.sub_iterations) +' --headless --xvfb --browser firefox --cacheClearRaw  --firefox.geckodriverPath /usr/bin/geckodriver --firefox.preference network.dns.disableIPv6:true --video=false --visualMetrics=false --visualElements=false ' + str(host_string))
                 matches = re.findall('Load: ([0-9.]+)([ms])', str(host_result))
                 if self.sub_iterations > 1:
                     matches = matches[:-1] # the last match is the average load time, which we don't want mixing up our stats
@@ -197,9 +357,9 @@ class SpeedtestBenchmark(Benchmark):
 
     def run(self):
         logger.debug("Launching Speedtest CLI")
-        docker_client = docker.from_env()
-        terminal_workstation = docker_client.containers.get(os.getenv("WS_ST_CONTAINER_NAME"))
-        speedtest_results = terminal_workstation.exec_run('python3 /tmp/speedtest.py --json --server ' + str(self.server_id))
+        terminal_workstation = get_container(os.getenv("WS_ST_CONTAINER_NAME"))
+        with span("speedtest", MEASUREMENT):
+            speedtest_results = terminal_workstation.exec_run('python3 /tmp/speedtest.py --json --server ' + str(self.server_id))
         json_string = speedtest_results.output.decode('unicode_escape').rstrip('\n')
         json_data = json.loads(json_string)
         logger.success("Speedtest Complete" + str(json_data["upload"]) + "/" + str(json_data["download"]))
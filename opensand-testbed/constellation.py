@@ -0,0 +1,204 @@
+import hashlib
+import json
+import os
+import numpy
+from loguru import logger
+from opensand_config import ScenarioConfig
+
+EARTH_RADIUS_KM = 6371.0
+EARTH_MU_KM3_S2 = 398600.4418
+EARTH_ROTATION_RAD_S = 7.2921159e-5
+LIGHT_SPEED_KM_S = 299792.458
+# time steps propagated at once at the fine resolution
+FINE_CHUNK = 1000000
+TRACE_CACHE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".trace_cache")
+
+
+class WalkerConstellation(object):
+    # Circular orbits in a Walker pattern: planes evenly spread over raan_spread_deg (360 for a delta constellation,
+    # 180 for a star one like Iridium), satellites evenly spaced within each plane and offset between neighbouring
+    # planes by the phasing factor.
+    def __init__(self, planes, sats_per_plane, altitude_km, inclination_deg, phasing=1, raan_spread_deg=360.0):
+        self.planes = planes
+        self.sats_per_plane = sats_per_plane
+        self.altitude_km = altitude_km
+        self.inclination_deg = inclination_deg
+        self.phasing = phasing
+        self.raan_spread_deg = raan_spread_deg
+        self.radius_km = EARTH_RADIUS_KM + altitude_km
+        self.mean_motion = numpy.sqrt(EARTH_MU_KM3_S2 / self.radius_km ** 3)
+        plane_index = numpy.repeat(numpy.arange(planes), sats_per_plane)
+        slot_index = numpy.tile(numpy.arange(sats_per_plane), planes)
+        self.raan = numpy.radians(raan_spread_deg) * plane_index / planes
+        self.phase = 2 * numpy.pi * (slot_index / sats_per_plane + phasing * plane_index / (planes * sats_per_plane))
+
+    @classmethod
+    def iridium(cls):
+        return cls(planes=6, sats_per_plane=11, altitude_km=780, inclination_deg=86.4, phasing=2, raan_spread_deg=180)
+
+    @classmethod
+    def starlink(cls):
+        # the first 550km shell
+        return cls(planes=72, sats_per_plane=22, altitude_km=550, inclination_deg=53, phasing=17)
+
+    @classmethod
+    def o3b(cls):
+        return cls(planes=1, sats_per_plane=20, altitude_km=8062, inclination_deg=0)
+
+    @property
+    def size(self):
+        return self.planes * self.sats_per_plane
+
+    def parameters(self):
+        return {"planes": self.planes, "sats_per_plane": self.sats_per_plane, "altitude_km": self.altitude_km,
+                "inclination_deg": self.inclination_deg, "phasing": self.phasing, "raan_spread_deg": self.raan_spread_deg}
+
+    def positions(self, times, satellites=None):
+        # Earth-fixed positions in km, shape (len(times), satellites, 3). With satellites given as one index per time
+        # step only that satellite is propagated, shape (len(times), 3).
+        times = numpy.asarray(times, dtype=float)
+        if satellites is None:
+            raan, phase, times = self.raan[None, :], self.phase[None, :], times[:, None]
+        else:
+            raan, phase = self.raan[satellites], self.phase[satellites]
+        argument = phase + self.mean_motion * times
+        inclination = numpy.radians(self.inclination_deg)
+        cos_argument, sin_argument = numpy.cos(argument), numpy.sin(argument)
+        cos_raan, sin_raan = numpy.cos(raan), numpy.sin(raan)
+        x = self.radius_km * (cos_raan * cos_argument - sin_raan * sin_argument * numpy.cos(inclination))
+        y = self.radius_km * (sin_raan * cos_argument + cos_raan * sin_argument * numpy.cos(inclination))
+        z = self.radius_km * sin_argument * numpy.sin(inclination) * numpy.ones_like(times)
+        # the ground stations rotate with the Earth, so rotate the orbits the other way instead
+        rotation = EARTH_ROTATION_RAD_S * times
+        cos_rotation, sin_rotation = numpy.cos(rotation), numpy.sin(rotation)
+        return numpy.stack([x * cos_rotation + y * sin_rotation, -x * sin_rotation + y * cos_rotation, z], axis=-1)
+
+
+def ground_position(latitude_deg, longitude_deg):
+    latitude, longitude = numpy.radians(latitude_deg), numpy.radians(longitude_deg)
+    return EARTH_RADIUS_KM * numpy.array([numpy.cos(latitude) * numpy.cos(longitude),
+                                          numpy.cos(latitude) * numpy.sin(longitude), numpy.sin(latitude)])
+
+
+def elevations(positions, ground):
+    # degrees above the horizon of every position seen from ground, positions in the same frame
+    offset = positions - ground
+    distance = numpy.linalg.norm(offset, axis=-1)
+    return numpy.degrees(numpy.arcsin(offset @ (ground / EARTH_RADIUS_KM) / distance)), distance
+
+
+def select_serving(usable, elevation, strategy="sticky"):
+    # serving satellite index per time step, -1 where none is usable. "max_elevation" always picks the highest
+    # satellite, "sticky" keeps a satellite until it becomes unusable and only then hands over to the highest one.
+    masked = numpy.where(usable, elevation, -numpy.inf)
+    if strategy == "max_elevation":
+        return numpy.where(usable.any(axis=1), numpy.argmax(masked, axis=1), -1)
+    if strategy != "sticky":
+        raise ValueError("Unknown serving satellite strategy " + str(strategy))
+    serving = numpy.full(len(usable), -1)
+    any_usable = usable.any(axis=1)
+    step = 0
+    # one iteration per handover or outage, the spans in between are found with vectorized searches
+    while step < len(usable):
+        if not any_usable[step]:
+            next_usable = numpy.argmax(any_usable[step:])
+            step = len(usable) if next_usable == 0 else step + next_usable
+            continue
+        satellite = numpy.argmax(masked[step])
+        lost = numpy.argmin(usable[step:, satellite])
+        end = len(usable) if usable[step:, satellite].all() else step + lost
+        serving[step:end] = satellite
+        step = end
+    return serving
+
+
+def delay_trace(constellation, terminal, gateway=None, duration_s=3600, step_s=1.0, selection_step_s=1.0,
+                min_elevation_deg=10.0, strategy="sticky", processing_delay_ms=0.0, cache=True):
+    # One-way delay in ms from terminal (latitude, longitude) through its serving satellite, down to gateway when one
+    # is given (a bent pipe, the satellite then has to see both), every step_s seconds. The serving satellite is
+    # chosen every selection_step_s seconds over all satellites at once and only that satellite is propagated at the
+    # fine resolution, which keeps hours of millisecond steps within memory. Returns (times, delays, serving) with
+    # NaN delays and serving -1 where no satellite is usable.
+    parameters = {"constellation": constellation.parameters(), "terminal": list(terminal),
+                  "gateway": list(gateway) if gateway is not None else None, "duration_s": duration_s, "step_s": step_s,
+                  "selection_step_s": selection_step_s, "min_elevation_deg": min_elevation_deg, "strategy": strategy,
+                  "processing_delay_ms": processing_delay_ms}
+    cache_path = os.path.join(TRACE_CACHE_DIRECTORY, hashlib.sha256(json.dumps(parameters, sort_keys=True).encode())
+                              .hexdigest() + ".npz")
+    if cache and os.path.exists(cache_path):
+        cached = numpy.load(cache_path)
+        return cached["times"], cached["delays"], cached["serving"]
+
+    terminal_position = ground_position(*terminal)
+    gateway_position = ground_position(*gateway) if gateway is not None else None
+    selection_times = numpy.arange(0, duration_s + selection_step_s, selection_step_s)
+    usable = numpy.ones((len(selection_times), constellation.size), dtype=bool)
+    # bounded memory for long traces of big constellations
+    chunk = max(1, int(2e7 // (constellation.size * 3)))
+    terminal_elevation = numpy.empty(usable.shape)
+    for start in range(0, len(selection_times), chunk):
+        positions = constellation.positions(selection_times[start:start + chunk])
+        terminal_elevation[start:start + chunk] = elevations(positions, terminal_position)[0]
+        if gateway_position is not None:
+            usable[start:start + chunk] &= elevations(positions, gateway_position)[0] >= min_elevation_deg
+    usable &= terminal_elevation >= min_elevation_deg
+    selected = select_serving(usable, terminal_elevation, strategy)
+
+    times = numpy.arange(0, duration_s, step_s)
+    serving = selected[numpy.minimum((times // selection_step_s).astype(int), len(selected) - 1)]
+    delays = numpy.empty(len(times))
+    for start in range(0, len(times), FINE_CHUNK):
+        positions = constellation.positions(times[start:start + FINE_CHUNK], numpy.maximum(serving[start:start + FINE_CHUNK], 0))
+        distance = numpy.linalg.norm(positions - terminal_position, axis=-1)
+        if gateway_position is not None:
+            distance += numpy.linalg.norm(positions - gateway_position, axis=-1)
+        delays[start:start + FINE_CHUNK] = distance / LIGHT_SPEED_KM_S * 1000 + processing_delay_ms
+    delays[serving < 0] = numpy.nan
+    handovers = int(numpy.count_nonzero(numpy.diff(selected[selected >= 0])))
+    logger.debug("Generated " + str(len(times)) + " step delay trace with " + str(handovers) + " handovers, " +
+                 str(round(100 * numpy.mean(serving < 0), 2)) + "% without coverage")
+    if cache:
+        os.makedirs(TRACE_CACHE_DIRECTORY, exist_ok=True)
+        numpy.savez_compressed(cache_path, times=times, delays=delays, serving=serving)
+    return times, delays, serving
+
+
+def delay_traces(constellation, terminals, **trace_kwargs):
+    # traces for several terminal locations, keyed like terminals, e.g. {"zurich": (47.4, 8.5), ...}
+    return {name: delay_trace(constellation, location, **trace_kwargs) for name, location in terminals.items()}
+
+
+def delay_rows(times, delays, resolution_ms=1):
+    # Compresses a trace into the rows OpenSAND's FileDelay plugin reads: a row only where the delay, rounded to
+    # resolution_ms, changes. Gaps without coverage keep the last delay since the plugin cannot express an outage.
+    delays = numpy.asarray(delays, dtype=float)
+    if numpy.isnan(delays).all():
+        raise ValueError("Delay trace has no coverage at all")
+    valid = ~numpy.isnan(delays)
+    # carry the last covered delay forward (and the first one backwards) over coverage gaps
+    last_valid = numpy.maximum.accumulate(numpy.where(valid, numpy.arange(len(delays)), -1))
+    filled = delays[numpy.where(last_valid >= 0, last_valid, numpy.argmax(valid))]
+    rounded = (numpy.round(filled / resolution_ms) * resolution_ms).astype(int)
+    changes = numpy.concatenate([[0], numpy.flatnonzero(numpy.diff(rounded)) + 1])
+    return [(_format_time(times[index]), int(rounded[index])) for index in changes]
+
+
+def _format_time(time_s):
+    # whole seconds stay integers like in satdelay.csv
+    return int(time_s) if float(time_s).is_integer() else round(float(time_s), 3)
+
+
+def write_delay_file(path, times, delays, resolution_ms=1):
+    rows = delay_rows(times, delays, resolution_ms)
+    with open(path, "w") as delay_file:
+        delay_file.writelines(str(time_s) + " " + str(delay_ms) + "\n" for time_s, delay_ms in rows)
+    return rows
+
+
+def materialize_delay_scenario(times, delays, name="constellation_scenario", base="delay_scenario", resolution_ms=1):
+    # an OpenSAND scenario replaying the trace on both the terminal and the gateway, e.g. for
+    # testbed.opensand_scenario = materialize_delay_scenario(*delay_trace(...)[:2])
+    scenario = ScenarioConfig.load(base).copy(name)
+    scenario.set_delay_file(delay_rows(times, delays, resolution_ms))
+    scenario.materialize()
+    return name
@@ -0,0 +1,154 @@
+import json
+import os
+import tempfile
+import time
+from loguru import logger
+from docker_utils import get_docker_client, get_container
+from dotenv import load_dotenv
+load_dotenv()
+
+# OpenSAND's frame scheduling runs in these, each gets cores no other container on the host may use
+EMULATOR_CONTAINERS = ["SAT_CONTAINER_NAME", "GW_CONTAINER_NAME", "ST_CONTAINER_NAME"]
+# iperf, browsertime, the VPN server and the gateway side of QPEP share the testbed's measurement cores
+MEASUREMENT_CONTAINERS = ["WS_ST_CONTAINER_NAME", "WS_GW_CONTAINER_NAME", "WS_OVPN_CONTAINER_NAME", "SITESPEED_CONTAINER_NAME"]
+# shared by every testbed on the host so parallel testbeds never pin onto the same cores
+ALLOCATION_FILE = os.path.join(tempfile.gettempdir(), "qpep-cpusets.json")
+
+
+class CpuAllocationError(RuntimeError):
+    pass
+
+
+def _process_alive(pid):
+    # allocations come from harnesses on this host, they share the allocation file in its temp directory
+    if not isinstance(pid, int):
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # someone else's process, but alive
+        return True
+    return True
+
+
+class CpuAllocator(object):
+    # Allocations are kept until release(). One whose owning process is gone is expired by the next reader, whatever
+    # the state of its containers: allocate() runs before docker-compose up, so a testbed that is starting has none.
+    def __init__(self, emulator_cores=1, measurement_cores=2, reserved_cores=1, allocation_file=ALLOCATION_FILE,
+                 extra_terminals=()):
+        self.emulator_cores = emulator_cores
+        self.measurement_cores = measurement_cores
+        # (terminal container, workstation container) of a MultiTerminalTestbed's terminals beyond the first: each
+        # terminal gets emulator cores of its own, the workstations share the measurement cores
+        self.extra_terminals = list(extra_terminals)
+        # the first cores are left to the docker daemon, the harness and the host itself
+        self.reserved_cores = reserved_cores
+        self.allocation_file = allocation_file
+        self.lock_file = allocation_file + ".lock"
+
+    @property
+    def owner(self):
+        # one allocation per testbed, named after its satellite container which is unique per .env
+        return os.getenv("SAT_CONTAINER_NAME")
+
+    def _lock(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                os.close(os.open(self.lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return
+            except FileExistsError:
+                # a harness that died while holding the lock must not block every other testbed forever
+                try:
+                    if time.time() - os.path.getmtime(self.lock_file) > timeout:
+                        os.remove(self.lock_file)
+                except FileNotFoundError:
+                    pass
+                if time.monotonic() > deadline:
+                    raise CpuAllocationError("Timed out waiting for " + self.lock_file)
+                time.sleep(0.05)
+
+    def _unlock(self):
+        if os.path.exists(self.lock_file):
+            os.remove(self.lock_file)
+
+    def _read_allocations(self):
+        # {owner: {"pid": process that allocated, "cores": {container: cores}}}
+        try:
+            with open(self.allocation_file, "r") as allocation_file:
+                allocations = json.load(allocation_file)
+        except (OSError, ValueError):
+            return {}
+        for owner in list(allocations.keys()):
+            if owner != self.owner and not _process_alive(allocations[owner].get("pid")):
+                logger.debug("Expiring the cores of " + str(owner) + ", its harness is gone")
+                del allocations[owner]
+        return allocations
+
+    def _write_allocations(self, allocations):
+        with open(self.allocation_file, "w") as allocation_file:
+            json.dump(allocations, allocation_file, indent=2)
+
+    def host_cores(self):
+        # the containers run wherever the docker daemon runs, which on Docker Desktop is a VM with its own core count
+        return list(range(self.reserved_cores, get_docker_client().info()["NCPU"]))
+
+    def emulator_containers(self):
+        # the container variables of the testbed's emulators and the names of its extra terminals
+        return EMULATOR_CONTAINERS + [terminal for terminal, _ in self.extra_terminals]
+
+    def allocate(self):
+        self._lock()
+        try:
+            allocations = self._read_allocations()
+            emulators = self.emulator_containers()
+            own = allocations.pop(self.owner, None)
+            if own is not None and set(own["cores"]) == set(emulators + ["measurement"]):
+                own["pid"] = os.getpid()
+                allocations[self.owner] = own
+                self._write_allocations(allocations)
+                return own["cores"]
+            taken = set()
+            for allocation in allocations.values():
+                for cores in allocation["cores"].values():
+                    taken.update(cores)
+            free_cores = [core for core in self.host_cores() if core not in taken]
+            needed = self.emulator_cores * len(emulators) + self.measurement_cores
+            if len(free_cores) < needed:
+                raise CpuAllocationError("Testbed " + str(self.owner) + " needs " + str(needed) + " free cores but only " +
+                                         str(len(free_cores)) + " of " + str(len(self.host_cores())) +
+                                         " are free (" + str(len(allocations)) + " other testbeds pinned)")
+            allocation = {}
+            for container in emulators:
+                allocation[container] = free_cores[:self.emulator_cores]
+                free_cores = free_cores[self.emulator_cores:]
+            allocation["measurement"] = free_cores[:self.measurement_cores]
+            allocations[self.owner] = {"pid": os.getpid(), "cores": allocation}
+            self._write_allocations(allocations)
+            return allocation
+        finally:
+            self._unlock()
+
+    def release(self):
+        self._lock()
+        try:
+            allocations = self._read_allocations()
+            allocations.pop(self.owner, None)
+            self._write_allocations(allocations)
+        finally:
+            self._unlock()
+
+    def pin_containers(self):
+        allocation = self.allocate()
+        containers = [(container_variable, os.getenv(container_variable))
+                      for container_variable in EMULATOR_CONTAINERS + MEASUREMENT_CONTAINERS]
+        for terminal, workstation in self.extra_terminals:
+            containers += [(terminal, terminal), (workstation, workstation)]
+        for key, container_name in containers:
+            cores = allocation.get(key, allocation["measurement"])
+            cpuset = ",".join(str(core) for core in cores)
+            get_container(container_name).update(cpuset_cpus=cpuset)
+            logger.debug("Pinned " + str(container_name) + " to cores " + cpuset)
+        return allocation
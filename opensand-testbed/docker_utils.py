@@ -0,0 +1,295 @@
+import contextlib
+import os
+import subprocess
+import threading
+import time
+import uuid
+from collections import namedtuple
+from loguru import logger
+import docker
+from fakes import dry_run, FakeDockerClient, fake_compose
+from dotenv import load_dotenv
+load_dotenv()
+
+# sized for the concurrent exec calls one testbed makes, docker-py's default pool of 10 drops connections beyond that
+MAX_POOL_SIZE = 32
+# container events after which a cached handle may point at a container that no longer exists
+INVALIDATING_EVENTS = {"die", "destroy", "kill", "oom", "rename", "restart", "start", "stop"}
+
+# the status a container event leaves the container in, kill and oom are followed by a die of their own
+STATUS_EVENTS = {"create": "created", "start": "running", "restart": "running", "unpause": "running",
+                 "pause": "paused", "die": "exited", "stop": "exited", "destroy": "removed"}
+
+BatchResult = namedtuple("BatchResult", ["command", "exit_code", "output"])
+# health is None for containers without a healthcheck, changed is the time.monotonic() of the last event
+ContainerState = namedtuple("ContainerState", ["status", "health", "exit_code", "changed"])
+ContainerFailure = namedtuple("ContainerFailure", ["time", "container", "reason"])
+
+_lock = threading.Lock()
+_client = None
+_client_pid = None
+_containers = {}
+_events_thread = None
+_tracker = None
+
+
+class ContainerStateTimeout(TimeoutError):
+    pass
+
+
+class ContainerStateTracker(object):
+    # Live state of every container on the Docker events stream, kept by the event listener thread so nothing has to
+    # poll exec_run or inspect to learn that a container started, died or changed health. Processes registered with
+    # watch_process (e.g. QPEP, which "pkill -9 main" ends without any container event) are followed through their
+    # exec_start/exec_die events. While monitor() is active, a monitored container dying or a watched process
+    # exiting is a failure: it is logged the moment the event arrives and handed to the on_failure callbacks.
+    def __init__(self):
+        self._condition = threading.Condition()
+        self.states = {}
+        self.failures = []
+        self._execs = {}
+        self._watched = {}
+        self._monitored = set()
+        self._suspended = 0
+        self._callbacks = []
+
+    def _inspect(self, name):
+        try:
+            state = get_docker_client().api.inspect_container(name)["State"]
+        except docker.errors.NotFound:
+            return ContainerState("removed", None, None, time.monotonic())
+        return ContainerState(state.get("Status"), (state.get("Health") or {}).get("Status"), state.get("ExitCode"),
+                              time.monotonic())
+
+    def state(self, name):
+        # containers without an event since the listener started are inspected once, events keep them current after
+        get_docker_client()
+        with self._condition:
+            if name in self.states:
+                return self.states[name]
+        state = self._inspect(name)
+        with self._condition:
+            return self.states.setdefault(name, state)
+
+    def wait_for(self, name, status="running", health=None, timeout=120):
+        # blocks until the container has status (and health, if given), woken by the events instead of polling
+        deadline = time.monotonic() + timeout
+        state = self.state(name)
+        with self._condition:
+            while True:
+                state = self.states.get(name, state)
+                if state.status == status and (health is None or state.health == health):
+                    return state
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ContainerStateTimeout("Timed out waiting for " + str(name) + " to be " + str(status) +
+                                                ("/" + str(health) if health else "") + " (last: " + str(state) + ")")
+                self._condition.wait(remaining)
+
+    def wait_for_all(self, names, status="running", health=None, timeout=120):
+        deadline = time.monotonic() + timeout
+        return {name: self.wait_for(name, status, health, max(deadline - time.monotonic(), 0)) for name in names}
+
+    def watch_process(self, container_name, command_part, label=None):
+        # execs in container_name whose command contains command_part count as failed when they exit while monitored
+        with self._condition:
+            self._watched.setdefault(container_name, {})[command_part] = label or command_part
+
+    def unwatch_process(self, container_name, command_part=None):
+        with self._condition:
+            if command_part is None:
+                self._watched.pop(container_name, None)
+            else:
+                self._watched.get(container_name, {}).pop(command_part, None)
+
+    def on_failure(self, callback):
+        with self._condition:
+            self._callbacks.append(callback)
+
+    @contextlib.contextmanager
+    def monitor(self, names):
+        # yields the list the failures of names are appended to while the block runs, e.g. a benchmark
+        failures = []
+
+        def collect(failure):
+            if failure.container in names:
+                failures.append(failure)
+
+        with self._condition:
+            self._monitored.update(names)
+            self._callbacks.append(collect)
+        try:
+            yield failures
+        finally:
+            with self._condition:
+                self._monitored.difference_update(names)
+                self._callbacks.remove(collect)
+
+    @contextlib.contextmanager
+    def suspended(self):
+        # deliberate restarts (a repair, a redeploy) are not failures
+        with self._condition:
+            self._suspended += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._suspended -= 1
+
+    def failures_since(self, since, names=None):
+        with self._condition:
+            return [failure for failure in self.failures if failure.time >= since and (names is None or failure.container in names)]
+
+    def handle_event(self, event):
+        action = event.get("Action") or event.get("status") or ""
+        attributes = event.get("Actor", {}).get("Attributes", {})
+        name = attributes.get("name")
+        if name is None:
+            return
+        failure = None
+        with self._condition:
+            previous = self.states.get(name, ContainerState(None, None, None, None))
+            kind, _, detail = action.partition(":")
+            if kind in STATUS_EVENTS:
+                exit_code = int(attributes["exitCode"]) if "exitCode" in attributes else previous.exit_code
+                health = None if kind in ("start", "restart", "destroy") else previous.health
+                self.states[name] = ContainerState(STATUS_EVENTS[kind], health, exit_code, time.monotonic())
+                if kind == "die" and name in self._monitored:
+                    failure = "container died with exit code " + str(exit_code)
+            elif kind == "health_status":
+                self.states[name] = previous._replace(health=detail.strip(), changed=time.monotonic())
+                if detail.strip() == "unhealthy" and name in self._monitored:
+                    failure = "container unhealthy"
+            elif kind == "oom" and name in self._monitored:
+                failure = "container ran out of memory"
+            elif kind == "exec_start":
+                self._execs[attributes.get("execID")] = (name, detail.strip())
+            elif kind == "exec_die":
+                _, command = self._execs.pop(attributes.get("execID"), (name, ""))
+                for command_part, label in self._watched.get(name, {}).items():
+                    if command_part in command and name in self._monitored:
+                        failure = label + " exited with code " + str(attributes.get("exitCode"))
+            if failure is not None and self._suspended:
+                failure = None
+            callbacks = list(self._callbacks) if failure is not None else []
+            if failure is not None:
+                failure = ContainerFailure(time.monotonic(), name, failure)
+                self.failures.append(failure)
+            self._condition.notify_all()
+        if failure is not None:
+            logger.error("Container failure in " + name + ": " + failure.reason)
+            for callback in callbacks:
+                callback(failure)
+
+    def reset(self):
+        # after the event stream dropped the table may have missed events, so everything is inspected afresh
+        with self._condition:
+            self.states.clear()
+            self._execs.clear()
+            self._condition.notify_all()
+
+
+def container_states():
+    global _tracker
+    with _lock:
+        if _tracker is None:
+            _tracker = ContainerStateTracker()
+        return _tracker
+
+
+def get_docker_client():
+    # one client per process, forked pool workers must not share the parent's connection pool
+    global _client, _client_pid
+    with _lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = FakeDockerClient() if dry_run() else docker.from_env(max_pool_size=MAX_POOL_SIZE)
+            _client_pid = os.getpid()
+            _containers.clear()
+            _start_event_listener()
+        return _client
+
+
+def compose(arguments, env=None, capture=False, **kwargs):
+    # runs docker-compose with arguments, returning its output when capture is set and its exit code otherwise
+    if dry_run():
+        return fake_compose(arguments, capture)
+    if capture:
+        return subprocess.check_output(["docker-compose"] + list(arguments), env=env, **kwargs)
+    return subprocess.call(["docker-compose"] + list(arguments), env=env, **kwargs)
+
+
+def get_container(name):
+    # name is the container name as configured in .env, e.g. get_container(os.getenv("ST_CONTAINER_NAME"))
+    client = get_docker_client()
+    with _lock:
+        container = _containers.get(name)
+    if container is None:
+        container = client.containers.get(name)
+        with _lock:
+            _containers[name] = container
+    return container
+
+
+def invalidate_container(name=None):
+    with _lock:
+        if name is None:
+            _containers.clear()
+        else:
+            _containers.pop(name, None)
+
+
+def exec_batch(container, commands, **exec_kwargs):
+    # Runs a phase's commands for one container as a single exec. Every command runs regardless of earlier failures,
+    # exactly like issuing them as separate exec_run calls, and gets its own exit code and combined stdout/stderr.
+    if isinstance(container, str):
+        container = get_container(container)
+    marker = "__batch_" + uuid.uuid4().hex + "__"
+    script = ""
+    for index, command in enumerate(commands):
+        script += "printf '\\n%s begin %d\\n' " + marker + " " + str(index) + "; "
+        # a subshell per command so an exit in one command cannot end the batch
+        script += "( " + command + "\n) 2>&1; "
+        script += "printf '\\n%s end %d %d\\n' " + marker + " " + str(index) + " $?\n"
+    exit_code, output = container.exec_run(["/bin/sh", "-c", script], stdout=True, stderr=True, **exec_kwargs)
+    lines = output.decode(errors="replace").split("\n")
+    results = [BatchResult(command, None, "") for command in commands]
+    current, captured = None, []
+    for line in lines:
+        if line.startswith(marker + " begin "):
+            current, captured = int(line.split()[2]), []
+        elif line.startswith(marker + " end ") and current is not None:
+            # drop the newline printed in front of the end marker
+            output_text = "\n".join(captured[:-1] if captured and captured[-1] == "" else captured)
+            results[current] = BatchResult(commands[current], int(line.split()[3]), output_text)
+            current = None
+        elif current is not None:
+            captured.append(line)
+    return results
+
+
+def _start_event_listener():
+    global _events_thread
+    _events_thread = threading.Thread(target=_listen_for_events, args=(_client,), name="docker-events", daemon=True)
+    _events_thread.start()
+
+
+def _listen_for_events(client):
+    global _client
+    tracker = container_states()
+    try:
+        for event in client.events(decode=True, filters={"type": "container"}):
+            if event.get("status", event.get("Action")) in INVALIDATING_EVENTS:
+                name = event.get("Actor", {}).get("Attributes", {}).get("name")
+                invalidate_container(name)
+            try:
+                tracker.handle_event(event)
+            except Exception as error:
+                logger.warning("Could not track container event " + str(event.get("Action")) + ": " + str(error))
+    except Exception as error:
+        # without events the cache can go stale, so drop it and reconnect on next use
+        logger.warning("Docker event stream closed, resetting container cache: " + str(error))
+        tracker.reset()
+        with _lock:
+            _containers.clear()
+            if _client is client:
+                _client = None
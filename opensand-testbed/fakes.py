@@ -0,0 +1,346 @@
+import io
+import json
+import os
+import queue
+import re
+import socketserver
+import tarfile
+import threading
+import time
+import docker
+from docker.models.containers import ExecResult
+from loguru import logger
+from topology import MAX_TERMINALS
+from dotenv import load_dotenv
+load_dotenv()
+
+# QPEP_DRY_RUN=1 swaps the Docker client, docker-compose and the OpenSAND manager for the in-process stand-ins below,
+# so a sweep from simulation_examples.py runs end to end without a testbed
+DRY_RUN_VARIABLE = "QPEP_DRY_RUN"
+# what the fake link delivers, the canned iperf3 and browsertime results follow from it
+FAKE_LINK_BPS = 20000000
+FAKE_PAGE_LOAD_MS = 1800
+# ports the fake containers always report as listening: QPEP's gateway and client, iperf3 servers of every terminal
+FAKE_LISTENING_PORTS = {"udp": [4242], "tcp": [8080, 1991] + list(range(5201, 5201 + MAX_TERMINALS))}
+EMPTY_TAR = io.BytesIO()
+tarfile.open(fileobj=EMPTY_TAR, mode="w").close()
+BATCH_PATTERN = re.compile(r"printf '\\n%s begin %d\\n' (\S+) (\d+); \( (.*?)\n\) 2>&1; ", re.DOTALL)
+PKILL_PATTERN = re.compile(r"^\s*pkill (?:-\S+\s+)*'?([^']+?)'?\s*$")
+
+_lock = threading.Lock()
+_opensand_server = None
+
+
+def dry_run():
+    return os.getenv(DRY_RUN_VARIABLE, "0") == "1"
+
+
+def _iperf_output(command):
+    transfer_bytes = int(re.search(r"-n\s+(\d+)", command).group(1)) if re.search(r"-n\s+(\d+)", command) else 10000000
+    seconds = transfer_bytes * 8 / FAKE_LINK_BPS
+    end = {"sum_sent": {"bytes": transfer_bytes, "bits_per_second": FAKE_LINK_BPS, "seconds": seconds},
+           "sum_received": {"bytes": transfer_bytes, "bits_per_second": FAKE_LINK_BPS * 0.98, "seconds": seconds}}
+    return 0, json.dumps({"start": {"system_info": "Linux fake"}, "intervals": [], "end": end}, indent=2)
+
+
+def _browsertime_output(command):
+    runs = int(re.search(r"-n\s+(\d+)", command).group(1)) if re.search(r"-n\s+(\d+)", command) else 1
+    url = command.split()[-1]
+    lines = [url + " run " + str(run + 1) + " Load: " + str(round((FAKE_PAGE_LOAD_MS + 50 * run) / 1000, 2)) + "s"
+             for run in range(runs)]
+    if runs > 1:
+        # browsertime closes with the average, which the benchmark drops
+        lines.append(url + " " + str(runs) + " runs Load: " + str(round(FAKE_PAGE_LOAD_MS / 1000, 2)) + "s")
+    return 0, "\n".join(lines)
+
+
+def _ss_output(command):
+    protocol = "udp" if "-u" in command else "tcp"
+    lines = ["State Recv-Q Send-Q Local Address:Port Peer Address:Port"]
+    lines += ["LISTEN 0 128 0.0.0.0:" + str(port) + " 0.0.0.0:*" for port in FAKE_LISTENING_PORTS[protocol]]
+    return 0, "\n".join(lines)
+
+
+def _speedtest_output(command):
+    return 0, json.dumps({"upload": FAKE_LINK_BPS / 4, "download": FAKE_LINK_BPS, "bytes_sent": 5000000,
+                          "bytes_received": 20000000})
+
+
+def _qpep_control_output(command):
+    # QPEP's control endpoint takes every setting it is given and reports its defaults on get
+    line = re.search(r"printf '%s\\n' '?([^'>]*?)'? >&3", command).group(1).split()
+    if line[0] == "get":
+        return 0, "ok acks=10 decimate=4 ackDelay=25 varAckDelay=0.25 minBeforeDecimation=100 congestion=4"
+    return 0, "ok " + " ".join(line[1:])
+
+
+# first match wins, anything else succeeds without output
+FAKE_RESPONSES = [
+    (re.compile(r"iperf3 .*-c "), _iperf_output),
+    (re.compile(r"browsertime"), _browsertime_output),
+    (re.compile(r"^ss -[tu]ln"), _ss_output),
+    (re.compile(r"speedtest\.py"), _speedtest_output),
+    (re.compile(r"/dev/tcp/127\.0\.0\.1/"), _qpep_control_output),
+]
+
+
+class FakeContainer(object):
+    # Answers exec_run from FAKE_RESPONSES and records every call in the client's exec_log. Detached execs stay
+    # "running" until a pkill matches them, and their start and exit go out as exec events like Docker's would.
+    def __init__(self, client, name, image="fake"):
+        self.client = client
+        self.name = name
+        self.id = "fake-" + name
+        self.image = image
+        self.status = "running"
+        self.started_at = time.time()
+        self.processes = {}
+        self.rx_bytes = 0
+
+    @property
+    def attrs(self):
+        return {"Name": "/" + self.name, "State": {"Status": self.status, "Pid": abs(hash(self.name)) % 30000 + 1000,
+                "ExitCode": 0, "StartedAt": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(self.started_at)) + ".000000000Z"}}
+
+    def _respond(self, command):
+        if "statistics/rx_bytes" in command:
+            # a transfer that always makes progress
+            self.rx_bytes += 1 << 20
+            return 0, str(self.rx_bytes)
+        match = re.match(r"^pgrep (?:-\S+\s+)*(\S+)$", command)
+        if match:
+            found = [exec_id for exec_id, process in self.processes.items() if match.group(1) in process]
+            return (0 if found else 1), "\n".join(found)
+        for part in re.split(r";|&&|\|\|", command):
+            match = PKILL_PATTERN.match(part)
+            if match:
+                self._kill(match.group(1))
+        for pattern, response in FAKE_RESPONSES:
+            if pattern.search(command):
+                return response(command)
+        return 0, ""
+
+    def _kill(self, name):
+        for exec_id, command in list(self.processes.items()):
+            if name in command:
+                del self.processes[exec_id]
+                self.client.emit(self.name, "exec_die", execID=exec_id, exitCode="137")
+
+    def _batch(self, script):
+        # exec_batch's markers around the output of every command
+        output = ""
+        for marker, index, command in BATCH_PATTERN.findall(script):
+            exit_code, command_output = self._respond(command)
+            output += "\n" + marker + " begin " + index + "\n" + command_output + "\n" + marker + " end " + index + " " + str(exit_code) + "\n"
+        return 0, output
+
+    def exec_run(self, cmd, detach=False, **kwargs):
+        command = " ".join(cmd) if isinstance(cmd, (list, tuple)) else cmd
+        self.client.exec_log.append((self.name, command, dict(kwargs, detach=detach)))
+        if self.status != "running":
+            raise docker.errors.APIError("Container " + self.name + " is not running")
+        exec_id = self.client.next_exec_id()
+        self.client.emit(self.name, "exec_start: " + command, execID=exec_id)
+        if detach:
+            self.processes[exec_id] = command
+            return ExecResult(None, b"")
+        if isinstance(cmd, (list, tuple)) and "__batch_" in command:
+            exit_code, output = self._batch(cmd[-1])
+        else:
+            exit_code, output = self._respond(command)
+        self.client.emit(self.name, "exec_die", execID=exec_id, exitCode=str(exit_code))
+        return ExecResult(exit_code, output.encode())
+
+    def reload(self):
+        pass
+
+    def logs(self, **kwargs):
+        return b""
+
+    def update(self, **kwargs):
+        pass
+
+    def get_archive(self, path):
+        # the OpenSAND probes of a fake run are an empty directory
+        return iter([EMPTY_TAR.getvalue()]), {"name": os.path.basename(path)}
+
+    def put_archive(self, path, data):
+        return True
+
+    def start(self):
+        self.status, self.started_at = "running", time.time()
+        self.client.emit(self.name, "start")
+
+    def stop(self, **kwargs):
+        self.processes.clear()
+        self.status = "exited"
+        self.client.emit(self.name, "die", exitCode="0")
+
+    def kill(self, **kwargs):
+        self.stop()
+
+    def restart(self, **kwargs):
+        self.stop()
+        self.start()
+
+    def remove(self, force=False, **kwargs):
+        self.stop()
+        self.client.containers.remove(self.name)
+        self.client.emit(self.name, "destroy")
+
+
+class FakeContainerCollection(object):
+    def __init__(self, client):
+        self.client = client
+        self._containers = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        # every container the testbed asks for exists, as if docker-compose up had just run
+        with self._lock:
+            if name not in self._containers:
+                self._containers[name] = FakeContainer(self.client, name)
+            return self._containers[name]
+
+    def list(self, all=False, **kwargs):
+        with self._lock:
+            return [container for container in self._containers.values() if all or container.status == "running"]
+
+    def run(self, image, name=None, **kwargs):
+        with self._lock:
+            self._containers[name] = FakeContainer(self.client, name, image)
+        self.client.emit(name, "start")
+        return self._containers[name]
+
+    def remove(self, name):
+        with self._lock:
+            self._containers.pop(name, None)
+
+
+class FakeImage(object):
+    def __init__(self, tag, labels=None):
+        self.tags = [tag]
+        self.labels = labels or {}
+
+    def tag(self, repository, tag=None, **kwargs):
+        return True
+
+
+class FakeImageCollection(object):
+    def get(self, name):
+        return FakeImage(name)
+
+    def list(self, **kwargs):
+        return []
+
+    def pull(self, repository, tag=None, **kwargs):
+        return FakeImage(repository + ":" + str(tag))
+
+    def build(self, tag=None, labels=None, **kwargs):
+        return FakeImage(tag, labels), []
+
+
+class FakeNetworkCollection(object):
+    def list(self, **kwargs):
+        return []
+
+
+class FakeAPIClient(object):
+    def __init__(self, client):
+        self.client = client
+
+    def inspect_container(self, name):
+        return self.client.containers.get(name).attrs
+
+
+class FakeDockerClient(object):
+    # Stands in for docker.DockerClient. exec_log holds (container, command, exec kwargs) of every exec_run, and
+    # events() streams the container and exec events the fakes emit, so docker_utils' state tracking works unchanged.
+    def __init__(self):
+        self.containers = FakeContainerCollection(self)
+        self.images = FakeImageCollection()
+        self.networks = FakeNetworkCollection()
+        self.api = FakeAPIClient(self)
+        self.exec_log = []
+        self._events = queue.Queue()
+        self._exec_ids = 0
+        self._lock = threading.Lock()
+
+    def next_exec_id(self):
+        with self._lock:
+            self._exec_ids += 1
+            return "fake-exec-" + str(self._exec_ids)
+
+    def emit(self, name, action, **attributes):
+        self._events.put({"Type": "container", "Action": action, "status": action,
+                          "Actor": {"ID": "fake-" + name, "Attributes": dict(attributes, name=name)}, "time": int(time.time())})
+
+    def events(self, decode=True, filters=None):
+        while True:
+            yield self._events.get()
+
+    def info(self):
+        return {"NCPU": os.cpu_count() or 1}
+
+    def close(self):
+        pass
+
+
+def fake_compose(arguments, capture=False):
+    # docker-compose without containers: "config" is an empty project, so nothing gets built
+    logger.debug("Dry run: docker-compose " + " ".join(arguments))
+    return b"services: {}\n" if capture else 0
+
+
+class _OpensandHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        self.wfile.write(b"OpenSAND manager (dry run)\ncommands: status, start, stop, scenario <name>, help\n")
+        for line in self.rfile:
+            command, _, argument = line.decode(errors="replace").strip().partition(" ")
+            if command == "status":
+                response = "\n".join(host + " " + server.state for host in server.hosts)
+            elif command == "start":
+                server.state = "RUNNING"
+                response = "OK"
+            elif command == "stop":
+                server.state = "STOPPED"
+                response = "OK"
+            elif command == "scenario":
+                server.scenario = argument
+                response = "OK"
+            elif command == "help":
+                response = "commands: status, start, stop, scenario <name>, help"
+            else:
+                response = "unknown command " + command
+            self.wfile.write(response.encode() + b"\n")
+
+
+class FakeOpensandServer(socketserver.ThreadingTCPServer):
+    # Speaks enough of the sand-manager command line for OpensandController: a banner ending in the help line, then
+    # status, start, stop and scenario. Every host a testbed can have is reported, so multi terminal testbeds find
+    # theirs as well.
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0, terminals=MAX_TERMINALS):
+        super().__init__((host, port), _OpensandHandler)
+        self.hosts = ["SAT", "GW0"] + ["ST" + str(index) for index in range(1, terminals + 1)]
+        self.state = "STOPPED"
+        self.scenario = None
+        self.thread = threading.Thread(target=self.serve_forever, name="fake-opensand", daemon=True)
+        self.thread.start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+def fake_opensand_port():
+    # one fake manager per process, started on first use
+    global _opensand_server
+    with _lock:
+        if _opensand_server is None:
+            _opensand_server = FakeOpensandServer()
+            logger.debug("Dry run: fake OpenSAND manager on port " + str(_opensand_server.port))
+        return _opensand_server.port
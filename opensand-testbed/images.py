@@ -0,0 +1,178 @@
+import glob
+import hashlib
+import os
+import re
+import shlex
+import subprocess
+import time
+import yaml
+from loguru import logger
+import docker
+from docker_utils import get_docker_client, compose
+from orchestration import run_concurrently
+from timing import span
+from dotenv import load_dotenv
+load_dotenv()
+
+# images are labelled with the hash of what went into them, an image with a matching label needs no rebuild
+CONTEXT_HASH_LABEL = "qpep.context_hash"
+COPY_PATTERN = re.compile(r"^\s*(COPY|ADD)\s+(.*)$", re.IGNORECASE)
+FROM_PATTERN = re.compile(r"^\s*FROM\s+(?:--platform=\S+\s+)?(\S+)", re.IGNORECASE)
+
+
+class ImageBuildError(RuntimeError):
+    pass
+
+
+class ServiceImage(object):
+    def __init__(self, service, context, dockerfile, tag, build_args):
+        self.service = service
+        self.context = context
+        self.dockerfile = dockerfile
+        self.tag = tag
+        self.build_args = build_args
+        self.base_images = []
+        self.context_hash = None
+
+    def _dockerfile_lines(self):
+        with open(os.path.join(self.context, self.dockerfile), "r") as dockerfile:
+            # join continuation lines so a multi line COPY is parsed as one instruction
+            return dockerfile.read().replace("\\\n", " ").splitlines()
+
+    def _copied_paths(self, lines):
+        # Only what the Dockerfile copies can change the image, hashing the whole context would rebuild the
+        # satellite every time a scenario file it only mounts at runtime is edited
+        paths = []
+        for line in lines:
+            match = COPY_PATTERN.match(line)
+            if match is None:
+                continue
+            if match.group(2).lstrip().startswith("--from"):
+                # copied from another build stage, already covered by that stage's instructions
+                continue
+            arguments = [argument for argument in shlex.split(match.group(2)) if not argument.startswith("--")]
+            for source in arguments[:-1]:
+                matches = sorted(glob.glob(os.path.join(self.context, source)))
+                # URLs and missing sources still have to change the hash when the Dockerfile line changes
+                paths += matches if matches else [source]
+        return paths
+
+    def compute_hash(self):
+        lines = self._dockerfile_lines()
+        self.base_images = [match.group(1) for match in map(FROM_PATTERN.match, lines) if match is not None]
+        digest = hashlib.sha256()
+        digest.update("\n".join(lines).encode())
+        for key in sorted(self.build_args):
+            digest.update((key + "=" + str(self.build_args[key]) + "\n").encode())
+        for path in self._copied_paths(lines):
+            if not os.path.exists(path):
+                digest.update(path.encode())
+                continue
+            files = [path] if os.path.isfile(path) else sorted(
+                os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+            for file_path in files:
+                digest.update(os.path.relpath(file_path, self.context).replace(os.sep, "/").encode())
+                digest.update(str(os.stat(file_path).st_mode & 0o111).encode())
+                with open(file_path, "rb") as copied_file:
+                    for chunk in iter(lambda: copied_file.read(1 << 20), b""):
+                        digest.update(chunk)
+        self.context_hash = digest.hexdigest()
+        return self.context_hash
+
+
+class ImageBuilder(object):
+    # Builds the images of every compose service with a build: entry under the names docker-compose expects, so a
+    # following "docker-compose up" uses them as they are. Unchanged images are skipped, images another testbed
+    # project already built from identical contents are only re-tagged, and the rest are built concurrently once the
+    # base images they share have been pulled.
+    def __init__(self, env=None, directory=None):
+        self.env = env if env is not None else dict(os.environ)
+        self.directory = directory if directory is not None else os.getcwd()
+        self.build_times = {}
+
+    def project_name(self):
+        # the name docker-compose 1.x prefixes images with
+        name = self.env.get("COMPOSE_PROJECT_NAME") or os.path.basename(os.path.abspath(self.directory))
+        return re.sub(r"[^-_a-z0-9]", "", name.lower())
+
+    def services(self):
+        config = yaml.safe_load(compose(["config"], env=self.env, capture=True, cwd=self.directory,
+                                         stderr=subprocess.DEVNULL))
+        images = []
+        for service, definition in sorted(config.get("services", {}).items()):
+            build = definition.get("build")
+            if build is None:
+                continue
+            if isinstance(build, str):
+                build = {"context": build}
+            tag = definition.get("image") or self.project_name() + "_" + service
+            images.append(ServiceImage(service, os.path.join(self.directory, build["context"]),
+                                       build.get("dockerfile", "Dockerfile"), tag, build.get("args") or {}))
+        return images
+
+    def _current_hash(self, tag):
+        try:
+            return get_docker_client().images.get(tag).labels.get(CONTEXT_HASH_LABEL)
+        except docker.errors.ImageNotFound:
+            return None
+
+    def _image_with_hash(self, context_hash):
+        images = get_docker_client().images.list(filters={"label": CONTEXT_HASH_LABEL + "=" + context_hash})
+        return images[0] if images else None
+
+    def _pull_base(self, base_image):
+        try:
+            get_docker_client().images.get(base_image)
+            return False
+        except docker.errors.ImageNotFound:
+            pass
+        logger.debug("Pulling Base Image " + base_image)
+        repository, _, tag = base_image.partition(":")
+        with span("pull " + base_image, "build"):
+            get_docker_client().images.pull(repository, tag=tag or "latest")
+        return True
+
+    def _build(self, image):
+        logger.debug("Building Image " + image.tag)
+        start = time.monotonic()
+        with span("build " + image.tag, "build"):
+            try:
+                get_docker_client().images.build(path=image.context, dockerfile=image.dockerfile, tag=image.tag,
+                                                 buildargs={key: str(value) for key, value in image.build_args.items()},
+                                                 labels={CONTEXT_HASH_LABEL: image.context_hash}, rm=True, pull=False)
+            except docker.errors.BuildError as error:
+                output = "".join(str(chunk.get("stream", chunk.get("error", ""))) for chunk in error.build_log)
+                raise ImageBuildError("Building " + image.tag + " failed: " + str(error) + "\n" + output[-2000:])
+        return time.monotonic() - start
+
+    def build(self, services=None, force=False):
+        # returns the context hash of every service image so callers can tell when an image changed, services limits
+        # the build to those compose services
+        images = [image for image in self.services() if services is None or image.service in services]
+        with span("hash build contexts", "build"):
+            for image in images:
+                image.compute_hash()
+        stale = []
+        for image in images:
+            if not force and self._current_hash(image.tag) == image.context_hash:
+                self.build_times[image.service] = 0.0
+                continue
+            existing = None if force else self._image_with_hash(image.context_hash)
+            if existing is not None:
+                existing.tag(image.tag)
+                logger.debug("Tagged " + image.tag + " from identical image " + str(existing.tags))
+                self.build_times[image.service] = 0.0
+                continue
+            stale.append(image)
+        if stale:
+            base_images = sorted(set(base for image in stale for base in image.base_images))
+            run_concurrently({base: (self._pull_base, (base,)) for base in base_images}, name="Pull")
+            # the testbed's images do not depend on each other, only on the bases pulled above
+            self.build_times.update(run_concurrently({image.service: (self._build, (image,)) for image in stale},
+                                                     name="Build"))
+        for image in images:
+            if image in stale:
+                logger.debug("Built " + image.tag + " in " + str(round(self.build_times[image.service], 1)) + "s")
+            else:
+                logger.debug("Image " + image.tag + " is up to date")
+        return {image.service: image.context_hash for image in images}
@@ -0,0 +1,227 @@
+import csv
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+from loguru import logger
+from netem import NetemProfile, DIRECTION_CONTAINERS
+from opensand_config import ScenarioConfig
+from orchestration import run_concurrently
+from timing import span
+from dotenv import load_dotenv
+load_dotenv()
+
+EVENT_KINDS = ("delay", "loss", "rate", "outage")
+# OpenSAND applies a host's delay file to what that host sends
+DIRECTION_HOSTS = {"down": "gw0", "up": "st1"}
+
+# time is seconds from the start of the schedule, value is ms for delay, percent for loss, a tc rate such as "10mbit"
+# (or None to unshape) for rate and seconds for outage, direction is "down", "up" or "both"
+LinkEvent = namedtuple("LinkEvent", ["time", "kind", "value", "direction"])
+AppliedEvent = namedtuple("AppliedEvent", ["scheduled", "applied", "timestamp", "kind", "value", "direction"])
+
+
+class LinkSchedule(object):
+    def __init__(self, events=()):
+        self.events = []
+        for event in events:
+            self.add(*event)
+
+    def add(self, time_s, kind, value, direction="both"):
+        if kind not in EVENT_KINDS:
+            raise ValueError("Unknown link event " + str(kind) + ", expected one of " + str(EVENT_KINDS))
+        if direction not in ("down", "up", "both"):
+            raise ValueError("Unknown link direction " + str(direction))
+        self.events.append(LinkEvent(float(time_s), kind, value, direction))
+        self.events.sort(key=lambda event: event.time)
+        return self
+
+    def delay(self, time_s, delay_ms, direction="both"):
+        return self.add(time_s, "delay", delay_ms, direction)
+
+    def loss(self, time_s, loss_percentage, direction="both"):
+        return self.add(time_s, "loss", loss_percentage, direction)
+
+    def rate(self, time_s, rate, direction="both"):
+        return self.add(time_s, "rate", rate, direction)
+
+    def outage(self, time_s, duration_s, direction="both"):
+        return self.add(time_s, "outage", duration_s, direction)
+
+    @property
+    def duration(self):
+        return max([event.time + (event.value if event.kind == "outage" else 0) for event in self.events] + [0])
+
+    def delay_rows(self, direction):
+        # the delay events of one direction as (seconds, ms) rows for OpenSAND's FileDelay plugin
+        rows = [(event.time, event.value) for event in self.events
+                if event.kind == "delay" and event.direction in (direction, "both")]
+        if rows and rows[0][0] > 0:
+            # the plugin needs a delay from the start, hold the first one until then
+            rows.insert(0, (0, rows[0][1]))
+        return rows
+
+
+class LinkScheduleRunner(object):
+    # Replays a LinkSchedule against a running testbed. Every event has an absolute deadline measured from the start
+    # of the run on the monotonic clock, so a slow tc call delays that one event but never shifts the rest of the
+    # timeline. On OpenSAND testbeds the delay events are compiled into a FileDelay scenario which is loaded before
+    # the run starts, a NetemTestbed changes its link delay live. Loss, rate and outages always go through netem on
+    # the terminal's and gateway's opensand_tun.
+    def __init__(self, testbed, schedule, scenario_name="schedule_scenario", base_scenario="delay_scenario"):
+        self.testbed = testbed
+        self.schedule = schedule
+        self.scenario_name = scenario_name
+        self.base_scenario = base_scenario
+        self.log = []
+        self.start_time = None
+        # when OpenSAND started replaying the compiled delays, the rest of the timeline is aligned to it
+        self.scenario_start = None
+        self._stop = threading.Event()
+        self._thread = None
+        # what each direction's netem profile was when the run started, the events only change its loss and rate
+        self._base_profiles = {}
+        # the loss, rate and outage the events set so far on each direction, a change has to restate all of them
+        self._shaping = {direction: {} for direction in DIRECTION_CONTAINERS}
+
+    @property
+    def live_delay(self):
+        return hasattr(self.testbed, "set_link")
+
+    def prepare(self):
+        # restarting OpenSAND breaks running PEP sessions, so call this before deploying the scenario to benchmark
+        if self.live_delay or self.scenario_start is not None or not any(event.kind == "delay" for event in self.schedule.events):
+            return
+        logger.debug("Compiling Link Schedule Delays into OpenSAND Scenario " + self.scenario_name)
+        scenario = ScenarioConfig.load(self.base_scenario).copy(self.scenario_name)
+        for direction, host in DIRECTION_HOSTS.items():
+            rows = self.schedule.delay_rows(direction)
+            if rows:
+                scenario.set_delay_file(rows, hosts=(host,), file_name="schedule_delay.csv")
+                # replay the timeline once, looping would restart it mid benchmark
+                scenario.set_text(host + "/plugins/file_delay.conf", "delay_conf/loop_mode", "false")
+        scenario.materialize()
+        with span("opensand schedule scenario restart"):
+            self.testbed.opensand.connect()
+            self.testbed.opensand.stop()
+            self.testbed.opensand.load_scenario(self.scenario_name)
+            self.testbed.opensand.start(failure_check=self.testbed.check_opensand_failure)
+        self.testbed.netem.invalidate()
+        self.scenario_start = time.monotonic()
+        self.testbed.write_testbed_state(**{**self.testbed.read_testbed_state(), "opensand_scenario": self.scenario_name})
+        self.testbed.connect_terminal_modem()
+
+    def start(self):
+        # taken before prepare, whose OpenSAND restart leaves the netem cache empty
+        self._base_profiles = {direction: self.testbed.netem.profile(direction) or NetemProfile()
+                               for direction in DIRECTION_CONTAINERS}
+        self._shaping = {direction: {} for direction in DIRECTION_CONTAINERS}
+        self.prepare()
+        self.log = []
+        self._stop.clear()
+        # the OpenSAND delay file runs from the simulation start, any events already due are applied right away
+        self.start_time = self.scenario_start if self.scenario_start is not None else time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="link-schedule", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _timeline(self):
+        # outages become a 100% loss and the restore of whatever loss was set when it ends
+        timeline = []
+        for event in self.schedule.events:
+            if event.kind == "outage":
+                timeline.append(LinkEvent(event.time, "outage_start", event.value, event.direction))
+                timeline.append(LinkEvent(event.time + event.value, "outage_end", event.value, event.direction))
+            else:
+                timeline.append(event)
+        return sorted(timeline, key=lambda event: event.time)
+
+    def _run(self):
+        timeline = self._timeline()
+        index = 0
+        while index < len(timeline) and not self._stop.is_set():
+            deadline = self.start_time + timeline[index].time
+            if self._stop.wait(max(deadline - time.monotonic(), 0)):
+                return
+            # everything due by now goes out together, both directions concurrently
+            due = []
+            while index < len(timeline) and timeline[index].time <= time.monotonic() - self.start_time:
+                due.append(timeline[index])
+                index += 1
+            try:
+                self._apply(due)
+            except Exception as error:
+                logger.error("Link schedule event failed: " + str(error))
+
+    def _apply(self, events):
+        commands = {direction: False for direction in DIRECTION_CONTAINERS}
+        live_delay = None
+        for event in events:
+            directions = list(DIRECTION_CONTAINERS) if event.direction == "both" else [event.direction]
+            if event.kind == "delay":
+                live_delay = event.value
+                continue
+            for direction in directions:
+                shaping = self._shaping[direction]
+                if event.kind == "loss":
+                    shaping["loss"] = event.value
+                elif event.kind == "rate":
+                    shaping["rate"] = event.value
+                elif event.kind == "outage_start":
+                    shaping["outage"] = True
+                elif event.kind == "outage_end":
+                    shaping.pop("outage", None)
+                commands[direction] = True
+        calls = {}
+        profiles = {direction: self._profile(direction) for direction, changed in commands.items() if changed}
+        if profiles:
+            # both directions in one concurrent update that is rolled back if either fails
+            calls["shaping"] = (self.testbed.set_netem_profile, (profiles,))
+        if live_delay is not None and self.live_delay:
+            calls["delay"] = (self.testbed.set_link, (live_delay,))
+        if calls:
+            run_concurrently(calls, name="Link Schedule")
+        applied = time.monotonic() - self.start_time
+        for event in events:
+            entry = AppliedEvent(event.time, applied, datetime.now().isoformat(), event.kind, event.value, event.direction)
+            self.log.append(entry)
+            logger.debug("Link event at " + str(round(applied, 3)) + "s (scheduled " + str(event.time) + "s): " +
+                         event.kind + " " + str(event.value) + " " + event.direction)
+
+    def _profile(self, direction):
+        # the profile the run started with, e.g. a PLR or delay set on the testbed, with the scheduled loss and rate
+        shaping = self._shaping[direction]
+        changes = {}
+        if shaping.get("outage"):
+            changes["loss"] = 100
+        elif "loss" in shaping:
+            changes["loss"] = shaping["loss"]
+        if "loss" in changes:
+            # a scheduled loss replaces a Gilbert-Elliott model, even a loss of 0
+            changes["gilbert_elliott"] = None
+        if "rate" in shaping:
+            changes["rate"] = shaping["rate"]
+        return self._base_profiles.get(direction, NetemProfile()).replace(**changes)
+
+    def write_log(self, path):
+        with open(path, "w", newline="") as log_file:
+            writer = csv.writer(log_file)
+            writer.writerow(AppliedEvent._fields)
+            writer.writerows(self.log)
+        return path
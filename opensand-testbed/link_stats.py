@@ -0,0 +1,157 @@
+import array
+import io
+import json
+import os
+import re
+import tarfile
+import time
+from collections import namedtuple
+import numpy
+from loguru import logger
+import docker
+from docker_utils import get_container
+from timing import events, wall_time, MEASUREMENT
+from dotenv import load_dotenv
+load_dotenv()
+
+# the manager's collector keeps each probe of a run in <scenario>/<run>/<host>/<probe>.log as "time value" lines, one
+# per statistics_timer tick of core_global.conf, the time in ms since the simulation started
+RUN_NAME = "default"
+# where the manager keeps the scenario it starts with when none was loaded by name
+DEFAULT_SCENARIO_PATH = "/root/.opensand/default"
+# queueing, MODCOD, allocated capacity and drops tell a slow DVB link apart from a slow PEP
+DEFAULT_PROBE_PATTERN = re.compile(r"queue|modcod|capacity|alloc|drop|lost|loss|throughput|rate", re.IGNORECASE)
+SAMPLE_PATTERN = re.compile(rb"^\s*([-+0-9.eE]+)[\s,;]+([-+0-9.eE]+)\s*$")
+
+# probes maps (host, probe) to (times, values) arrays, times in seconds from the window's start
+ProbeWindow = namedtuple("ProbeWindow", ["name", "start", "end", "args", "probes"])
+
+
+class _ChunkStream(io.RawIOBase):
+    # file-like view of docker-py's archive chunks, so tarfile reads the probes as they stream out of the container
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        while not self.buffer:
+            try:
+                self.buffer = next(self.chunks)
+            except StopIteration:
+                return 0
+        size = min(len(target), len(self.buffer))
+        target[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+
+def _parse_samples(probe_file):
+    times, values = array.array("d"), array.array("d")
+    for line in probe_file:
+        match = SAMPLE_PATTERN.match(line)
+        if match is None:
+            continue
+        try:
+            time_value, value = float(match.group(1)), float(match.group(2))
+        except ValueError:
+            continue
+        times.append(time_value)
+        values.append(value)
+    times, values = numpy.frombuffer(times, dtype=numpy.float64), numpy.frombuffer(values, dtype=numpy.float64)
+    order = numpy.argsort(times, kind="stable")
+    return times[order], values[order].astype(numpy.float32)
+
+
+class LinkStatsCollector(object):
+    # Reads the OpenSAND probes of the running simulation out of the satellite container and cuts them into one
+    # ProbeWindow per measurement span (iperf transfer, browsertime, ...), so each benchmark result can be put next
+    # to the link's queueing, MODCOD and drops while it was measured. Probes are kept as float32 arrays.
+    def __init__(self, testbed, probe_pattern=DEFAULT_PROBE_PATTERN, run=RUN_NAME):
+        self.testbed = testbed
+        self.probe_pattern = re.compile(probe_pattern) if isinstance(probe_pattern, str) else probe_pattern
+        self.run = run
+        self.windows = []
+
+    def run_directory(self):
+        # the scenario that is actually running, run_attenuation_scenario and link schedules swap it out
+        scenario = self.testbed.read_testbed_state().get("opensand_scenario", self.testbed.opensand_scenario)
+        return ("/" + scenario if scenario else DEFAULT_SCENARIO_PATH) + "/" + self.run
+
+    def read_probes(self):
+        # {(host, probe): (wall clock times, values)} of every probe matching probe_pattern
+        container = get_container(os.getenv("SAT_CONTAINER_NAME"))
+        try:
+            chunks, _ = container.get_archive(self.run_directory())
+        except docker.errors.NotFound:
+            logger.warning("No OpenSAND probes in " + self.run_directory() + ", is the collector running?")
+            return {}
+        probes = {}
+        with tarfile.open(fileobj=io.BufferedReader(_ChunkStream(chunks), 1 << 16), mode="r|") as archive:
+            for member in archive:
+                # <run>/<host>/<probe>.log, anything else is skipped without being read
+                parts = member.name.split("/")
+                if not member.isfile() or len(parts) < 3 or not self.probe_pattern.search("/".join(parts[2:])):
+                    continue
+                times, values = _parse_samples(archive.extractfile(member))
+                if len(times):
+                    probes[(parts[1], "/".join(parts[2:]).rsplit(".", 1)[0])] = (times, values)
+        return self._wall_clock(probes)
+
+    def _wall_clock(self, probes):
+        if not probes:
+            return probes
+        last = max(times[-1] for times, _ in probes.values())
+        if last > 1e9:
+            # epoch stamps need no alignment
+            return probes if last < 1e12 else {key: (times / 1000.0, values) for key, (times, values) in probes.items()}
+        started = self.testbed.opensand.started_at
+        if started is None:
+            # a reused testbed was started by an earlier run, the collector writes as it goes so the newest sample
+            # is about now
+            started = time.time() - last / 1000.0
+        return {key: (started + times / 1000.0, values) for key, (times, values) in probes.items()}
+
+    def collect(self, since=None):
+        # one ProbeWindow per measurement span that started after since (a perf_counter time), in the order the
+        # measurements were taken, i.e. the order the benchmark appended its results in
+        spans = sorted([event for event in events() if event["cat"] == MEASUREMENT and (since is None or event["start"] >= since)],
+                       key=lambda event: event["start"])
+        if not spans:
+            return []
+        probes = self.read_probes()
+        windows = []
+        for event in spans:
+            start, end = wall_time(event["start"]), wall_time(event["end"])
+            window_probes = {}
+            for key, (times, values) in probes.items():
+                first, last = numpy.searchsorted(times, [start, end])
+                window_probes[key] = ((times[first:last] - start).astype(numpy.float32), values[first:last])
+            windows.append(ProbeWindow(event["name"], start, end, dict(event["args"]), window_probes))
+        logger.debug("Collected " + str(len(probes)) + " OpenSAND probes over " + str(len(windows)) + " measurements")
+        self.windows += windows
+        return windows
+
+    def save(self, path, windows=None):
+        # all windows in one compressed .npz, "index" describes them and names each window's arrays
+        windows = self.windows if windows is None else windows
+        arrays, index = {}, []
+        for number, window in enumerate(windows):
+            entry = {"name": window.name, "start": window.start, "end": window.end,
+                     "args": {key: str(value) for key, value in window.args.items()}, "probes": {}}
+            for probe_number, ((host, probe), (times, values)) in enumerate(sorted(window.probes.items())):
+                key = "w" + str(number) + "_p" + str(probe_number)
+                arrays[key + "_t"], arrays[key + "_v"] = times, values
+                entry["probes"][host + "/" + probe] = key
+            index.append(entry)
+        numpy.savez_compressed(path, index=numpy.array(json.dumps(index)), **arrays)
+        return path
+
+
+def window_summary(window):
+    # mean, max and sample count of every probe in a window
+    return {host + "/" + probe: {"mean": float(numpy.mean(values)) if len(values) else None,
+                                 "max": float(numpy.max(values)) if len(values) else None, "samples": len(values)}
+            for (host, probe), (_, values) in sorted(window.probes.items())}
@@ -0,0 +1,190 @@
+import os
+import threading
+from loguru import logger
+from docker_utils import get_container, exec_batch
+from orchestration import run_concurrently
+from dotenv import load_dotenv
+load_dotenv()
+
+# impairments are applied to what each side sends, on its opensand_tun
+DIRECTION_CONTAINERS = {"down": "GW_CONTAINER_NAME", "up": "ST_CONTAINER_NAME"}
+DEVICE = "opensand_tun"
+
+
+class NetemError(RuntimeError):
+    pass
+
+
+def _percent(value):
+    return str(value) + "%"
+
+
+class NetemProfile(object):
+    # Everything netem can do to one direction of the link. Loss is either uniform (loss, loss_correlation in percent)
+    # or a Gilbert-Elliott burst model given as gilbert_elliott=(p, r, 1-h, 1-k) in percent: p and r are the
+    # good->bad and bad->good transition probabilities, 1-h the loss probability in the bad state and 1-k the one in
+    # the good state. Delay and jitter are in ms, reorder, duplicate and corrupt in percent, rate a tc rate such as
+    # "10mbit". limit is the queue length in packets, left out it stays netem's default of 1000. Profiles compare equal
+    # when they would produce the same qdisc.
+    def __init__(self, loss=0, loss_correlation=None, gilbert_elliott=None, delay_ms=None, jitter_ms=None,
+                 delay_correlation=None, distribution=None, reorder=None, reorder_correlation=None, duplicate=None,
+                 corrupt=None, rate=None, limit=None):
+        if gilbert_elliott is not None and loss:
+            raise ValueError("A netem profile takes either uniform loss or a Gilbert-Elliott model, not both")
+        if reorder and not delay_ms:
+            # netem only reorders by sending some packets without the delay the others get
+            raise ValueError("Reordering needs a delay to reorder packets against")
+        if (jitter_ms or distribution) and not delay_ms:
+            raise ValueError("Jitter needs a delay to vary")
+        self.loss = loss
+        self.loss_correlation = loss_correlation
+        self.gilbert_elliott = tuple(gilbert_elliott) if gilbert_elliott is not None else None
+        self.delay_ms = delay_ms
+        self.jitter_ms = jitter_ms
+        self.delay_correlation = delay_correlation
+        self.distribution = distribution
+        self.reorder = reorder
+        self.reorder_correlation = reorder_correlation
+        self.duplicate = duplicate
+        self.corrupt = corrupt
+        self.rate = rate
+        self.limit = limit
+
+    @classmethod
+    def uniform_loss(cls, loss_percentage, **kwargs):
+        return cls(loss=loss_percentage, **kwargs)
+
+    @classmethod
+    def burst_loss(cls, loss_percentage, mean_burst_length, **kwargs):
+        # A simple Gilbert model with the given average loss and average burst length in packets: every packet in the
+        # bad state is lost and none in the good one, so r = 1 / burst length and p follows from the stationary loss
+        # p / (p + r).
+        if not 0 <= loss_percentage < 100 or mean_burst_length < 1:
+            raise ValueError("Burst loss needs a loss below 100% and bursts of at least one packet")
+        r = 100.0 / mean_burst_length
+        p = r * loss_percentage / (100.0 - loss_percentage)
+        return cls(gilbert_elliott=(round(p, 6), round(r, 6), 100, 0), **kwargs)
+
+    def replace(self, **changes):
+        settings = dict(vars(self))
+        if "gilbert_elliott" in changes and changes["gilbert_elliott"] is not None:
+            settings["loss"] = 0
+        elif changes.get("loss"):
+            settings["gilbert_elliott"] = None
+        settings.update(changes)
+        return NetemProfile(**settings)
+
+    def arguments(self):
+        # the qdisc description following "tc qdisc replace dev <device> root"
+        arguments = ["netem"]
+        if self.delay_ms:
+            arguments += ["delay", str(self.delay_ms) + "ms"]
+            if self.jitter_ms:
+                arguments.append(str(self.jitter_ms) + "ms")
+                if self.delay_correlation is not None:
+                    arguments.append(_percent(self.delay_correlation))
+            if self.distribution:
+                arguments += ["distribution", str(self.distribution)]
+        if self.gilbert_elliott is not None:
+            arguments += ["loss", "gemodel"] + [_percent(value) for value in self.gilbert_elliott]
+        elif self.loss:
+            arguments += ["loss", "random", _percent(self.loss)]
+            if self.loss_correlation is not None:
+                arguments.append(_percent(self.loss_correlation))
+        if self.reorder:
+            arguments += ["reorder", _percent(self.reorder)]
+            if self.reorder_correlation is not None:
+                arguments.append(_percent(self.reorder_correlation))
+        if self.duplicate:
+            arguments += ["duplicate", _percent(self.duplicate)]
+        if self.corrupt:
+            arguments += ["corrupt", _percent(self.corrupt)]
+        if self.rate is not None:
+            arguments += ["rate", str(self.rate)]
+        if self.limit is not None:
+            arguments += ["limit", str(self.limit)]
+        return " ".join(arguments)
+
+    def __eq__(self, other):
+        return isinstance(other, NetemProfile) and self.arguments() == other.arguments()
+
+    def __hash__(self):
+        return hash(self.arguments())
+
+    def __repr__(self):
+        return "NetemProfile(" + self.arguments() + ")"
+
+
+class NetemController(object):
+    # Applies NetemProfiles to the link directions of a testbed and remembers what each opensand_tun currently has, so
+    # setting a profile that is already there costs no exec at all. Directions are updated concurrently with one
+    # "tc qdisc replace" each. If one of them fails, the ones that succeeded are put back to what they had, so the
+    # link is never left half changed. The cache only knows what went through this controller: reset() after the
+    # qdiscs were removed, invalidate() when they may have changed behind its back (e.g. OpenSAND recreating its tun).
+    def __init__(self, directions=DIRECTION_CONTAINERS, device=DEVICE):
+        self.directions = dict(directions)
+        self.device = device
+        self._profiles = {}
+        self._lock = threading.Lock()
+
+    def container_name(self, direction):
+        return os.getenv(self.directions[direction])
+
+    def profile(self, direction):
+        # the profile on direction as far as the cache knows, None for no qdisc or an unknown one
+        with self._lock:
+            return self._profiles.get(direction)
+
+    def reset(self):
+        with self._lock:
+            self._profiles = {direction: None for direction in self.directions}
+
+    def invalidate(self):
+        with self._lock:
+            self._profiles = {}
+
+    def _command(self, profile):
+        if profile is None:
+            return "/sbin/tc qdisc del dev " + self.device + " root 2>/dev/null; true"
+        return "/sbin/tc qdisc replace dev " + self.device + " root " + profile.arguments()
+
+    def _set(self, direction, profile):
+        result = exec_batch(get_container(self.container_name(direction)), [self._command(profile)])[0]
+        if result.exit_code != 0:
+            raise NetemError("Setting " + str(profile) + " on " + direction + " failed: " + result.output.strip())
+        return profile
+
+    def apply(self, profiles):
+        # profiles maps directions to a NetemProfile, or None to remove the qdisc. Returns the directions changed.
+        with self._lock:
+            changes = {direction: profile for direction, profile in profiles.items()
+                       if direction not in self._profiles or self._profiles[direction] != profile}
+            previous = {direction: self._profiles.get(direction) for direction in changes}
+        if not changes:
+            return []
+        outcomes = run_concurrently({direction: (self._safe_set, (direction, profile)) for direction, profile in changes.items()},
+                                    name="Netem")
+        failed = {direction: outcome for direction, outcome in outcomes.items() if isinstance(outcome, Exception)}
+        if failed:
+            # roll the directions that changed back, an unknown previous state is safest without a qdisc
+            rollback = {direction: previous[direction] for direction in changes if direction not in failed}
+            run_concurrently({direction: (self._safe_set, (direction, profile)) for direction, profile in rollback.items()},
+                             name="Netem Rollback")
+            self.invalidate()
+            raise NetemError("Netem update failed, rolled back " + str(sorted(rollback)) + ": " +
+                             "; ".join(str(error) for error in failed.values()))
+        with self._lock:
+            self._profiles.update(changes)
+        for direction, profile in changes.items():
+            logger.debug("Netem " + direction + ": " + (profile.arguments() if profile is not None else "none"))
+        return sorted(changes)
+
+    def _safe_set(self, direction, profile):
+        # errors come back as values so one failed direction does not hide the outcome of the other
+        try:
+            return self._set(direction, profile)
+        except Exception as error:
+            return error
+
+    def apply_all(self, profile):
+        return self.apply({direction: profile for direction in self.directions})
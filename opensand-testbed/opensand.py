@@ -0,0 +1,171 @@
+import re
+import time
+import os
+from loguru import logger
+import nclib
+from dotenv import load_dotenv
+load_dotenv()
+
+# the component names OpenSAND reports for the default single terminal topology
+DEFAULT_HOSTS = ('SAT', 'GW0', 'ST1')
+HOST_PATTERN = re.compile(r'\b(SAT|GW\d+|ST\d+)\b')
+STATE_PATTERN = re.compile(r'\b(RUNNING|STOPPED|STARTING|STOPPING|ERROR|UNKNOWN|UNREACHABLE|NOT RUNNING)\b')
+
+
+class OpensandTimeout(TimeoutError):
+    pass
+
+
+class OpensandFailure(RuntimeError):
+    pass
+
+
+# Holds a single connection to the sand-manager command line interface exposed by the satellite container and turns
+# its status output into a per-component state map. All waits use capped exponential backoff and a hard deadline so a
+# stuck OpenSAND platform raises instead of pinning a core forever.
+class OpensandController(object):
+    def __init__(self, host='localhost', port=None, hosts=DEFAULT_HOSTS, command_timeout=10, min_backoff=0.1, max_backoff=2.0):
+        self.host = host
+        self.port = int(port if port is not None else os.getenv('SAT_PORT_NUMBER'))
+        self.hosts = tuple(hosts)
+        self.command_timeout = command_timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.nc = None
+        self.last_status = {}
+        # wall clock time the last simulation this controller started was launched, OpenSAND's probes count from it
+        self.started_at = None
+
+    def _backoff(self):
+        delay = self.min_backoff
+        while True:
+            yield delay
+            delay = min(delay * 2, self.max_backoff)
+
+    def _sleep_until(self, deadline, delay, waiting_for):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise OpensandTimeout("Timed out waiting for OpenSAND " + waiting_for + " (last status: " + str(self.last_status) + ")")
+        time.sleep(min(delay, remaining))
+
+    def connect(self, timeout=300, failure_check=None):
+        if self.nc is not None:
+            return self
+        deadline = time.monotonic() + timeout
+        for delay in self._backoff():
+            try:
+                nc = nclib.Netcat(connect=(self.host, self.port), verbose=False)
+                # the manager prints its banner and a list of commands once it is ready for input
+                banner = nc.recv_until(b'help', timeout=self.command_timeout)
+                if b'help' in banner:
+                    self._drain(nc)
+                    self.nc = nc
+                    logger.debug("Connected to OpenSAND Manager on port " + str(self.port))
+                    return self
+                nc.close()
+            except (nclib.errors.NetcatError, OSError):
+                pass
+            if failure_check is not None:
+                failure_check()
+            self._sleep_until(deadline, delay, "manager connection")
+
+    def close(self):
+        if self.nc is not None:
+            try:
+                self.nc.close()
+            except OSError:
+                pass
+        self.nc = None
+
+    def _drain(self, nc=None, quiet_period=0.2):
+        nc = nc if nc is not None else self.nc
+        output = b''
+        while True:
+            chunk = nc.recv(timeout=quiet_period)
+            if not chunk:
+                return output
+            output += chunk
+
+    def command(self, command, expect=None):
+        self.connect()
+        try:
+            self.nc.send(command.encode() + b'\n')
+            output = b''
+            if expect is not None:
+                output = self.nc.recv_until(expect.encode(), timeout=self.command_timeout)
+                if expect.encode() not in output:
+                    logger.warning("OpenSAND did not acknowledge '" + command + "'")
+            return (output + self._drain()).decode(errors='replace')
+        except (nclib.errors.NetcatError, OSError):
+            # the manager dropped us (e.g. satellite container restarted), reconnect on the next command
+            self.close()
+            raise
+
+    def status(self):
+        response = self.command('status')
+        states = {}
+        for line in response.splitlines():
+            host = HOST_PATTERN.search(line)
+            state = STATE_PATTERN.findall(line)
+            if host and state:
+                states[host.group(1)] = state[-1]
+        # older managers print the state on a separate line from the host name, fall back to counting states
+        if not states and response.count('RUNNING') > len(self.hosts):
+            states = {host: 'RUNNING' for host in self.hosts}
+        elif not states:
+            states = {host: 'UNKNOWN' for host in self.hosts if host in response}
+        self.last_status = states
+        return states
+
+    def wait_for_hosts(self, timeout=120, failure_check=None):
+        deadline = time.monotonic() + timeout
+        self.connect(timeout=timeout, failure_check=failure_check)
+        for delay in self._backoff():
+            try:
+                states = self.status()
+                if all(host in states for host in self.hosts):
+                    return states
+            except (nclib.errors.NetcatError, OSError):
+                self.connect(timeout=max(deadline - time.monotonic(), 0), failure_check=failure_check)
+            if failure_check is not None:
+                failure_check()
+            self._sleep_until(deadline, delay, "hosts " + str(self.hosts))
+
+    def wait_for_state(self, state='RUNNING', timeout=120, failure_check=None):
+        deadline = time.monotonic() + timeout
+        for delay in self._backoff():
+            try:
+                states = self.status()
+                if all(states.get(host) == state for host in self.hosts):
+                    return states
+            except (nclib.errors.NetcatError, OSError):
+                self.connect(timeout=max(deadline - time.monotonic(), 0), failure_check=failure_check)
+            if failure_check is not None:
+                failure_check()
+            self._sleep_until(deadline, delay, "state " + state)
+
+    def load_scenario(self, scenario_name):
+        logger.debug("Loading OpenSAND Scenario " + str(scenario_name))
+        return self.command('scenario ' + str(scenario_name), expect='OK')
+
+    def start(self, timeout=120, failure_check=None):
+        self.command('start', expect='OK')
+        self.started_at = time.time()
+        return self.wait_for_state('RUNNING', timeout=timeout, failure_check=failure_check)
+
+    def stop(self, timeout=60):
+        # opensand reports that the testbed has stopped a little before it actually has, so wait on the hosts too
+        deadline = time.monotonic() + timeout
+        stop_sent = False
+        for delay in self._backoff():
+            try:
+                # a manager that dropped us before acknowledging gets the stop again on the new connection
+                if not stop_sent:
+                    self.command('stop', expect='OK')
+                    stop_sent = True
+                states = self.status()
+                if not any(state == 'RUNNING' for state in states.values()):
+                    return states
+            except (nclib.errors.NetcatError, OSError):
+                self.connect(timeout=max(deadline - time.monotonic(), 0))
+            self._sleep_until(deadline, delay, "hosts to stop")
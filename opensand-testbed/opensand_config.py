@@ -0,0 +1,200 @@
+import copy
+import hashlib
+import io
+import json
+import os
+import re
+import xml.etree.ElementTree as ET
+from loguru import logger
+
+# the satellite container mounts its scenario directories from here, e.g. ./satellite/delay_scenario:/delay_scenario
+SCENARIO_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "satellite")
+# records the hash of every file materialize wrote, so unchanged files are neither read nor rewritten
+MANIFEST_FILE = ".scenario_hashes.json"
+TERMINAL_HOST_PATTERN = re.compile(r"^(gw\d+|st\d+)/")
+# tal_id OpenSAND reserves for multicast groups
+MULTICAST_TAL_ID = "31"
+
+_base_cache = {}
+
+
+def _hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+class ScenarioConfig(object):
+    # In-memory copy of an OpenSAND scenario directory: core_global.conf, topology.conf, each host's core.conf and
+    # plugin confs and the delay/attenuation CSVs. XML files are only parsed once something overrides them and only
+    # serialized again if they were, every other file is carried through as the bytes it was read as.
+    def __init__(self, name, files):
+        self.name = name
+        self.files = files
+        self.documents = {}
+
+    @classmethod
+    def load(cls, base, directory=SCENARIO_DIRECTORY):
+        base_path = os.path.join(directory, base)
+        if not os.path.isdir(base_path):
+            raise FileNotFoundError("No OpenSAND scenario at " + base_path)
+        # sweeps load the same base over and over, only re-read it when a file in it changed
+        signature = []
+        for root, _, names in os.walk(base_path):
+            for file_name in names:
+                if file_name == MANIFEST_FILE:
+                    continue
+                path = os.path.join(root, file_name)
+                stat = os.stat(path)
+                signature.append((os.path.relpath(path, base_path).replace(os.sep, "/"), stat.st_mtime_ns, stat.st_size))
+        signature.sort()
+        cached = _base_cache.get(base_path)
+        if cached is None or cached[0] != signature:
+            files = {}
+            for relative_path, _, _ in signature:
+                with open(os.path.join(base_path, relative_path), "rb") as scenario_file:
+                    files[relative_path] = scenario_file.read()
+            cached = (signature, files)
+            _base_cache[base_path] = cached
+        return cls(base, dict(cached[1]))
+
+    def copy(self, name):
+        scenario = ScenarioConfig(name, dict(self.files))
+        scenario.documents = {path: copy.deepcopy(document) for path, document in self.documents.items()}
+        return scenario
+
+    def xml(self, path):
+        # parsed with comments kept, OpenSAND's confs document most of their settings in them
+        if path not in self.documents:
+            if path not in self.files:
+                raise KeyError("Scenario " + self.name + " has no file " + path)
+            parser = ET.XMLParser(target=ET.TreeBuilder(insert_comments=True))
+            self.documents[path] = ET.ElementTree(ET.fromstring(self.files[path], parser=parser))
+        return self.documents[path]
+
+    def set_file(self, path, content):
+        if isinstance(content, str):
+            content = content.encode()
+        self.documents.pop(path, None)
+        self.files[path] = content
+
+    def set_attribute(self, path, element_path, attribute, value, match=None):
+        # sets attribute on every element at element_path whose attributes include match,
+        # e.g. set_attribute("st1/plugins/ideal.conf", "ideal/ideal_attenuations/ideal_attenuation",
+        #                    "attenuation_value", 3, match={"link": "down"})
+        elements = [element for element in self.xml(path).getroot().findall(element_path)
+                    if all(element.get(key) == expected for key, expected in (match or {}).items())]
+        if not elements:
+            raise KeyError("No " + element_path + " matching " + str(match) + " in " + self.name + "/" + path)
+        for element in elements:
+            element.set(attribute, str(value))
+
+    def set_text(self, path, element_path, value):
+        elements = self.xml(path).getroot().findall(element_path)
+        if not elements:
+            raise KeyError("No " + element_path + " in " + self.name + "/" + path)
+        for element in elements:
+            element.text = str(value)
+
+    def terminal_hosts(self):
+        # the gateways and satellite terminals this scenario configures, gw0 and st1 up to stN
+        return tuple(sorted({match.group(1) for match in map(TERMINAL_HOST_PATTERN.match, self.files) if match}))
+
+    def set_terminals(self, terminal_lans, gateway_lan=None):
+        # Configures one satellite terminal per entry of terminal_lans, the IPv4 subnets ("172.21.1.0/24") behind ST1,
+        # ST2 and so on. Terminals beyond st1 start as copies of st1, the topology routes each subnet to its terminal
+        # and puts every terminal on the spot and gateway st1 uses. gateway_lan replaces the subnet routed to gw0.
+        template = [path for path in self.files if path.startswith("st1/")]
+        for path in list(self.files):
+            host = TERMINAL_HOST_PATTERN.match(path)
+            if host and host.group(1).startswith("st") and int(host.group(1)[2:]) > len(terminal_lans):
+                del self.files[path]
+                self.documents.pop(path, None)
+        for tal_id in range(2, len(terminal_lans) + 1):
+            for path in template:
+                self.set_file("st" + str(tal_id) + path[3:], self._serialize(path))
+        root = self.xml("topology.conf").getroot()
+        ipv4 = root.find("sarp/ipv4")
+        replaced = {MULTICAST_TAL_ID} if gateway_lan is None else {MULTICAST_TAL_ID, "0"}
+        for entry in ipv4.findall("terminal_v4"):
+            if entry.get("tal_id") not in replaced:
+                ipv4.remove(entry)
+        lans = ([(gateway_lan, 0)] if gateway_lan is not None else []) + \
+               [(lan, tal_id) for tal_id, lan in enumerate(terminal_lans, start=1)]
+        for lan, tal_id in lans:
+            address, _, mask = lan.partition("/")
+            ET.SubElement(ipv4, "terminal_v4", {"addr": address, "mask": mask or "24", "tal_id": str(tal_id)})
+        for terminals in root.findall("spot_table/spot/terminals") + root.findall("gw_table/gw/terminals"):
+            known = {tal.get("id") for tal in terminals.findall("tal")}
+            for tal_id in range(1, len(terminal_lans) + 1):
+                if str(tal_id) not in known:
+                    ET.SubElement(terminals, "tal", {"id": str(tal_id)})
+
+    def set_attenuation(self, attenuation_value, link="down", hosts=None):
+        for host in hosts or self.terminal_hosts():
+            self.set_attribute(host + "/plugins/ideal.conf", "ideal/ideal_attenuations/ideal_attenuation",
+                               "attenuation_value", attenuation_value, match={"link": link})
+
+    def set_constant_delay(self, delay_ms, hosts=None):
+        # one-way delay each host adds, a GEO link is two hops of 125ms
+        for host in hosts or self.terminal_hosts():
+            self.set_text(host + "/core.conf", "delay/delay_type", "ConstantDelay")
+            self.set_text(host + "/plugins/constant_delay.conf", "delay_conf/delay", delay_ms)
+
+    def set_delay_file(self, rows, hosts=None, file_name="satdelay.csv"):
+        # rows of (seconds, delay in ms), OpenSAND steps to each delay at its time and loops over the file
+        content = "".join(str(time_s) + " " + str(delay_ms) + "\n" for time_s, delay_ms in rows)
+        for host in hosts or self.terminal_hosts():
+            self.set_file(host + "/plugins/" + file_name, content)
+            self.set_text(host + "/plugins/file_delay.conf", "delay_conf/path", "plugins/" + file_name)
+            self.set_text(host + "/core.conf", "delay/delay_type", "FileDelay")
+
+    def _serialize(self, path):
+        if path not in self.documents:
+            return self.files[path]
+        output = io.BytesIO()
+        self.documents[path].write(output, encoding="UTF-8", xml_declaration=True)
+        return output.getvalue() + b"\n"
+
+    def content_hash(self):
+        digest = hashlib.sha256()
+        for path in sorted(self.files):
+            digest.update(path.encode() + b"\0" + self._serialize(path) + b"\0")
+        return digest.hexdigest()
+
+    def materialize(self, directory=SCENARIO_DIRECTORY):
+        # Writes the scenario to directory/name, touching only files whose content changed since the last
+        # materialize and removing files the scenario no longer has. Returns the paths that changed, an empty list
+        # means OpenSAND's copy of the scenario is already current.
+        target = os.path.join(directory, self.name)
+        manifest_path = os.path.join(target, MANIFEST_FILE)
+        try:
+            with open(manifest_path, "r") as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            manifest = {}
+        changed = []
+        hashes = {}
+        for path in sorted(self.files):
+            content = self._serialize(path)
+            hashes[path] = _hash(content)
+            file_path = os.path.join(target, path)
+            if manifest.get(path) == hashes[path] and os.path.exists(file_path):
+                continue
+            if path not in manifest and os.path.exists(file_path):
+                # written by hand or by an older testbed, compare against what is actually there
+                with open(file_path, "rb") as existing_file:
+                    if _hash(existing_file.read()) == hashes[path]:
+                        continue
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, "wb") as scenario_file:
+                scenario_file.write(content)
+            changed.append(path)
+        for path in manifest:
+            if path not in self.files and os.path.exists(os.path.join(target, path)):
+                os.remove(os.path.join(target, path))
+                changed.append(path)
+        if changed or manifest != hashes:
+            os.makedirs(target, exist_ok=True)
+            with open(manifest_path, "w") as manifest_file:
+                json.dump(hashes, manifest_file, indent=1, sort_keys=True)
+        logger.debug("Materialized OpenSAND Scenario " + self.name + " (" + str(len(changed)) + " files changed)")
+        return changed
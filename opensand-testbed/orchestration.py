@@ -0,0 +1,61 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+from timing import span
+
+# docker-py is blocking, so every step runs on a worker thread and asyncio only handles the dependency graph
+MAX_WORKERS = 16
+
+
+class Orchestrator(object):
+    # Collects container operations as named steps. A step starts as soon as all the steps listed in its "after"
+    # have finished, so independent operations run concurrently and a deploy only takes as long as its critical path.
+    def __init__(self, name=""):
+        self.name = name
+        self.steps = {}
+
+    def add(self, step_name, function, *args, after=(), **kwargs):
+        for dependency in after:
+            if dependency not in self.steps:
+                raise ValueError("Step " + step_name + " depends on unknown step " + dependency)
+        self.steps[step_name] = (functools.partial(function, *args, **kwargs), tuple(after))
+        return step_name
+
+    def run(self):
+        # a private loop keeps this usable from code that already runs inside an event loop's thread pool
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self._run(loop))
+        finally:
+            loop.close()
+
+    async def _run(self, loop):
+        tasks = {}
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="orchestrator") as executor:
+            async def run_step(step_name, call, after):
+                if after:
+                    await asyncio.gather(*[tasks[dependency] for dependency in after])
+                logger.debug("Running " + (self.name + ": " if self.name else "") + step_name)
+                return await loop.run_in_executor(executor, _run_timed, (self.name + ": " if self.name else "") + step_name, call)
+
+            for step_name, (call, after) in self.steps.items():
+                tasks[step_name] = loop.create_task(run_step(step_name, call, after))
+            results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+        for step_name, result in zip(tasks.keys(), results):
+            if isinstance(result, BaseException):
+                raise result
+        return dict(zip(tasks.keys(), results))
+
+
+def run_concurrently(calls, name=""):
+    # shorthand for independent steps: calls is a dict of step name -> (function, args)
+    orchestrator = Orchestrator(name)
+    for step_name, (function, args) in calls.items():
+        orchestrator.add(step_name, function, *args)
+    return orchestrator.run()
+
+
+def _run_timed(span_name, call):
+    with span(span_name, "orchestration"):
+        return call()
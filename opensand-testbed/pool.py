@@ -0,0 +1,274 @@
+import ipaddress
+import multiprocessing
+import os
+import queue
+import shutil
+import socket
+import subprocess
+import sys
+import traceback
+from loguru import logger
+from docker_utils import get_docker_client, compose
+from images import ImageBuilder
+from dotenv import load_dotenv
+load_dotenv()
+
+TESTBED_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIRECTORY = os.path.dirname(TESTBED_DIRECTORY)
+POOL_DIRECTORY = os.path.join(REPOSITORY_DIRECTORY, ".testbed-pool")
+# roughly what one OpenSAND testbed plus its measurement tools needs to give results matching a single testbed
+CORES_PER_TESTBED = 6
+
+CONTAINER_VARIABLES = {
+    "SAT_CONTAINER_NAME": "satellite",
+    "GW_CONTAINER_NAME": "gateway",
+    "ST_CONTAINER_NAME": "terminal",
+    "WS_ST_CONTAINER_NAME": "ws-st",
+    "WS_GW_CONTAINER_NAME": "ws-gw",
+    "WS_OVPN_CONTAINER_NAME": "ws-ovpn",
+    "SITESPEED_CONTAINER_NAME": "sitespeed",
+}
+NETWORK_VARIABLES = {
+    "EMU_NETWORK_NAME": "emulation",
+    "GW_NETWORK_NAME": "gwlan",
+    "ST_NETWORK_NAME": "stlan",
+    "GUI_NETWORK_NAME": "gui",
+}
+# each testbed needs four /24 networks, the compose file builds them as <head>.0.0/24
+NETWORK_HEADS = ["EMU_NETWORK_HEAD", "ST_NETWORK_HEAD", "GW_NETWORK_HEAD", "GUI_NETWORK_HEAD"]
+# Workers are spawned, not forked: the parent already holds a Docker client whose event thread (and requests' pools)
+# may hold a lock at the moment of a fork, which would leave the worker's copy locked forever. Functions given to
+# run() must therefore be importable module level functions.
+WORKER_CONTEXT = multiprocessing.get_context("spawn")
+# how often the pool checks for workers that died without reporting their cell, e.g. killed by the OOM killer
+WORKER_POLL_S = 5
+
+
+class TestbedInstance(object):
+    def __init__(self, index, directory, env):
+        self.index = index
+        self.directory = directory
+        self.env = env
+
+    @property
+    def name(self):
+        return self.env["COMPOSE_PROJECT_NAME"]
+
+
+class TestbedPool(object):
+    def __init__(self, size=None, pool_directory=POOL_DIRECTORY, project_prefix="qpep", subnet_base="10.100.0.0",
+                 sat_base_port=6100, ovpn_base_port=7100, ip6_base=0x700, display_base=100):
+        self.size = size if size is not None else max(1, (os.cpu_count() or 1) // CORES_PER_TESTBED)
+        self.pool_directory = pool_directory
+        self.project_prefix = project_prefix
+        self.subnet_base = ipaddress.IPv4Address(subnet_base)
+        self.sat_base_port = sat_base_port
+        self.ovpn_base_port = ovpn_base_port
+        self.ip6_base = ip6_base
+        self.display_base = display_base
+        self.instances = []
+
+    def _used_subnets(self):
+        # networks created by an earlier run of this pool are ours to reuse, everything else must be avoided
+        used = []
+        for network in get_docker_client().networks.list():
+            if network.name.startswith(self.project_prefix):
+                continue
+            for config in (network.attrs.get("IPAM") or {}).get("Config") or []:
+                if "Subnet" in config:
+                    used.append(ipaddress.ip_network(config["Subnet"], strict=False))
+        return used
+
+    def _allocate_heads(self, count, used_subnets):
+        heads = []
+        candidate = self.subnet_base
+        while len(heads) < count:
+            subnet = ipaddress.IPv4Network(str(candidate) + "/24")
+            if not any(subnet.overlaps(used) for used in used_subnets):
+                heads.append(".".join(str(candidate).split(".")[:2]))
+            # heads only carry the first two octets, so step through the address space a /16 at a time
+            candidate = candidate + 2 ** 16
+        return heads
+
+    def _allocate_port(self, start, kind, taken):
+        port = start
+        while True:
+            if port not in taken:
+                with socket.socket(socket.AF_INET, kind) as probe:
+                    try:
+                        probe.bind(("0.0.0.0", port))
+                        taken.add(port)
+                        return port
+                    except OSError:
+                        pass
+            port += 1
+
+    def allocate(self):
+        used_subnets = self._used_subnets()
+        heads = self._allocate_heads(self.size * len(NETWORK_HEADS), used_subnets)
+        taken_ports = set()
+        self.instances = []
+        for index in range(self.size):
+            project = self.project_prefix + str(index)
+            env = {"COMPOSE_PROJECT_NAME": project}
+            for variable, base_name in {**CONTAINER_VARIABLES, **NETWORK_VARIABLES}.items():
+                env[variable] = project + "-" + base_name
+            for offset, variable in enumerate(NETWORK_HEADS):
+                env[variable] = heads[index * len(NETWORK_HEADS) + offset]
+            env["ST_IP6_HEAD"] = "2001:" + format(self.ip6_base + 2 * index, "x")
+            env["GW_IP6_HEAD"] = "2001:" + format(self.ip6_base + 2 * index + 1, "x")
+            env["SAT_PORT_NUMBER"] = str(self._allocate_port(self.sat_base_port + index, socket.SOCK_STREAM, taken_ports))
+            env["WS_OVPN_PORT"] = str(self._allocate_port(self.ovpn_base_port + index, socket.SOCK_DGRAM, taken_ports))
+            # each headless satellite has its own X socket directory, distinct displays only keep their logs apart
+            env["OPENSAND_DISPLAY"] = str(self.display_base + index)
+            directory = os.path.join(self.pool_directory, project)
+            self.instances.append(TestbedInstance(index, directory, env))
+        return self.instances
+
+    def prepare(self, refresh=False):
+        # every instance gets its own copy of the testbed directory since the configurator bakes the network heads
+        # into the container configs, ../src is linked so the QPEP sources stay shared
+        if not self.instances:
+            self.allocate()
+        os.makedirs(self.pool_directory, exist_ok=True)
+        source_link = os.path.join(self.pool_directory, "src")
+        if not os.path.exists(source_link):
+            os.symlink(os.path.join(REPOSITORY_DIRECTORY, "src"), source_link, target_is_directory=True)
+        for instance in self.instances:
+            if refresh and os.path.exists(instance.directory):
+                shutil.rmtree(instance.directory)
+            if not os.path.exists(instance.directory):
+                logger.debug("Creating Testbed Instance " + instance.name)
+                shutil.copytree(TESTBED_DIRECTORY, instance.directory, symlinks=True,
+                                ignore=shutil.ignore_patterns("__pycache__", ".testbed_state", ".trace_cache", ".topology", ".snapshots"))
+            self._write_env(instance)
+            subprocess.check_call([sys.executable, "configurator.py"], cwd=instance.directory,
+                                  env={**os.environ, **instance.env})
+        return self.instances
+
+    def _write_env(self, instance):
+        with open(os.path.join(TESTBED_DIRECTORY, ".env"), "r") as env_file:
+            lines = env_file.readlines()
+        remaining = dict(instance.env)
+        for line_number, line in enumerate(lines):
+            key = line.split("=", 1)[0].strip()
+            if "=" in line and not line.startswith("#") and key in remaining:
+                lines[line_number] = key + "=" + remaining.pop(key) + "\n"
+        lines += [key + "=" + value + "\n" for key, value in remaining.items()]
+        with open(os.path.join(instance.directory, ".env"), "w") as env_file:
+            env_file.writelines(lines)
+
+    def start_testbeds(self, testbed_class, **testbed_kwargs):
+        # brings every instance up concurrently, unlike run() each instance gets exactly one call
+        if not self.instances:
+            self.prepare()
+        self.build_images()
+        context = WORKER_CONTEXT
+        result_queue = context.Queue()
+        current_cells = [context.Value("i", -1) for _ in self.instances]
+        workers = [context.Process(target=_instance_worker, name=instance.name,
+                                   args=(instance, None, result_queue, current_cell, _start_testbed, (testbed_class,), testbed_kwargs))
+                   for instance, current_cell in zip(self.instances, current_cells)]
+        for worker in workers:
+            worker.start()
+        errors = [None] * len(workers)
+        for instance_index, _, error in _collect_results(workers, current_cells, result_queue, len(workers)):
+            errors[instance_index] = error
+        for worker in workers:
+            worker.join()
+        for instance, error in zip(self.instances, errors):
+            if error is not None:
+                logger.error("Testbed " + instance.name + " failed to start: " + error)
+        return errors
+
+    def build_images(self):
+        # the first instance builds, every other one finds the identical images by their hash and only tags them
+        for instance in self.instances:
+            ImageBuilder({**os.environ, **instance.env}, instance.directory).build()
+
+    def stop_testbeds(self):
+        for instance in self.instances:
+            compose(["down"], env={**os.environ, **instance.env}, cwd=instance.directory)
+
+    def run(self, function, cells, *args, **kwargs):
+        # Runs function once per cell, each cell's variables are layered over the instance's .env so the env driven
+        # sweeps in simulation_examples.py pick up their slice of the sweep. Every instance works through the shared
+        # cell queue one cell at a time, results come back in cell order as (cell, result, error) tuples.
+        if not self.instances:
+            self.prepare()
+        context = WORKER_CONTEXT
+        cell_queue = context.Queue()
+        result_queue = context.Queue()
+        for cell_index, cell in enumerate(cells):
+            cell_queue.put((cell_index, cell))
+        current_cells = [context.Value("i", -1) for _ in self.instances]
+        workers = [context.Process(target=_instance_worker, name=instance.name,
+                                   args=(instance, cell_queue, result_queue, current_cell, function, args, kwargs))
+                   for instance, current_cell in zip(self.instances, current_cells)]
+        for worker in workers:
+            worker.start()
+        results = [None] * len(cells)
+        for cell_index, result, error in _collect_results(workers, current_cells, result_queue, len(cells)):
+            results[cell_index] = (cells[cell_index], result, error)
+            if error is not None:
+                logger.error("Pool cell " + str(cells[cell_index]) + " failed: " + error)
+            else:
+                logger.debug("Pool cell " + str(cells[cell_index]) + " complete")
+        for worker in workers:
+            worker.join()
+        return results
+
+
+def _start_testbed(testbed_class, **testbed_kwargs):
+    testbed_class(**testbed_kwargs).start_testbed()
+
+
+def _collect_results(workers, current_cells, result_queue, count):
+    # Yields (cell index, result, error) for each of count cells as the workers report them. A worker that dies
+    # without reporting, e.g. killed by the OOM killer or a segfault, fails the cell it was running, and once no
+    # worker is left the cells nobody picked up fail as well, so a dead worker never hangs the pool.
+    pending = set(range(count))
+    while pending:
+        try:
+            cell_index, result, error = result_queue.get(timeout=WORKER_POLL_S)
+        except queue.Empty:
+            for worker, current_cell in zip(workers, current_cells):
+                if not worker.is_alive() and current_cell.value in pending:
+                    pending.discard(current_cell.value)
+                    yield current_cell.value, None, "worker " + worker.name + " died with exit code " + str(worker.exitcode)
+            if not any(worker.is_alive() for worker in workers):
+                for cell_index in sorted(pending):
+                    yield cell_index, None, "no pool worker left to run this cell"
+                return
+            continue
+        # a result that arrives after its worker was given up on has already been reported
+        if cell_index in pending:
+            pending.discard(cell_index)
+            yield cell_index, result, error
+
+
+def _instance_worker(instance, cell_queue, result_queue, current_cell, function, args, kwargs):
+    os.chdir(instance.directory)
+    os.environ.update(instance.env)
+    # every cell starts from the instance's environment, a variable one cell sets must not leak into the next
+    instance_environment = dict(os.environ)
+    while True:
+        if cell_queue is None:
+            # a single call on this instance
+            cell_index, cell, cell_queue = instance.index, {}, queue.Queue()
+        else:
+            try:
+                cell_index, cell = cell_queue.get(timeout=1)
+            except queue.Empty:
+                return
+        # tells the pool which cell to fail if this process dies
+        current_cell.value = cell_index
+        os.environ.update(cell)
+        try:
+            result_queue.put((cell_index, function(*args, **kwargs), None))
+        except Exception:
+            result_queue.put((cell_index, None, traceback.format_exc()))
+        finally:
+            os.environ.clear()
+            os.environ.update(instance_environment)
+            current_cell.value = -1
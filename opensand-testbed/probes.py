@@ -0,0 +1,109 @@
+import threading
+import time
+from collections import namedtuple
+from loguru import logger
+from timing import span
+
+# spans of this category are waits on the testbed becoming ready
+PROBE = "probe"
+
+# elapsed is how long the probe waited until it succeeded (or gave up), attempts how often it checked
+ProbeResult = namedtuple("ProbeResult", ["name", "target", "elapsed", "attempts", "succeeded"])
+
+_lock = threading.Lock()
+_results = []
+
+
+class ProbeTimeout(TimeoutError):
+    pass
+
+
+def probe(name, check, target="", timeout=60, interval=0.1, max_interval=1.0):
+    # Calls check until it returns something truthy and returns that, backing off from interval to max_interval
+    # between attempts. Raises ProbeTimeout at the deadline. Every probe is recorded with the time it actually took,
+    # so fixed waits that used to be guessed can be read off the results.
+    start = time.monotonic()
+    deadline = start + timeout
+    attempts = 0
+    delay = interval
+    with span(name, PROBE, target=str(target)):
+        while True:
+            attempts += 1
+            outcome = check()
+            if outcome:
+                _record(ProbeResult(name, str(target), time.monotonic() - start, attempts, True))
+                return outcome
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                _record(ProbeResult(name, str(target), time.monotonic() - start, attempts, False))
+                raise ProbeTimeout(name + " for " + str(target) + " not ready after " + str(timeout) + "s (" +
+                                   str(attempts) + " checks)")
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, max_interval)
+
+
+def timed_probe(name, wait, *args, target="", **kwargs):
+    # records a blocking wait that has its own deadline, e.g. OpensandController.wait_for_hosts, like a probe
+    start = time.monotonic()
+    with span(name, PROBE, target=str(target)):
+        try:
+            outcome = wait(*args, **kwargs)
+        except Exception:
+            _record(ProbeResult(name, str(target), time.monotonic() - start, 1, False))
+            raise
+    _record(ProbeResult(name, str(target), time.monotonic() - start, 1, True))
+    return outcome
+
+
+def _record(result):
+    with _lock:
+        _results.append(result)
+    logger.debug("Probe " + result.name + " " + result.target + (" ready after " if result.succeeded else " gave up after ") +
+                 str(round(result.elapsed, 3)) + "s")
+
+
+def results():
+    with _lock:
+        return list(_results)
+
+
+def summary():
+    # {probe name: count, total, mean and max seconds, failures}
+    probe_summary = {}
+    for result in results():
+        entry = probe_summary.setdefault(result.name, {"count": 0, "total": 0.0, "max": 0.0, "failures": 0})
+        entry["count"] += 1
+        entry["total"] += result.elapsed
+        entry["max"] = max(entry["max"], result.elapsed)
+        entry["failures"] += 0 if result.succeeded else 1
+    for entry in probe_summary.values():
+        entry["mean"] = entry["total"] / entry["count"]
+    return probe_summary
+
+
+def wait_for_port(container, port, protocol="tcp", timeout=120):
+    # until something listens on port in container
+    flag = "-uln" if protocol == "udp" else "-tln"
+
+    def listening():
+        _, output = container.exec_run("ss " + flag)
+        local_addresses = [line.split()[3] for line in output.decode(errors="replace").splitlines()[1:] if len(line.split()) > 3]
+        return any(address.endswith(":" + str(port)) for address in local_addresses)
+
+    return probe(protocol + " port listening", listening, container.name + ":" + str(port), timeout)
+
+
+def wait_for_process_exit(container, process_name, timeout=10):
+    # until no process called process_name is left in container, e.g. after a pkill
+    return probe("process exit", lambda: container.exec_run("pgrep -x " + process_name)[0] != 0,
+                 container.name + ":" + process_name, timeout, interval=0.02, max_interval=0.2)
+
+
+def wait_for_tunnel(container, interface, peer, timeout=60):
+    # until interface is up in container and peer answers a ping through it
+    def tunnel_up():
+        if container.exec_run("sh -c 'ip -o link show dev " + interface + " up | grep -q " + interface + "'")[0] != 0:
+            return False
+        return container.exec_run("ping -c 1 -W 1 " + str(peer))[0] == 0
+
+    return probe("tunnel up", tunnel_up, container.name + ":" + interface + "->" + str(peer), timeout, interval=0.25)
@@ -0,0 +1,55 @@
+import hashlib
+import os
+from loguru import logger
+from docker_utils import exec_batch
+from timing import span
+
+TESTBED_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# mounted at /root/go/src in the containers that run QPEP
+QPEP_SOURCE_DIRECTORY = os.path.join(TESTBED_DIRECTORY, "..", "src", "qpep")
+QPEP_MAIN = "/root/go/src/qpep/main.go"
+# the qpep-bin volume every QPEP container mounts, one directory per source hash
+BINARY_DIRECTORY = "/qpep-bin"
+# "main" like the binary go run builds, so "pkill -9 main" still stops QPEP
+BINARY_NAME = "main"
+
+
+class QPEPBuildError(RuntimeError):
+    pass
+
+
+def source_hash(directory=QPEP_SOURCE_DIRECTORY):
+    # everything under src/qpep, a changed file or a new package means a new binary
+    digest = hashlib.sha256()
+    for root, directories, names in os.walk(directory):
+        directories.sort()
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, directory).replace(os.sep, "/").encode() + b"\0")
+            with open(path, "rb") as source_file:
+                digest.update(source_file.read())
+    return digest.hexdigest()
+
+
+def binary_path(hash_value):
+    return BINARY_DIRECTORY + "/" + hash_value[:16] + "/" + BINARY_NAME
+
+
+def build_qpep(container):
+    # Returns the path of the QPEP binary for the current sources in the qpep-bin volume, building it in container
+    # first if no earlier deploy did. CGO_ENABLED=0 links it statically, so it runs in every container that mounts
+    # the volume whatever their libc.
+    path = binary_path(source_hash())
+    if exec_batch(container, ["test -x " + path])[0].exit_code == 0:
+        logger.debug("Using cached QPEP binary " + path)
+        return path
+    logger.debug("Building QPEP binary " + path)
+    with span("build qpep", "build"):
+        # built next to its final name and moved into place, a build that dies halfway never looks cached
+        result = exec_batch(container, [
+            "mkdir -p " + os.path.dirname(path) + " && CGO_ENABLED=0 go build -o " + path + ".partial " + QPEP_MAIN +
+            " && mv " + path + ".partial " + path,
+        ])[0]
+    if result.exit_code != 0:
+        raise QPEPBuildError("Building QPEP in " + container.name + " failed:\n" + result.output[-2000:])
+    return path
@@ -0,0 +1,75 @@
+import shlex
+from loguru import logger
+from docker_utils import get_container
+from orchestration import run_concurrently
+from dotenv import load_dotenv
+load_dotenv()
+
+# QPEP's -controlPort on both sides, it only listens on the container's loopback
+CONTROL_PORT = 4243
+# what the control endpoint can change, named like the flags that set them at startup
+CONTROL_SETTINGS = ["acks", "decimate", "ackDelay", "varAckDelay", "minBeforeDecimation", "congestion"]
+# the flags' defaults in shared/quic_optimizations.go
+DEFAULT_SETTINGS = {"acks": 10, "decimate": 4, "ackDelay": 25, "varAckDelay": 0.25, "minBeforeDecimation": 100, "congestion": 4}
+
+
+class QPEPControlError(RuntimeError):
+    pass
+
+
+def settings_arguments(settings):
+    # the same settings as QPEP command line flags
+    return " ".join("-" + name + " " + str(value) for name, value in settings.items())
+
+
+def control_command(container, line, port=CONTROL_PORT, timeout=5):
+    # one line to QPEP's control endpoint in container and its one line answer, through bash's /dev/tcp so the
+    # workstation images need no client
+    script = ("exec 3<>/dev/tcp/127.0.0.1/" + str(port) + " && printf '%s\\n' " + shlex.quote(line) +
+              " >&3 && timeout " + str(timeout) + " head -n 1 <&3")
+    exit_code, output = container.exec_run(["bash", "-c", script])
+    response = output.decode(errors="replace").strip()
+    if exit_code != 0 or not response.startswith("ok "):
+        raise QPEPControlError("QPEP control in " + container.name + " answered '" + line + "' with " +
+                               (response or "exit code " + str(exit_code)))
+    return dict(setting.split("=", 1) for setting in response[3:].split())
+
+
+def get_settings(container, port=CONTROL_PORT):
+    if isinstance(container, str):
+        container = get_container(container)
+    return control_command(container, "get", port)
+
+
+def set_settings(container, settings, port=CONTROL_PORT):
+    # Changes the settings QPEP in container opens new sessions with, settings maps CONTROL_SETTINGS names to values.
+    # Either all of them apply or none. A client also stops reusing its session, so the next connection gets the
+    # new settings. Returns what QPEP runs with now.
+    if isinstance(container, str):
+        container = get_container(container)
+    unknown = [name for name in settings if name not in CONTROL_SETTINGS]
+    if unknown:
+        raise ValueError("QPEP cannot change " + str(unknown) + " at runtime")
+    current = control_command(container, "set " + " ".join(name + "=" + str(value) for name, value in settings.items()), port)
+    logger.debug("QPEP in " + container.name + " now runs with " + str(current))
+    return current
+
+
+def update_qpep(container_settings, port=CONTROL_PORT):
+    # {container name: settings} for every QPEP to change, updated concurrently. Raises QPEPControlError if any of
+    # them could not be reached or refused its settings.
+    if not container_settings:
+        return {}
+    outcomes = run_concurrently({name: (_safe_set, (name, settings, port)) for name, settings in container_settings.items()},
+                                name="QPEP Control")
+    failed = {name: outcome for name, outcome in outcomes.items() if isinstance(outcome, Exception)}
+    if failed:
+        raise QPEPControlError("; ".join(str(error) for error in failed.values()))
+    return outcomes
+
+
+def _safe_set(name, settings, port):
+    try:
+        return set_settings(name, settings, port)
+    except Exception as error:
+        return error
@@ -4,4 +4,36 @@ service avahi-daemon start
 opensand_interfaces
 sand-collector -b
 sand-daemon
-xvfb-run sand-manager -i
\ No newline at end of file
+if [ "$OPENSAND_HEADLESS" = "1" ]; then
+    # run the manager on a private virtual framebuffer instead of relying on xvfb-run's fixed display
+    DISPLAY_NUMBER=${OPENSAND_DISPLAY:-99}
+    # /tmp/.X11-unix is the host's (the GUI mode needs it), so Xvfb gets a socket directory of this container's own
+    # over it: a socket there could belong to a live host X server or another testbed's Xvfb
+    if ! mount -t tmpfs -o mode=1777 tmpfs /tmp/.X11-unix; then
+        echo "OpenSAND headless: Xvfb failed to start, no private X socket directory"
+        exit 1
+    fi
+    # a restarted container keeps the lock of its previous Xvfb, which would make the new one refuse to start
+    LOCK_FILE=/tmp/.X${DISPLAY_NUMBER}-lock
+    if [ -f $LOCK_FILE ] && ! kill -0 $(tr -d ' ' < $LOCK_FILE) 2>/dev/null; then
+        rm -f $LOCK_FILE
+    fi
+    Xvfb :${DISPLAY_NUMBER} -screen 0 1280x1024x24 -nolisten tcp > /var/log/xvfb.log 2>&1 &
+    XVFB_PID=$!
+    for attempt in $(seq 1 100); do
+        [ -S /tmp/.X11-unix/X${DISPLAY_NUMBER} ] && break
+        if ! kill -0 $XVFB_PID 2>/dev/null; then
+            echo "OpenSAND headless: Xvfb failed to start on :${DISPLAY_NUMBER}"
+            cat /var/log/xvfb.log
+            exit 1
+        fi
+        sleep 0.1
+    done
+    if [ ! -S /tmp/.X11-unix/X${DISPLAY_NUMBER} ]; then
+        echo "OpenSAND headless: Xvfb did not come up on :${DISPLAY_NUMBER}"
+        exit 1
+    fi
+    export DISPLAY=:${DISPLAY_NUMBER}
+    exec sand-manager -i
+fi
+xvfb-run sand-manager -i
@@ -1,27 +1,57 @@
 from abc import ABC, abstractmethod
 from loguru import logger
-import docker
+from docker_utils import get_container, exec_batch, container_states
+from link_stats import window_summary
+from orchestration import Orchestrator
+from probes import wait_for_port, wait_for_tunnel
+from qpep_build import build_qpep
+from qpep_control import CONTROL_PORT, DEFAULT_SETTINGS, QPEPControlError, settings_arguments, update_qpep
+from timing import span, timed
 import time
 import os
 from dotenv import load_dotenv
 load_dotenv()
 
 class Scenario(ABC):
+    # a LinkStatsCollector, when set each benchmark keeps the OpenSAND probes of every measurement in link_stats
+    link_stats = None
+    # a Watchdog, when set it guards the benchmarks' transfers and retries failed ones after a repair
+    watchdog = None
+
     def __init__(self, name, testbed, benchmarks):
         self.name = name
         self.testbed = testbed
         self.benchmarks = benchmarks
 
     @abstractmethod
+    @timed("deploy")
     def deploy_scenario(self):
         self.testbed.start_testbed()
         self.testbed.connect_terminal_workstation()
 
+    def terminal_containers(self):
+        # every satellite terminal of the testbed, a MultiTerminalTestbed has more than one
+        return [terminal for terminal, _, _ in self.testbed.terminals()]
+
     def run_benchmarks(self, deployed=False):
         for benchmark in self.benchmarks:
             if not deployed:
                 self.deploy_scenario()
-            benchmark.run()
+            started = time.perf_counter()
+            benchmark.watchdog = self.watchdog
+            # a container or QPEP dying mid-benchmark is logged as it happens and kept with the results, rather than
+            # only showing up as zero throughput
+            with span("benchmark " + benchmark.name + " (" + self.name + ")", "benchmark"), \
+                    container_states().monitor(self.testbed.testbed_containers()) as failures:
+                benchmark.run()
+            benchmark.container_failures += failures
+            if self.link_stats is not None:
+                with span("collect link stats"):
+                    benchmark.link_stats += self.link_stats.collect(since=started)
+
+    def restart_pep(self):
+        # restarts whatever this scenario runs between terminal and gateway on a testbed that stays up
+        self.deploy_scenario(testbed_up=True)
 
     def print_results(self):
         print("*"*25)
@@ -30,22 +60,67 @@ class Scenario(ABC):
         for benchmark in self.benchmarks:
             print("****", benchmark.name, "****")
             benchmark.print_results()
+            for window in benchmark.link_stats:
+                print("Link stats", window.name, window.args, window_summary(window))
+            for failure in benchmark.container_failures:
+                print("Container failure", failure.container, failure.reason)
 
 class PlainScenario(Scenario):
+    @timed("deploy")
     def deploy_scenario(self, testbed_up=False):
         if not testbed_up:
             super().deploy_scenario()
 
+# client.ovpn's tun device and the server's end of openvpn.conf's 192.168.255.0/24
+OPENVPN_INTERFACE = "tun0"
+OPENVPN_SERVER_ADDRESS = "192.168.255.1"
+
 class OpenVPNScenario(Scenario):
+    @timed("deploy")
     def deploy_scenario(self, testbed_up=False):
         if not testbed_up:
             super().deploy_scenario()
-        docker_client = docker.from_env()
-        terminal_workstation = docker_client.containers.get(os.getenv("WS_ST_CONTAINER_NAME"))
-        # Satellite latency means that it takes OpenVPN a long time to establish the connection, waiting is easiest
+        terminal_workstation = get_container(os.getenv("WS_ST_CONTAINER_NAME"))
+        # Satellite latency means that it takes OpenVPN a long time to establish the connection, it is up once the
+        # server answers through the tunnel
         logger.debug("Launching OVPN and waiting...")
         terminal_workstation.exec_run("openvpn --config /root/client.ovpn --daemon")
-        time.sleep(20)
+        wait_for_tunnel(terminal_workstation, OPENVPN_INTERFACE, OPENVPN_SERVER_ADDRESS)
+
+    def restart_pep(self):
+        get_container(os.getenv("WS_ST_CONTAINER_NAME")).exec_run("pkill -9 openvpn")
+        super().restart_pep()
+
+@timed("deploy")
+def deploy_qpep(setup_commands, client_args="", gateway_args="", terminals=None, snapshots=None):
+    # the gateway has to be listening before the clients can open their QUIC sessions, everything else is independent.
+    # terminals are the container names to run a client on, by default the testbed's one terminal. With the testbed's
+    # snapshots given, setup_commands restore a captured configuration where they can. QPEP itself is built once per
+    # source hash (see qpep_build.py) and every side runs that binary, ready once its listener is up. Both sides
+    # accept setting changes on their control port (see qpep_control.py), so sweeps need not deploy again.
+    terminals = terminals if terminals is not None else [os.getenv("ST_CONTAINER_NAME")]
+    gateway_workstation = get_container(os.getenv("WS_GW_CONTAINER_NAME"))
+    binary = build_qpep(gateway_workstation)
+    # QPEP runs as a detached exec, so only its exec_die event tells that it exited
+    container_states().watch_process(gateway_workstation.name, binary, "QPEP gateway")
+    for terminal in terminals:
+        container_states().watch_process(terminal, binary, "QPEP client")
+    configure = exec_batch if snapshots is None else lambda container, commands: snapshots.configure(container, commands, "qpep")
+    orchestrator = Orchestrator("QPEP")
+    orchestrator.add("configure gateway", configure, gateway_workstation, setup_commands)
+    orchestrator.add("launch gateway", gateway_workstation.exec_run, binary + " -controlPort " + str(CONTROL_PORT) + " " + gateway_args,
+                     detach=True, after=["configure gateway"])
+    orchestrator.add("gateway listening", wait_for_port, gateway_workstation, 4242, "udp", after=["launch gateway"])
+    for terminal in terminals:
+        terminal_container = get_container(terminal)
+        client = "client" if len(terminals) == 1 else "client " + terminal
+        orchestrator.add("configure " + client, configure, terminal_container, setup_commands)
+        orchestrator.add("launch " + client, terminal_container.exec_run, binary + " -client -controlPort " + str(CONTROL_PORT) + " -gateway " +
+                         str(os.getenv("GW_NETWORK_HEAD")) + ".0.9 " + client_args,
+                         detach=True, after=["configure " + client, "gateway listening"])
+        orchestrator.add(client + " listening", wait_for_port, terminal_container, 8080, "tcp", after=["launch " + client])
+    orchestrator.run()
+    logger.success("QPEP Running")
 
 class QPEPScenario(Scenario):
 
@@ -53,82 +128,82 @@ class QPEPScenario(Scenario):
         self.multi_stream = multi_stream
         super().__init__(name, testbed, benchmarks)
 
+    @timed("deploy")
     def deploy_scenario(self, testbed_up=False):
         if not testbed_up:
             super().deploy_scenario()
-        docker_client = docker.from_env()
-
-        logger.debug("Configuring Client Side of QPEP Proxy")
-        terminal_container = docker_client.containers.get(os.getenv("ST_CONTAINER_NAME"))
-        terminal_container.exec_run("bash /opensand_config/configure_qpep.sh")
-
-        logger.debug("Configuring Gateway Side of QPEP Proxy")
-        gateway_workstation = docker_client.containers.get(os.getenv("WS_GW_CONTAINER_NAME"))
-        gateway_workstation.exec_run("bash /opensand_config/configure_qpep.sh")
 
+        setup_commands = ["bash /opensand_config/configure_qpep.sh"]
         if testbed_up:
             # kill running QPEP services for fresh start
-            gateway_workstation.exec_run("pkill -9 main")
-            terminal_container.exec_run("pkill -9 main")
-
-        logger.debug("Launching QPEP Client")
-        terminal_container.exec_run("go run /root/go/src/qpep/main.go -client -gateway " + str(os.getenv("GW_NETWORK_HEAD")) + ".0.9 ", detach=True)
-        logger.debug("Launching QPEP Gateway")
-        gateway_workstation.exec_run("go run /root/go/src/qpep/main.go", detach=True)
-        logger.success("QPEP Running")
+            setup_commands.append("pkill -9 main")
+        logger.debug("Configuring QPEP Proxy and Launching QPEP Client and Gateway")
+        deploy_qpep(setup_commands, terminals=self.terminal_containers(), snapshots=self.testbed.snapshots)
+
+def retune_qpep(gateway_settings, client_settings, terminals):
+    # Changes the settings of the QPEP already running on the gateway workstation and terminals instead of
+    # deploying it again. False when that is not possible, e.g. nothing answers on the control port.
+    container_settings = {os.getenv("WS_GW_CONTAINER_NAME"): gateway_settings}
+    container_settings.update({terminal: client_settings for terminal in terminals})
+    try:
+        with span("qpep retune"):
+            update_qpep(container_settings)
+    except QPEPControlError as error:
+        logger.warning("Could not retune QPEP, deploying it again: " + str(error))
+        return False
+    logger.success("QPEP Retuned")
+    return True
 
 class QPEPAckScenario(Scenario):
+    # ack timing both sides run with, ack bundling is the client's acks on top of it
+    ack_settings = dict(DEFAULT_SETTINGS, minBeforeDecimation=2, ackDelay=8000, varAckDelay=16.0)
+
+    @timed("deploy")
     def deploy_scenario(self, testbed_up=False, ack_level=4):
+        # With the testbed up the running QPEP is retuned to ack_level, it is only deployed again if that fails
+        gateway_settings = self.ack_settings
+        client_settings = dict(self.ack_settings, acks=ack_level)
         if not testbed_up:
             super().deploy_scenario()
+        elif retune_qpep(gateway_settings, client_settings, self.terminal_containers()):
+            return
 
-        docker_client = docker.from_env()
-        terminal_container = docker_client.containers.get(os.getenv("ST_CONTAINER_NAME"))
-        gateway_workstation = docker_client.containers.get(os.getenv("WS_GW_CONTAINER_NAME"))
         if testbed_up:
             logger.debug("Killing any prior QPEP")
-            terminal_container.exec_run("pkill -9 main")
-            gateway_workstation.exec_run("pkill -9 main")
-            time.sleep(1)
+            setup_commands = ["pkill -9 main"]
         else:
-            logger.debug("Configuring Client Side of QPEP Proxy")
-            terminal_container.exec_run("bash /opensand_config/configure_qpep.sh")
+            logger.debug("Configuring Client and Gateway Sides of QPEP Proxy")
+            setup_commands = ["bash /opensand_config/configure_qpep.sh"]
 
-            logger.debug("Configuring Gateway Side of QPEP Proxy")
-            gateway_workstation.exec_run("bash /opensand_config/configure_qpep.sh")
-
-        logger.debug("Launching QPEP Client")
-        terminal_container.exec_run("go run /root/go/src/qpep/main.go -client -minBeforeDecimation 2 -ackDelay 8000 -varAckDelay 16.0 -gateway " + str(os.getenv("GW_NETWORK_HEAD")) + ".0.9 -acks " + str(ack_level), detach=True)
-        logger.debug("Launching QPEP Gateway")
-        gateway_workstation.exec_run("go run /root/go/src/qpep/main.go -minBeforeDecimation 2 -ackDelay 8000 -varAckDelay 16.0", detach=True)
-        logger.success("QPEP Running")
+        logger.debug("Launching QPEP Client and Gateway")
+        deploy_qpep(setup_commands,
+                    client_args=settings_arguments(client_settings),
+                    gateway_args=settings_arguments(gateway_settings),
+                    terminals=self.terminal_containers(), snapshots=self.testbed.snapshots)
 
 
 class QPEPCongestionScenario(Scenario):
+    @timed("deploy")
     def deploy_scenario(self, testbed_up=False, congestion_window=10):
+        # With the testbed up the running QPEP is retuned to congestion_window, it is only deployed again if that fails
+        settings = dict(DEFAULT_SETTINGS, congestion=congestion_window)
         if not testbed_up:
             super().deploy_scenario()
+        elif retune_qpep(settings, settings, self.terminal_containers()):
+            return
 
-        docker_client = docker.from_env()
-        terminal_container = docker_client.containers.get(os.getenv("ST_CONTAINER_NAME"))
-        gateway_workstation = docker_client.containers.get(os.getenv("WS_GW_CONTAINER_NAME"))
         if testbed_up:
             logger.debug("Killing any prior QPEP")
-            terminal_container.exec_run("pkill -9 main")
-            gateway_workstation.exec_run("pkill -9 main")
-            time.sleep(1)
+            setup_commands = ["pkill -9 main"]
         else:
-            logger.debug("Configuring Client Side of QPEP Proxy")
-            terminal_container.exec_run("bash /opensand_config/configure_qpep.sh")
-
-            logger.debug("Configuring Gateway Side of QPEP Proxy")
-            gateway_workstation.exec_run("bash /opensand_config/configure_qpep.sh")
+            logger.debug("Configuring Client and Gateway Sides of QPEP Proxy")
+            setup_commands = ["bash /opensand_config/configure_qpep.sh"]
 
-        logger.debug("Launching QPEP Client")
-        terminal_container.exec_run("go run /root/go/src/qpep/main.go -client -gateway " + str(os.getenv("GW_NETWORK_HEAD")) +".0.9 -congestion " + str(congestion_window), detach=True)
-        logger.debug("Launching QPEP Gateway")
-        gateway_workstation.exec_run("go run /root/go/src/qpep/main.go -congestion " + str(congestion_window), detach=True)
-        logger.success("QPEP Running")
+        logger.debug("Launching QPEP Client and Gateway")
+        deploy_qpep(setup_commands,
+                    client_args=settings_arguments(settings),
+                    gateway_args=settings_arguments(settings),
+                    terminals=self.terminal_containers(), snapshots=self.testbed.snapshots)
 
 
 class PEPsalScenario(Scenario):
@@ -137,20 +212,33 @@ class PEPsalScenario(Scenario):
         self.gateway = gateway
         super().__init__(name=name, testbed=testbed, benchmarks=benchmarks)
 
+    @timed("deploy")
     def deploy_scenario(self, testbed_up=False):
         if not testbed_up:
             super().deploy_scenario()
         logger.debug("Starting PEPsal Scenario")
-        docker_client = docker.from_env()
 
         if self.terminal and self.gateway:
             logger.debug("Deploying PEPsal in Distributed Mode")
 
+        # the two PEPsal instances do not depend on each other
+        orchestrator = Orchestrator("PEPsal")
         if self.terminal:
             logger.debug("Deploying PEPsal on Terminal Endpoint")
-            terminal_client = docker_client.containers.get(os.getenv("ST_CONTAINER_NAME"))
-            terminal_client.exec_run("bash /opensand_config/launch_pepsal.sh")
+            for terminal in self.terminal_containers():
+                orchestrator.add(terminal, self.testbed.snapshots.configure, terminal, ["bash /opensand_config/launch_pepsal.sh"], "pepsal")
         if self.gateway:
             logger.debug("Deploying PEPsal on Gateway Endpoint")
-            gateway_client = docker_client.containers.get(os.getenv("GW_CONTAINER_NAME"))
-            gateway_client.exec_run("bash /opensand_config/launch_pepsal.sh")
+            orchestrator.add("gateway", self.testbed.snapshots.configure, os.getenv("GW_CONTAINER_NAME"),
+                             ["bash /opensand_config/launch_pepsal.sh"], "pepsal")
+        orchestrator.run()
+
+    def restart_pep(self):
+        # a second pepsal would find its port taken, so stop the old ones and their TPROXY rules first
+        containers = (self.terminal_containers() if self.terminal else []) + ([os.getenv("GW_CONTAINER_NAME")] if self.gateway else [])
+        orchestrator = Orchestrator("PEPsal Stop")
+        for container_name in containers:
+            orchestrator.add(container_name, exec_batch, get_container(container_name),
+                             ["pkill -9 pepsal", "/sbin/iptables -t mangle -F PREROUTING"])
+        orchestrator.run()
+        super().restart_pep()
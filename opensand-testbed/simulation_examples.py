@@ -4,9 +4,13 @@ import time
 from statistics import mean
 import json
 from loguru import logger
-from testbeds import BasicTestbed, LeoTestbed
+from testbeds import BasicTestbed, LeoTestbed, MultiTerminalTestbed
 from scenarios import QPEPScenario, OpenVPNScenario, PEPsalScenario, PlainScenario, QPEPAckScenario, QPEPCongestionScenario
-from benchmarks import IperfBenchmark, SitespeedBenchmark
+from benchmarks import IperfBenchmark, MultiTerminalIperfBenchmark, SitespeedBenchmark
+from pool import TestbedPool
+from link_schedule import LinkSchedule, LinkScheduleRunner
+from watchdog import Watchdog
+import timing
 import numpy
 import os
 from dotenv import load_dotenv
@@ -22,8 +26,11 @@ def ack_bundling_iperf_scenario():
     ack_bundling_numbers = [ack for ack in range(1, 31, 1)]
     scenario = QPEPAckScenario(name='QPEP Ack Bundling Test', testbed=testbed, benchmarks=[])
     decimation_results = {}
+    # QPEP is deployed once, every further ack level only retunes it through its control port
+    testbed_up = False
     for ack_bundling_number in ack_bundling_numbers[int(os.getenv("ACK_BUNDLING_MIN")):int(os.getenv("ACK_BUNDLING_MAX"))]:
-        scenario.deploy_scenario(ack_level=ack_bundling_number)
+        scenario.deploy_scenario(testbed_up=testbed_up, ack_level=ack_bundling_number)
+        testbed_up = True
         if str(ack_bundling_number) not in decimation_results.keys():
             decimation_results[str(ack_bundling_number)] = {}
         for plr_level in plr_levels:
@@ -165,10 +172,10 @@ def plr_test_scenario():
     vpn_scenario  = OpenVPNScenario(name="OpenVPN", testbed=testbed, benchmarks=copy.deepcopy(benchmarks))
     distributed_pepsal_scenario = PEPsalScenario(name="Distributed PEPsal", gateway=True, terminal=True, testbed=testbed,benchmarks=copy.deepcopy(benchmarks))
     scenarios = [qpep_scenario, plain_scenario, vpn_scenario, pepsal_scenario, distributed_pepsal_scenario]
+    iperf_scenario_results = {}
     for scenario in scenarios:
         if scenario.name == os.getenv("SCENARIO_NAME"):
             logger.debug("Running packet loss rate scenario " + str(scenario.name))
-            iperf_scenario_results = {}
             for plr_level in plr_levels[int(os.getenv("PLR_MIN_INDEX")):int(os.getenv("PLR_MAX_INDEX"))]:
                 plr_string = numpy.format_float_positional(plr_level, precision=7, trim='-')
                 iperf_scenario_results[str(plr_string)] = []
@@ -176,14 +183,18 @@ def plr_test_scenario():
                     logger.debug("Running PLR for " + str(scenario.name) +  " at " + str(plr_string) + " batch " + str(j) + " of " + str(os.getenv("PLR_META_ITERATIONS")))
                     scenario.deploy_scenario()
                     scenario.testbed.set_plr_percentage(plr_string, st_out=False, gw_out=True)
+                    # stalled transfers are stopped early and only that transfer is repeated after repairing the link
+                    scenario.watchdog = Watchdog(scenario)
                     for i in range(0, int(os.getenv("IPERF_ITERATIONS"))):
                         scenario.benchmarks = copy.deepcopy(benchmarks)
                         scenario.run_benchmarks(deployed=True)
                         for benchmark in scenario.benchmarks:
                             iperf_scenario_results[str(plr_string)].append(benchmark.results)
-                            # if the link breaks, we need to restart the ip routes
+                            # a cell still failing after the watchdog's retries, or moving nothing, means the link is
+                            # broken, start over from a fresh deployment
                             for key in benchmark.results.keys():
-                                if(benchmark.results[key]["sent_bps"]) == 0:
+                                if (any(reason is not None for reason in benchmark.results[key]["failure_reason"]) or
+                                        any(sent_bps == 0 for sent_bps in benchmark.results[key]["sent_bps"])):
                                     scenario.deploy_scenario()
                                     scenario.testbed.set_plr_percentage(plr_string, st_out=False, gw_out=True)
                                     logger.warning("Failed Iperf Run @ " + str(plr_string))
@@ -194,6 +205,56 @@ def plr_test_scenario():
             print(iperf_scenario_results)
             print("\n******************************")
     logger.success("PLR Test Complete")
+    return iperf_scenario_results
+
+def parallel_plr_test_scenario(pool_size=None, scenario_names=("QPEP", "Plain", "OpenVPN", "PEPSal", "Distributed PEPsal")):
+    # Fans the PLR x scenario sweep out across a pool of isolated testbeds, one PLR level per cell
+    pool = TestbedPool(size=pool_size)
+    pool.prepare()
+    cells = [{"SCENARIO_NAME": scenario_name, "PLR_MIN_INDEX": str(plr_index), "PLR_MAX_INDEX": str(plr_index + 1)}
+             for scenario_name in scenario_names for plr_index in range(28)]
+    parallel_results = {}
+    for cell, result, error in pool.run(plr_test_scenario, cells):
+        if error is None:
+            parallel_results.setdefault(cell["SCENARIO_NAME"], {}).update(result)
+    pool.stop_testbeds()
+    print("Final Parallel PLR Results")
+    print("*********************************")
+    print(parallel_results)
+    print("\n******************************")
+    return parallel_results
+
+def link_schedule_iperf_scenario():
+    # Replays a LEO pass against a long QPEP transfer: the delay shrinks towards zenith, the downlink gets lossy as the
+    # satellite sets and the pass ends in a short outage. The applied event log lines up with iperf's throughput dips.
+    testbed = LeoTestbed(host_ip=HOST_IP)
+    schedule = LinkSchedule().delay(0, 45).delay(60, 30).delay(180, 45).loss(200, 1, direction="down").outage(240, 5)
+    scenario = QPEPScenario(name="QPEP", testbed=testbed, benchmarks=[IperfBenchmark(file_sizes=[50*1000000])])
+    runner = LinkScheduleRunner(testbed, schedule)
+    scenario.deploy_scenario()
+    runner.prepare()
+    scenario.deploy_scenario(testbed_up=True)
+    with runner:
+        scenario.run_benchmarks(deployed=True)
+    runner.write_log("link_schedule_log.csv")
+    scenario.print_results()
+    return runner.log
+
+
+def gateway_scaling_iperf_scenario(terminal_counts=(1, 2, 4, 8)):
+    # Measures how one QPEP gateway scales with the number of terminals transferring at the same time, every terminal
+    # runs its own QPEP client and iperf transfer. Returns the aggregate and per terminal results per terminal count.
+    scaling_results = {}
+    for terminals in terminal_counts:
+        testbed = MultiTerminalTestbed(terminals=terminals, host_ip=HOST_IP)
+        benchmark = MultiTerminalIperfBenchmark(file_sizes=[10*1000000], workstations=[workstation for _, workstation, _ in testbed.terminals()],
+                                                iterations=int(os.getenv("IPERF_ITERATIONS")))
+        scenario = QPEPScenario(name="QPEP (" + str(terminals) + " terminals)", testbed=testbed, benchmarks=[benchmark])
+        scenario.run_benchmarks()
+        scenario.print_results()
+        scaling_results[terminals] = benchmark.results
+    print("Gateway Scaling Results: ", scaling_results)
+    return scaling_results
 
 
 HOST_IP = "192.168.0.15" # Set this to the IP address of an X Server (Display #0)
@@ -220,5 +281,19 @@ if __name__ == '__main__':
     #leo_testbed = LeoTestbed(host_ip=HOST_IP)
     #plt_test_scenario(leo_testbed)
 
+    # Or replay a time-varying link during a single transfer
+    #link_schedule_iperf_scenario()
+
+    # Or measure how the gateway copes with several terminals at once
+    #gateway_scaling_iperf_scenario()
+
+    # Or split the PLR sweep across several isolated testbeds on this host
+    #parallel_plr_test_scenario()
+
     #Next look at ACK decimation
     ack_bundling_iperf_scenario()
+
+    # Where the run's time went, the trace opens in chrome://tracing or ui.perfetto.dev
+    timing.log_summary()
+    if os.getenv("TIMING_TRACE"):
+        timing.export_chrome_trace(os.getenv("TIMING_TRACE"))
@@ -0,0 +1,185 @@
+import glob
+import hashlib
+import json
+import os
+import re
+from loguru import logger
+from docker_utils import get_container, exec_batch
+from dotenv import load_dotenv
+load_dotenv()
+
+TESTBED_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+SNAPSHOT_DIRECTORY = os.path.join(TESTBED_DIRECTORY, ".snapshots")
+# a script run from a container's /opensand_config mount, the host copies live in <service>/config
+SCRIPT_PATTERN = re.compile(r"^\s*(?:bash|sh)\s+/opensand_config/(\S+\.sh)\s*$")
+# commands whose whole effect is network state the snapshot holds
+NETWORK_COMMAND_PATTERN = re.compile(r"^\s*(?:/sbin/|/usr/sbin/)?(?:ip|iptables|ip6tables|sysctl)\s")
+# everything the scripted configuration of a container changes, as one exec
+CAPTURE_COMMANDS = [
+    "sysctl -n net.ipv4.ip_forward",
+    "iptables-save",
+    "ip -4 rule show",
+    "ip -4 route show table all",
+]
+# routes the kernel derives from the interfaces, they come back by themselves
+KERNEL_ROUTE_PATTERN = re.compile(r"\btable local\b|\bproto kernel\b|^broadcast |^local .* table local")
+RULE_PATTERN = re.compile(r"^(\d+):\s+(.*)$")
+# priorities of the local, main and default lookups every network namespace starts with
+DEFAULT_RULE_PREFERENCES = ["0", "32766", "32767"]
+TABLE_PATTERN = re.compile(r"\btable (\S+)")
+# Docker's embedded DNS: its NAT rules point at ports that change every time the container starts, so they are never
+# part of a snapshot and the live ones are carried over into every restore
+DOCKER_DNS_CHAINS = "DOCKER_(OUTPUT|POSTROUTING)"
+DOCKER_DNS_PATTERN = re.compile(r"\b" + DOCKER_DNS_CHAINS + r"\b")
+
+
+class SnapshotError(RuntimeError):
+    pass
+
+
+def _without_docker_dns(iptables):
+    # also cleans snapshots taken before the DNS rules were left out
+    return "".join(line for line in iptables.splitlines(True) if not DOCKER_DNS_PATTERN.search(line))
+
+
+class NetworkSnapshots(object):
+    # Network state of containers after a scenario's scripted configuration (configure_qpep.sh, launch_pepsal.sh),
+    # captured once and restored on every later deploy with the same key. The key covers the commands, the scripts
+    # they run and the testbed's compose config and image hash, so editing any of them falls back to the scripted
+    # path, which captures a new snapshot. Only iptables, ip rules, routes and forwarding are kept: what a script
+    # starts (e.g. pepsal) is started again by running the script without its network lines. Restoring assumes the
+    # container is in the state reset_testbed leaves it in, like the scripts do.
+    def __init__(self, testbed, directory=SNAPSHOT_DIRECTORY):
+        self.testbed = testbed
+        self.directory = directory
+        self._snapshots = {}
+
+    def _script_hash(self, script):
+        # every service's copy of the script, terminal and gateway each have a launch_pepsal.sh of their own
+        digest = hashlib.sha256()
+        for path in sorted(glob.glob(os.path.join(TESTBED_DIRECTORY, "*", "config", script))):
+            with open(path, "rb") as script_file:
+                digest.update(os.path.relpath(path, TESTBED_DIRECTORY).encode() + b"\0" + script_file.read())
+        return digest.hexdigest()
+
+    def key(self, container_name, commands, name):
+        config_hash = self.testbed.read_testbed_state().get("config_hash")
+        if config_hash is None:
+            return None
+        scripts = [match.group(1) for match in map(SCRIPT_PATTERN.match, commands) if match is not None]
+        return hashlib.sha256(json.dumps([name, container_name, list(commands), config_hash,
+                                          [self._script_hash(script) for script in scripts]]).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def load(self, key):
+        if key not in self._snapshots:
+            try:
+                with open(self._path(key), "r") as snapshot_file:
+                    self._snapshots[key] = json.load(snapshot_file)
+            except (OSError, ValueError):
+                return None
+        return self._snapshots[key]
+
+    def capture(self, container):
+        return self._parse_capture(container, exec_batch(container, CAPTURE_COMMANDS))
+
+    def _parse_capture(self, container, results):
+        if any(result.exit_code != 0 for result in results):
+            logger.warning("Could not capture the network state of " + container.name + ": " +
+                           str([result.output for result in results if result.exit_code != 0]))
+            return None
+        forwarding, iptables, rules, routes = (result.output for result in results)
+        return {
+            "ip_forward": forwarding.strip(),
+            "iptables": _without_docker_dns(iptables),
+            "rules": [line.strip() for line in rules.splitlines() if line.strip()],
+            "routes": [line.strip() for line in routes.splitlines() if line.strip() and not KERNEL_ROUTE_PATTERN.search(line)],
+        }
+
+    def save(self, key, snapshot):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path(key), "w") as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+        self._snapshots[key] = snapshot
+
+    def restore_commands(self, snapshot):
+        commands = ["sysctl -w net.ipv4.ip_forward=" + snapshot["ip_forward"]]
+        # iptables-restore replaces every table the save lists, rules appended by an earlier run cannot pile up. The
+        # container's current DNS rules go into the nat table it replaces.
+        commands.append("dns_rules=$(iptables-save -t nat | grep -wE '" + DOCKER_DNS_CHAINS + "'); "
+                        "awk -v dns=\"$dns_rules\" '/^\\*/ { table = $0 } table == \"*nat\" && $0 == \"COMMIT\" && dns != \"\" "
+                        "{ print dns } { print }' <<'SNAPSHOT' | iptables-restore\n" +
+                        _without_docker_dns(snapshot["iptables"]).rstrip("\n") + "\nSNAPSHOT")
+        # only the rules a script can have added are replaced, the local, main and default lookups stay in place
+        commands.append("ip -4 rule show | sed -nE 's/^([0-9]+):.*/\\1/p' | grep -vxE '" + "|".join(DEFAULT_RULE_PREFERENCES) +
+                        "' | while read pref; do ip -4 rule del pref $pref; done")
+        for rule in snapshot["rules"]:
+            match = RULE_PATTERN.match(rule)
+            if match is not None and match.group(1) not in DEFAULT_RULE_PREFERENCES:
+                commands.append("ip -4 rule add pref " + match.group(1) + " " + match.group(2))
+        tables = sorted({match.group(1) for match in map(TABLE_PATTERN.search, snapshot["routes"])
+                         if match is not None and match.group(1) not in ("main", "local")})
+        commands += ["ip -4 route flush table " + table for table in tables]
+        commands += ["ip -4 route replace " + route for route in snapshot["routes"]]
+        return commands
+
+    def _process_commands(self, commands):
+        # what is left to run once the network state is restored: scripts without their network lines, and any
+        # command that is not network configuration at all
+        remaining = []
+        for command in commands:
+            match = SCRIPT_PATTERN.match(command)
+            if match is not None:
+                remaining.append("sed -E '/^\\s*(\\/sbin\\/|\\/usr\\/sbin\\/)?(ip|iptables|ip6tables|sysctl)\\s/d' "
+                                 "/opensand_config/" + match.group(1) + " | bash")
+            elif not NETWORK_COMMAND_PATTERN.match(command):
+                remaining.append(command)
+        return remaining
+
+    def rollback_commands(self, baseline, snapshot):
+        # back from a partly restored snapshot to baseline: baseline's state, minus the routes only snapshot had
+        commands = self.restore_commands(baseline)
+        commands += ["ip -4 route del " + route + " 2>/dev/null; true" for route in snapshot["routes"]
+                     if route not in baseline["routes"]]
+        return commands
+
+    def configure(self, container, commands, name):
+        # runs a scenario's configuration commands on container, restoring the snapshot instead where there is one.
+        # Returns exec_batch's results of the commands that ran.
+        if isinstance(container, str):
+            container = get_container(container)
+        key = self.key(container.name, commands, name)
+        snapshot = self.load(key) if key is not None else None
+        if snapshot is not None:
+            # the state before the restore is captured in the same exec, a failed restore is rolled back to it
+            results = exec_batch(container, CAPTURE_COMMANDS + self.restore_commands(snapshot))
+            failed = [result for result in results[len(CAPTURE_COMMANDS):] if result.exit_code != 0]
+            if not failed:
+                logger.debug("Restored " + name + " network snapshot on " + container.name)
+                # the processes only start once the restore is known to be complete, a failed one runs the scripts
+                process_commands = self._process_commands(commands)
+                return exec_batch(container, process_commands) if process_commands else []
+            logger.warning("Restoring " + name + " snapshot on " + container.name + " failed, running the scripts: " +
+                           str([(result.command.split("\n")[0], result.output) for result in failed]))
+            self._snapshots.pop(key, None)
+            os.remove(self._path(key))
+            baseline = self._parse_capture(container, results[:len(CAPTURE_COMMANDS)])
+            if baseline is None:
+                raise SnapshotError("Cannot roll " + container.name + " back from a failed " + name + " snapshot, " +
+                                    "its network state before the restore is unknown")
+            rollback = [result for result in exec_batch(container, self.rollback_commands(baseline, snapshot))
+                        if result.exit_code != 0]
+            if rollback:
+                raise SnapshotError("Rolling " + container.name + " back from a failed " + name + " snapshot failed: " +
+                                    str([(result.command.split("\n")[0], result.output) for result in rollback]))
+        results = exec_batch(container, commands)
+        # a pkill that found nothing to stop does not make the configuration any less complete
+        configured = all(result.exit_code == 0 for result in results
+                         if SCRIPT_PATTERN.match(result.command) or NETWORK_COMMAND_PATTERN.match(result.command))
+        if key is not None and configured:
+            snapshot = self.capture(container)
+            if snapshot is not None:
+                self.save(key, snapshot)
+        return results
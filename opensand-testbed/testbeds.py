@@ -1,215 +1,532 @@
 import subprocess
 import os
+import re
+from datetime import datetime, timezone
 from loguru import logger
-import nclib
 import docker
-import time
-import xml.etree.ElementTree as ET
+from docker_utils import get_docker_client, get_container, invalidate_container, exec_batch, container_states, compose
+import hashlib
+import json
+import yaml
+from opensand import OpensandController, OpensandFailure
+from opensand_config import ScenarioConfig, SCENARIO_DIRECTORY
+from cpusets import CpuAllocator
+from fakes import dry_run, fake_opensand_port
+from images import ImageBuilder
+from netem import NetemController, NetemProfile
+from snapshots import NetworkSnapshots
+from orchestration import run_concurrently
+from probes import timed_probe
+from timing import span, timed
+from topology import TerminalTopology
 from dotenv import load_dotenv
 load_dotenv()
 
+# records the compose config hash and loaded OpenSAND scenario of the testbed that is currently up
+TESTBED_STATE_FILE = ".testbed_state"
+COMPOSE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "docker-compose.yml")
+# a scenario directory the satellite container mounts, e.g. ./satellite/delay_scenario:/delay_scenario
+SCENARIO_MOUNT_PATTERN = re.compile(r"^\./satellite/(\w+_scenario):")
+TESTBED_CONTAINERS = ["SAT_CONTAINER_NAME", "GW_CONTAINER_NAME", "ST_CONTAINER_NAME", "WS_ST_CONTAINER_NAME",
+                      "WS_GW_CONTAINER_NAME", "WS_OVPN_CONTAINER_NAME", "SITESPEED_CONTAINER_NAME"]
+# what the satellite logs when the manager cannot reach its X server, it would otherwise just never report its hosts
+GUI_FAILURE_PATTERN = re.compile(r"cannot open display|Can't open display|Xvfb failed|Xvfb did not come up")
+# undoes everything the scenarios, benchmarks and set_plr_percentage leave behind in a running testbed, the terminal
+# and workstation commands run on every terminal with TERMINAL_LAN_HEAD set to that terminal's LAN
+RESET_COMMANDS = {
+    "ST_CONTAINER_NAME": [
+        "pkill -9 main; pkill -9 pepsal",
+        "/sbin/iptables -t mangle -F PREROUTING",
+        "while /sbin/ip rule del fwmark 1 lookup 100 2>/dev/null; do :; done",
+        "/sbin/ip route flush table 100",
+        "/sbin/tc qdisc del dev opensand_tun root 2>/dev/null",
+    ],
+    "GW_CONTAINER_NAME": [
+        "pkill -9 pepsal",
+        "/sbin/iptables -t mangle -F PREROUTING",
+        "while /sbin/iptables -t nat -D POSTROUTING -s {ST_NETWORK_HEAD}.0.0/24 -o eth0 -j MASQUERADE --random 2>/dev/null; do :; done",
+        "while /sbin/ip rule del fwmark 1 lookup 100 2>/dev/null; do :; done",
+        "/sbin/ip route flush table 100",
+        "/sbin/tc qdisc del dev opensand_tun root 2>/dev/null",
+    ],
+    "WS_ST_CONTAINER_NAME": [
+        "pkill -9 openvpn; pkill -9 iperf3",
+        "ip route del default; ip route add default via {TERMINAL_LAN_HEAD}.4",
+    ],
+    "WS_GW_CONTAINER_NAME": [
+        "pkill -9 main; pkill -9 iperf3",
+    ],
+}
+
+class EmulationError(RuntimeError):
+    pass
+
+
 class BasicTestbed(object):
-    def __init__(self, host_ip="192.168.1.199", display_number=0, linux=False):
+    # name of a scenario directory mounted into the satellite container, None keeps the manager's default scenario
+    opensand_scenario = None
+    # compose services started by start_testbed, None starts all of them
+    compose_services = None
+
+    def __init__(self, host_ip="192.168.1.199", display_number=0, linux=False, pin_cpus=None, headless=None):
         self.host_ip = host_ip
         self.display_number = display_number
         self.linux = linux
+        # runs OpenSAND on the satellite's own framebuffer, defaults to the OPENSAND_HEADLESS setting in .env
+        self.headless = headless if headless is not None else os.getenv("OPENSAND_HEADLESS", "0") == "1"
+        self.opensand = OpensandController(port=fake_opensand_port() if dry_run() else None)
+        # dedicated cores for the OpenSAND containers, defaults to the PIN_CPUS setting in .env
+        self.pin_cpus = pin_cpus if pin_cpus is not None else os.getenv("PIN_CPUS", "0") == "1"
+        self.cpu_allocator = CpuAllocator()
+        self.downlink_attenuation = 0
+        # configured network state of the scenarios, restored instead of re-running their scripts
+        self.snapshots = NetworkSnapshots(self)
+        self.netem = NetemController()
 
-    def start_testbed(self):
-        # First, shut down any old running testbeds
-        logger.debug("Shutting Down Previous Testbeds")
-        subprocess.call(["docker-compose", "down"], stderr=subprocess.DEVNULL)
-
+    def compose_env(self):
+        if self.headless:
+            # nothing in the testbed may depend on an X server outside the containers
+            return {**os.environ, 'OPENSAND_HEADLESS': '1', 'DISPLAY': ''}
         # The DISPLAY env variable points to an X server for showing OpenSAND UI
-        my_env = {**os.environ, 'DISPLAY': str(self.host_ip) + ":" + str(self.display_number)}
-        logger.debug("Starting Testbed Containers")
+        return {**os.environ, 'OPENSAND_HEADLESS': '0', 'DISPLAY': str(self.host_ip) + ":" + str(self.display_number)}
+
+    def compose_config_hash(self):
+        # docker-compose resolves .env and the environment into the effective config, so any change that would make
+        # compose recreate a container also changes this hash
+        config = compose(["config"], env=self.compose_env(), capture=True, stderr=subprocess.DEVNULL)
+        return hashlib.sha256(config).hexdigest()
 
-        # Start the docker containers
-        subprocess.call(["docker-compose", "up", "-d"], env=my_env)
+    def read_testbed_state(self):
+        try:
+            with open(TESTBED_STATE_FILE, "r") as state_file:
+                return json.load(state_file)
+        except (OSError, ValueError):
+            return {}
 
+    def write_testbed_state(self, **state):
+        with open(TESTBED_STATE_FILE, "w") as state_file:
+            json.dump(state, state_file)
+
+    def terminals(self):
+        # (terminal container, workstation container, LAN head) of every satellite terminal, terminal 1 first
+        return [(os.getenv("ST_CONTAINER_NAME"), os.getenv("WS_ST_CONTAINER_NAME"), str(os.getenv("ST_NETWORK_HEAD")) + ".0")]
+
+    def testbed_containers(self):
+        names = [os.getenv(container_variable) for container_variable in TESTBED_CONTAINERS]
+        return names + [name for terminal in self.terminals()[1:] for name in terminal[:2]]
+
+    def containers_running(self):
+        # the state table follows the Docker events, so only containers it has not seen yet are inspected
+        return all(container_states().state(container_name).status == "running" for container_name in self.testbed_containers())
+
+    @timed()
+    def start_testbed(self, reuse=True):
+        with span("docker-compose config"):
+            config_hash = self.compose_config_hash()
+        # build changed images up front, docker-compose up would otherwise keep running the stale ones
+        with span("build images"):
+            image_hashes = ImageBuilder(self.compose_env()).build(self.compose_services)
+        config_hash = hashlib.sha256((config_hash + json.dumps(image_hashes, sort_keys=True)).encode()).hexdigest()
+        state = self.read_testbed_state()
+        testbed_type = type(self).__name__
+        if (reuse and state.get("config_hash") == config_hash and state.get("testbed") == testbed_type and
+                self.containers_running()):
+            logger.debug("Reusing Running Testbed")
+            if self.pin_cpus:
+                # returns the cores this testbed already holds, or pins it if pinning was switched on since
+                self.cpu_allocator.pin_containers()
+            self.reset_testbed(opensand_scenario=state.get("opensand_scenario"))
+        else:
+            # First, shut down any old running testbeds
+            logger.debug("Shutting Down Previous Testbeds")
+            with span("docker-compose down"):
+                # orphans are the extra terminals of a previous testbed with more of them
+                compose(["down", "--remove-orphans"], env=self.compose_env(),
+                                stderr=subprocess.DEVNULL)
+            logger.debug("Starting Testbed Containers")
+
+            # Claim cores before starting anything so an oversubscribed host fails fast
+            if self.pin_cpus:
+                self.cpu_allocator.allocate()
+
+            # Start the docker containers
+            self.create_scenario_directories()
+            with span("docker-compose up"):
+                compose(["up", "-d"] + list(self.compose_services or []), env=self.compose_env())
+            self.start_emulator()
+            self.netem.reset()
+            # the netem satellite only exists once the emulator started, so every container is checked after it
+            container_states().wait_for_all(self.testbed_containers(), "running")
+            if self.pin_cpus:
+                self.cpu_allocator.pin_containers()
+        self.write_testbed_state(config_hash=config_hash, testbed=testbed_type, opensand_scenario=self.opensand_scenario)
+        self.connect_terminal_modem()
+        logger.success("OpeSAND Testbed Running")
+
+    def create_scenario_directories(self):
+        # the scenarios the testbed writes are not in the checkout, docker-compose up would create their mounts owned
+        # by root and materialize could no longer write into them
+        with open(COMPOSE_FILE, "r") as compose_file:
+            volumes = yaml.safe_load(compose_file)["services"]["satellite"].get("volumes", [])
+        for volume in volumes:
+            match = SCENARIO_MOUNT_PATTERN.match(volume)
+            if match is not None:
+                os.makedirs(os.path.join(SCENARIO_DIRECTORY, match.group(1)), exist_ok=True)
+
+    def start_emulator(self):
+        # brings up the satellite link between terminal and gateway once the containers are running
+        self.start_opensand()
+
+    @timed()
+    def start_opensand(self):
         # Wait for the opensand container to initialize then send a command to run the simulation
         logger.debug("Starting Opensand Platform")
-        opensand_launched = False
-        while not opensand_launched:
-            try:
-                nc = nclib.Netcat(('localhost', int(os.getenv('SAT_PORT_NUMBER'))), verbose=False)
-                nc.recv_until(b'help')
-                nc.recv()
-                nc.send(b'status\n')
-                response = nc.recv()
-                opensand_launched = ('SAT' in str(response)) and ('GW0' in str(response)) and ('ST1' in str(response))
-            except nclib.errors.NetcatError:
-                continue
-
-        time.sleep(1) # it often takes a little while for Opensand to identify all hosts
+        self.opensand.close()
+        with span("opensand manager connect"):
+            self.opensand.connect(failure_check=self.check_opensand_failure)
+        timed_probe("opensand hosts", self.opensand.wait_for_hosts, target=",".join(self.opensand.hosts),
+                    failure_check=self.check_opensand_failure)
+        if self.opensand_scenario is not None:
+            self.opensand.load_scenario(self.opensand_scenario)
         logger.debug("Launching Opensand Simulation")
-        nc.send(b'start\n')
-        simulation_running = False
-        while not simulation_running:
-            nc.send(b'status\n')
-            response = str(nc.recv())
-            # wait for all three components (satellite, terminal and gateway) to start running
-            simulation_running = response.count('RUNNING') > 3
+        # wait for all three components (satellite, terminal and gateway) to start running
+        with span("opensand simulation start"):
+            self.opensand.start(failure_check=self.check_opensand_failure)
+
+    def check_opensand_failure(self):
+        # called between status polls so a dead satellite or a missing display fails the start instead of timing out
+        satellite_container = get_container(os.getenv("SAT_CONTAINER_NAME"))
+        satellite_container.reload()
+        # only this run of the container, a restarted satellite still has the logs of its earlier runs
+        started = datetime.strptime(satellite_container.attrs["State"]["StartedAt"][:19], "%Y-%m-%dT%H:%M:%S")
+        logs = satellite_container.logs(tail=50, since=started.replace(tzinfo=timezone.utc)).decode(errors="replace")
+        if satellite_container.status != "running":
+            raise OpensandFailure("Satellite container " + satellite_container.status + ":\n" + logs)
+        gui_failure = GUI_FAILURE_PATTERN.search(logs)
+        if gui_failure:
+            raise OpensandFailure("OpenSAND manager has no display (" + gui_failure.group(0) + "), " +
+                                  ("check the Xvfb output in the satellite log" if self.headless else
+                                   "check the X server at " + str(self.host_ip) + ":" + str(self.display_number) +
+                                   " or set OPENSAND_HEADLESS=1"))
 
+    @timed()
+    def connect_terminal_modem(self):
         # now that the network is running, it is possible to add ip routes from user terminal through the network
-        logger.debug("Connecting User Terminal to Satellite Spot Beam")
-        docker_client = docker.from_env()
-        terminal_container = docker_client.containers.get(os.getenv("ST_CONTAINER_NAME"))
-        terminal_container.exec_run("/sbin/ip route delete default")
-        terminal_container.exec_run("/sbin/ip route add default via " + str(os.getenv("GW_NETWORK_HEAD")) + ".0.3")
-        logger.success("OpeSAND Testbed Running")
+        logger.debug("Connecting User Terminals to Satellite Spot Beam")
+        run_concurrently({terminal: (exec_batch, (get_container(terminal), [
+            "/sbin/ip route delete default",
+            "/sbin/ip route add default via " + str(os.getenv("GW_NETWORK_HEAD")) + ".0.3",
+        ])) for terminal, _, _ in self.terminals()}, name="Modem")
+
+    @timed()
+    def reset_testbed(self, opensand_scenario=None):
+        # Brings a running testbed back to the state start_testbed leaves it in without recreating any containers
+        logger.debug("Resetting Testbed Containers")
+        calls = {}
+        for index, (terminal, workstation, lan_head) in enumerate(self.terminals()):
+            variables = {**os.environ, "TERMINAL_LAN_HEAD": lan_head}
+            containers = {"ST_CONTAINER_NAME": terminal, "WS_ST_CONTAINER_NAME": workstation}
+            if index == 0:
+                containers.update({container_variable: os.getenv(container_variable) for container_variable in RESET_COMMANDS
+                                   if container_variable not in containers})
+            for container_variable, container_name in containers.items():
+                calls[container_name] = (exec_batch, (get_container(container_name), [
+                    command.format(**variables) for command in RESET_COMMANDS[container_variable]]))
+        run_concurrently(calls, name="Reset")
+        self.reset_emulator(opensand_scenario)
+        # the reset removed every netem qdisc, and a restarted OpenSAND has fresh tun devices anyway
+        self.netem.reset()
+
+    def reset_emulator(self, opensand_scenario=None):
+        # OpenSAND only needs a restart if it stopped or a different scenario is loaded
+        self.opensand.connect()
+        states = self.opensand.status()
+        running = all(states.get(host) == 'RUNNING' for host in self.opensand.hosts)
+        if running and opensand_scenario == self.opensand_scenario:
+            logger.debug("OpenSAND Simulation Still Running")
+            return
+        if opensand_scenario != self.opensand_scenario and self.opensand_scenario is None:
+            # the manager's default scenario cannot be reloaded by name, so it needs a fresh satellite container
+            logger.debug("Restarting Satellite Container for Default Scenario")
+            get_container(os.getenv("SAT_CONTAINER_NAME")).restart()
+            container_states().wait_for(os.getenv("SAT_CONTAINER_NAME"), "running")
+            self.start_opensand()
+            return
+        logger.debug("Restarting OpenSAND Simulation")
+        if any(state == 'RUNNING' for state in states.values()):
+            self.opensand.stop()
+        if self.opensand_scenario is not None:
+            self.opensand.load_scenario(self.opensand_scenario)
+        self.opensand.start(failure_check=self.check_opensand_failure)
 
+    @timed()
     def stop_testbed(self):
         logger.debug("Shutting Down Previous Testbeds")
-        subprocess.call(["docker-compose", "down"])
+        compose(["down", "--remove-orphans"], env=self.compose_env())
+        if os.path.exists(TESTBED_STATE_FILE):
+            os.remove(TESTBED_STATE_FILE)
+        if self.pin_cpus:
+            self.cpu_allocator.release()
 
+    @timed()
     def connect_terminal_workstation(self):
         logger.debug("Starting User Workstation")
-        docker_client = docker.from_env()
-        workstation_container = docker_client.containers.get(os.getenv("WS_ST_CONTAINER_NAME"))
-        logger.debug("Adding External Route to Docker Host for GUI Services")
-        workstation_container.exec_run("ip route add " + str(self.host_ip) + " via " + str(os.getenv("GUI_NETWORK_HEAD"))+".0.1 dev eth1")
-        logger.debug("Connecting User Workstation to Satellite Router")
-        workstation_container.exec_run("ip route del default")
-        workstation_container.exec_run("ip route add default via " + str(os.getenv("ST_NETWORK_HEAD"))+".0.4")
+        calls = {}
+        for index, (_, workstation, lan_head) in enumerate(self.terminals()):
+            commands = []
+            if index == 0 and not self.headless:
+                # only the first workstation is on the GUI network
+                logger.debug("Adding External Route to Docker Host for GUI Services")
+                commands.append("ip route add " + str(self.host_ip) + " via " + str(os.getenv("GUI_NETWORK_HEAD"))+".0.1 dev eth1")
+            calls[workstation] = (exec_batch, (get_container(workstation), commands + [
+                "ip route del default",
+                "ip route add default via " + lan_head + ".4",
+            ]))
+        logger.debug("Connecting User Workstations to Satellite Router")
+        run_concurrently(calls, name="Workstations")
         logger.success("Client Workstation Connected to Satellite Network")
 
+    @timed()
     def connect_sitespeed_workstation(self):
         logger.debug("Starting Sitespeed Workstation")
-        docker_client = docker.from_env()
-        sitespeed_container = docker_client.containers.get(os.getenv("SITESPEED_CONTAINER_NAME"))
-        sitespeed_container.exec_run("ip route del default")
-        sitespeed_container.exec_run("ip route add default via " + str(os.getenv("ST_NETWORK_HEAD"))+".0.4")
+        exec_batch(get_container(os.getenv("SITESPEED_CONTAINER_NAME")), [
+            "ip route del default",
+            "ip route add default via " + str(os.getenv("ST_NETWORK_HEAD"))+".0.4",
+        ])
         logger.success("Sitespeed Workstation Connected to Satellite Network")
 
     def launch_wireshark(self):
         logger.debug("Starting Wireshark on Satellite Endpoint")
-        docker_client = docker.from_env()
-        satellite_container = docker_client.containers.get(os.getenv("SAT_CONTAINER_NAME"))
+        satellite_container = get_container(os.getenv("SAT_CONTAINER_NAME"))
         satellite_container.exec_run("wireshark", detach=True)
 
     def launch_web_browser(self):
         logger.debug("Launching Web Browser on User Workstation")
-        docker_client = docker.from_env()
-        workstation_container = docker_client.containers.get(os.getenv("WS_ST_CONTAINER_NAME"))
+        workstation_container = get_container(os.getenv("WS_ST_CONTAINER_NAME"))
         workstation_container.exec_run("qupzilla", detach=True)
 
+    def materialize_attenuation_scenario(self):
+        # the attenuation scenario is the delay scenario with a constant GEO delay instead of the Iridium delay file
+        scenario = ScenarioConfig.load('delay_scenario').copy('attenuation_scenario')
+        scenario.set_constant_delay(125)
+        scenario.set_attenuation(self.downlink_attenuation, link="down")
+        return scenario.materialize()
+
     def set_downlink_attenuation(self, attenuation_value=0):
         logger.debug("Setting OpenSAND Downlink Attenuation to " + str(attenuation_value))
-        gw_path = 'satellite/attenuation_scenario/gw0/plugins/ideal.conf'
-        st_path = 'satellite/attenuation_scenario/st1/plugins/ideal.conf'
-        gw_conf = ET.parse(gw_path)
-        st_conf = ET.parse(st_path)
-        xml_confs = [gw_conf.getroot(), st_conf.getroot()]
-        for conf in xml_confs:
-            attenuation_settings = conf.findall('ideal/ideal_attenuations/ideal_attenuation')
-            for setting in attenuation_settings:
-                if setting.attrib["link"] == "down":
-                    setting.set("attenuation_value", str(attenuation_value))
-        gw_conf.write(gw_path)
-        st_conf.write(st_path)
+        self.downlink_attenuation = attenuation_value
+        self.materialize_attenuation_scenario()
         logger.debug("Updated Downlink Attenuations")
     
+    @timed()
     def set_plr_percentage(self, plr_percentage, st_out=False, gw_out=True):
+        # uniform loss on top of whatever else the direction's netem profile does
         logger.debug("Configuring Packet Loss Rate")
-        docker_client = docker.from_env()
-        containers_to_mod = []
-        if st_out:
-            logger.debug("Setting PLR for ST->GW at " + str(plr_percentage))
-            containers_to_mod.append(docker_client.containers.get(os.getenv("ST_CONTAINER_NAME")))
-        if gw_out:
-            logger.debug("Setting PLR for GW->ST at " + str(plr_percentage))
-            containers_to_mod.append(docker_client.containers.get(os.getenv("GW_CONTAINER_NAME")))
-        for container in containers_to_mod:
-            response = container.exec_run('/sbin/tc qdisc change dev opensand_tun root netem loss ' + str(plr_percentage) + "%", stderr=True, stdout=True)
-            if "RTNETLINK" in str(response.output):
-                container.exec_run('/sbin/tc qdisc add dev opensand_tun root netem loss ' + str(plr_percentage) + "%", stderr=True, stdout=True)
+        directions = ([] if not st_out else ["up"]) + ([] if not gw_out else ["down"])
+        self.set_netem_profile({direction: (self.netem.profile(direction) or NetemProfile()).replace(loss=plr_percentage)
+                                for direction in directions})
         logger.debug("Updated PLR to " + str(plr_percentage) + "%")
 
+    @timed()
+    def set_netem_profile(self, profiles):
+        # profiles maps "down" (GW->ST) and "up" (ST->GW) to a NetemProfile, or None to remove the impairment, or is
+        # one NetemProfile for both directions. Directions already set to their profile are skipped.
+        if profiles is None or isinstance(profiles, NetemProfile):
+            profiles = {direction: profiles for direction in self.netem.directions}
+        return self.netem.apply(profiles)
+
+    @timed()
     def run_attenuation_scenario(self):
         logger.debug("Running Attenuation Scenario")
-        # wait to connect to opensand
-        opensand_launched = False
-        nc = None
-        while not opensand_launched:
-            try:
-                nc = nclib.Netcat(('localhost', int(os.getenv('SAT_PORT_NUMBER'))), verbose=False)
-                nc.recv_until(b'help')
-                nc.recv()
-                opensand_launched = True
-            except:
-                continue
-        logger.debug("Connected to NC Listener")
         # stop running scenarios if any
-        nc.send(b'stop\n')
-        nc.recv_until(b'OK', timeout=10)
-        nc.recv()
-        # opensand reports that the testbed has stopped a little before it actually has
-        time.sleep(1)
-
-        # load attenuation scenario
-        nc.send(b'scenario attenuation_scenario\n')
-        nc.recv_until(b'OK', timeout=10)
-        nc.recv()
-
-        # start new scenario
-        nc.send(b'start\n')
-        nc.recv_until(b'OK', timeout=10)
+        self.opensand.connect()
+        logger.debug("Connected to NC Listener")
+        self.opensand.stop()
+
+        # load attenuation scenario and start it
+        self.materialize_attenuation_scenario()
+        self.opensand.load_scenario('attenuation_scenario')
+        self.opensand.start(failure_check=self.check_opensand_failure)
+        self.netem.invalidate()
         logger.debug("Scenario Restarted")
-        nc.recv()
+        # a warm restart has to know the running scenario differs from this testbed's
+        self.write_testbed_state(**{**self.read_testbed_state(), "opensand_scenario": 'attenuation_scenario'})
 
         # ensure that the terminal modem is still connected
-        docker_client = docker.from_env()
-        terminal_container = docker_client.containers.get(os.getenv("ST_CONTAINER_NAME"))
-        #terminal_container.exec_run("/sbin/ip route delete default")
-        terminal_container.exec_run("/sbin/ip route add default via " + str(os.getenv("GW_NETWORK_HEAD"))+".0.3")
+        self.connect_terminal_modem()
 
         logger.debug("Attenuation Scenario Launched")
 
 class LeoTestbed(BasicTestbed):
-    def start_testbed(self):
-        # First, shut down any old running testbeds
-        logger.debug("Shutting Down Previous Testbeds")
-        subprocess.call(["docker-compose", "down"], stderr=subprocess.DEVNULL)
+    # loads the Iridium delay simulation before the platform is started
+    opensand_scenario = 'delay_scenario'
 
-        # The DISPLAY env variable points to an X server for showing OpenSAND UI
-        my_env = {**os.environ, 'DISPLAY': str(self.host_ip) + ":" + str(self.display_number)}
-        logger.debug("Starting Testbed Containers")
 
-        # Start the docker containers
-        subprocess.call(["docker-compose", "up", "-d"], env=my_env)
+class MultiTerminalTestbed(BasicTestbed):
+    # One gateway serving several satellite terminals, each with its own workstation, to measure how the gateway
+    # scales. The extra terminals come from a generated compose override and OpenSAND scenario (see topology.py),
+    # delay_ms replaces the base scenario's delay with a constant one on every host (None keeps it).
+    opensand_scenario = 'multi_terminal_scenario'
 
-        # Wait for the opensand container to initialize then send a command to run the simulation
-        logger.debug("Starting Opensand Platform")
-        opensand_launched = False
-        while not opensand_launched:
-            try:
-                nc = nclib.Netcat(('localhost', int(os.getenv('SAT_PORT_NUMBER'))), verbose=False)
-                nc.recv_until(b'help')
-                nc.recv()
-                nc.send(b'status\n')
-                response = nc.recv()
-                opensand_launched = ('SAT' in str(response)) and ('GW0' in str(response)) and ('ST1' in str(response))
-            except nclib.errors.NetcatError:
-                continue
-
-        logger.debug("Loading Iridium Delay Simulation")
-        nc.send(b'scenario delay_scenario\n')
-        nc.recv_until(b'OK', timeout=10)
-        nc.recv()
-        time.sleep(1) # it often takes a little while for Opensand to identify all hosts
-        logger.debug("Launching Opensand Simulation")
-        nc.send(b'start\n')
-        simulation_running = False
-        while not simulation_running:
-            nc.send(b'status\n')
-            response = str(nc.recv())
-            # wait for all three components (satellite, terminal and gateway) to start running
-            simulation_running = response.count('RUNNING') > 3
+    def __init__(self, terminals=2, host_ip="192.168.1.199", display_number=0, linux=False, pin_cpus=None,
+                 headless=None, base_scenario='delay_scenario', delay_ms=125):
+        super().__init__(host_ip=host_ip, display_number=display_number, linux=linux, pin_cpus=pin_cpus,
+                         headless=headless)
+        self.topology = TerminalTopology(terminals)
+        self.base_scenario = base_scenario
+        self.delay_ms = delay_ms
+        self.opensand.hosts = self.topology.hosts()
+        self.cpu_allocator.extra_terminals = [terminal[:2] for terminal in self.terminals()[1:]]
+        self.scenario_changed = False
 
-        # now that the network is running, it is possible to add ip routes from user terminal through the network
-        logger.debug("Connecting User Terminal to Satellite Spot Beam")
-        docker_client = docker.from_env()
-        terminal_container = docker_client.containers.get(os.getenv("ST_CONTAINER_NAME"))
-        terminal_container.exec_run("/sbin/ip route delete default")
-        terminal_container.exec_run("/sbin/ip route add default via " + str(os.getenv("GW_NETWORK_HEAD")) + ".0.3")
-        logger.success("OpeSAND Testbed Running")
+    def terminals(self):
+        return self.topology.terminal_list()
+
+    def compose_env(self):
+        # docker-compose reads the override alongside the compose file for every command, including config and down
+        return {**super().compose_env(), 'COMPOSE_FILE': os.pathsep.join(["docker-compose.yml", self.topology.override_path])}
+
+    def materialize_scenario(self):
+        scenario = self.topology.scenario(self.base_scenario, self.opensand_scenario)
+        if self.delay_ms is not None:
+            scenario.set_constant_delay(self.delay_ms)
+        return scenario.materialize()
+
+    @timed()
+    def start_testbed(self, reuse=True):
+        self.topology.write(ImageBuilder(self.compose_env()).project_name())
+        self.scenario_changed = bool(self.materialize_scenario())
+        super().start_testbed(reuse)
+
+    def reset_emulator(self, opensand_scenario=None):
+        # a running simulation still has the old files of a scenario that was just rewritten, so it has to reload
+        super().reset_emulator(None if self.scenario_changed else opensand_scenario)
+
+    @timed()
+    def connect_terminal_modem(self):
+        super().connect_terminal_modem()
+        # the gateway reaches terminal 1's LAN through OpenSAND's own route, the others are added next to it
+        exec_batch(get_container(os.getenv("GW_CONTAINER_NAME")), [
+            "/sbin/ip route replace " + lan_head + ".0/24 dev opensand_tun" for _, _, lan_head in self.terminals()[1:]])
+
+
+class NetemTestbed(BasicTestbed):
+    # Replaces OpenSAND with a plain network path for quick QPEP regression runs. A privileged helper container takes
+    # the satellite's place: its network namespace bridges two veth pairs whose other ends appear as opensand_tun in
+    # the terminal and gateway, and netem on the satellite side of each pair adds the delay and rate of the link.
+    # Loss stays on the terminal/gateway opensand_tun so set_plr_percentage and the PEP scripts work unchanged.
+    compose_services = ["gateway", "terminal", "ws-st", "ws-gw", "ws-ovpn", "sitespeed"]
+
+    def __init__(self, host_ip="192.168.1.199", display_number=0, linux=False, pin_cpus=None, delay_ms=250,
+                 downlink_rate=None, uplink_rate=None):
+        super().__init__(host_ip=host_ip, display_number=display_number, linux=linux, pin_cpus=pin_cpus, headless=True)
+        # one-way delay of each direction, a GEO hop is about 250ms, and tc rates such as "20mbit" (None is unshaped)
+        self.delay_ms = delay_ms
+        self.downlink_rate = downlink_rate
+        self.uplink_rate = uplink_rate
+
+    def link_address(self, host):
+        # the terminal (.4) and gateway (.3) keep their emulation network host numbers on a subnet of their own
+        return str(os.getenv("EMU_NETWORK_HEAD")) + ".1." + str(host)
+
+    def satellite_container(self):
+        # named and labelled like the compose satellite so docker-compose down removes it with the rest of the testbed
+        client = get_docker_client()
+        name = os.getenv("SAT_CONTAINER_NAME")
+        try:
+            client.containers.get(name).remove(force=True)
+        except docker.errors.NotFound:
+            pass
+        invalidate_container(name)
+        gateway_container = get_container(os.getenv("GW_CONTAINER_NAME"))
+        return client.containers.run(gateway_container.image, entrypoint=["tail", "-f", "/dev/null"], name=name,
+                                     detach=True, privileged=True, pid_mode="host", network_mode="none", labels={
+                                         "com.docker.compose.project": ImageBuilder(self.compose_env()).project_name(),
+                                         "com.docker.compose.service": "satellite",
+                                         "com.docker.compose.oneoff": "False",
+                                         "com.docker.compose.container-number": "1",
+                                     })
+
+    def link_commands(self):
+        commands = []
+        for interface, rate in (("sat_st", self.downlink_rate), ("sat_gw", self.uplink_rate)):
+            netem = "netem delay " + str(self.delay_ms) + "ms"
+            if rate is not None:
+                netem += " rate " + str(rate)
+            # room for a bandwidth-delay product of packets, netem's default of 1000 drops long fat flows
+            commands.append("/sbin/tc qdisc replace dev " + interface + " root " + netem + " limit 100000")
+        return commands
+
+    @timed()
+    def start_emulator(self):
+        logger.debug("Building Netem Satellite Link")
+        satellite_container = self.satellite_container()
+        endpoints = {"ST_CONTAINER_NAME": ("sat_st", 4, "GW_NETWORK_HEAD", 3),
+                     "GW_CONTAINER_NAME": ("sat_gw", 3, "ST_NETWORK_HEAD", 4)}
+        satellite_commands = ["/sbin/ip link add sat_br type bridge", "/sbin/ip link set sat_br up"]
+        for container_variable, (interface, host, remote_head, remote_host) in endpoints.items():
+            container = get_container(os.getenv(container_variable))
+            container.reload()
+            # an earlier link (or OpenSAND's tun) would keep the new veth end from taking the name
+            exec_batch(container, ["/sbin/ip link del opensand_tun 2>/dev/null"])
+            satellite_commands += [
+                "/sbin/ip link add " + interface + " type veth peer name opensand_tun netns " + str(container.attrs["State"]["Pid"]),
+                "/sbin/ip link set " + interface + " master sat_br",
+                "/sbin/ip link set " + interface + " up",
+            ]
+        satellite_commands += self.link_commands()
+        self._check_batch(satellite_container.name, exec_batch(satellite_container, satellite_commands))
+        run_concurrently({container_variable: (self._configure_endpoint, (container_variable, host, remote_head, remote_host))
+                          for container_variable, (_, host, remote_head, remote_host) in endpoints.items()}, name="Netem")
+        logger.debug("Netem Satellite Link Running")
+
+    def _configure_endpoint(self, container_variable, host, remote_head, remote_host):
+        container = get_container(os.getenv(container_variable))
+        self._check_batch(container.name, exec_batch(container, [
+            "/sbin/ip addr add " + self.link_address(host) + "/24 dev opensand_tun",
+            "/sbin/ip link set opensand_tun up",
+            "sysctl -w net.ipv4.ip_forward=1",
+            "/sbin/ip route replace " + str(os.getenv(remote_head)) + ".0.0/24 via " + self.link_address(remote_host) + " dev opensand_tun",
+        ]))
+
+    def _check_batch(self, container_name, results):
+        for result in results:
+            if result.exit_code != 0:
+                raise EmulationError(container_name + ": '" + result.command + "' failed: " + result.output)
+
+    def reset_emulator(self, opensand_scenario=None):
+        # the link survives a reset, only its shaping is restored in case it was changed during the last run
+        satellite_container = get_container(os.getenv("SAT_CONTAINER_NAME"))
+        results = exec_batch(satellite_container, ["/sbin/ip link show sat_st", "/sbin/ip link show sat_gw"])
+        if any(result.exit_code != 0 for result in results):
+            logger.debug("Netem Satellite Link Missing, Rebuilding")
+            self.start_emulator()
+            return
+        self._check_batch(satellite_container.name, exec_batch(satellite_container, self.link_commands()))
+
+    def set_link(self, delay_ms=None, downlink_rate=None, uplink_rate=None):
+        # changes the running link in place, arguments left at None keep their current value
+        if delay_ms is not None:
+            self.delay_ms = delay_ms
+        if downlink_rate is not None:
+            self.downlink_rate = downlink_rate
+        if uplink_rate is not None:
+            self.uplink_rate = uplink_rate
+        logger.debug("Setting Netem Link to " + str(self.delay_ms) + "ms, " + str(self.downlink_rate) + " down, " +
+                     str(self.uplink_rate) + " up")
+        satellite_container = get_container(os.getenv("SAT_CONTAINER_NAME"))
+        self._check_batch(satellite_container.name, exec_batch(satellite_container, self.link_commands()))
+
+    @timed()
+    def connect_terminal_modem(self):
+        logger.debug("Connecting User Terminal to Netem Satellite Link")
+        exec_batch(get_container(os.getenv("ST_CONTAINER_NAME")), [
+            "/sbin/ip route delete default",
+            "/sbin/ip route add default via " + self.link_address(3) + " dev opensand_tun",
+        ])
+
+    def set_downlink_attenuation(self, attenuation_value=0):
+        raise EmulationError("Attenuation is an OpenSAND physical layer setting, use set_plr_percentage or set_link")
+
+    def run_attenuation_scenario(self):
+        raise EmulationError("The netem testbed has no OpenSAND scenarios")
@@ -0,0 +1,12 @@
+import os
+import sys
+import pytest
+
+# the testbed's modules import each other by their plain names, as they do when run from opensand-testbed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(autouse=True)
+def dry_run(monkeypatch):
+    # nothing here may reach a real docker daemon or OpenSAND manager
+    monkeypatch.setenv("QPEP_DRY_RUN", "1")
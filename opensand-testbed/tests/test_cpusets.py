@@ -0,0 +1,51 @@
+import json
+import subprocess
+import sys
+import pytest
+from cpusets import CpuAllocator, CpuAllocationError
+
+
+def allocator(monkeypatch, tmp_path, owner, cores=16, **kwargs):
+    monkeypatch.setenv("SAT_CONTAINER_NAME", owner)
+    cpu_allocator = CpuAllocator(allocation_file=str(tmp_path / "cpusets.json"), **kwargs)
+    monkeypatch.setattr(cpu_allocator, "host_cores", lambda: list(range(cpu_allocator.reserved_cores, cores)))
+    return cpu_allocator
+
+
+def cores_of(allocation):
+    return [core for cores in allocation.values() for core in cores]
+
+
+def test_concurrent_owners_get_disjoint_cores(monkeypatch, tmp_path):
+    first = allocator(monkeypatch, tmp_path, "satellite1").allocate()
+    second = allocator(monkeypatch, tmp_path, "satellite2").allocate()
+    assert len(cores_of(first)) == len(cores_of(second)) == 5
+    assert not set(cores_of(first)) & set(cores_of(second))
+    assert 0 not in cores_of(first) + cores_of(second)
+    # allocating again keeps an owner's cores
+    assert allocator(monkeypatch, tmp_path, "satellite1").allocate() == first
+
+
+def test_extra_terminals_get_emulator_cores(monkeypatch, tmp_path):
+    allocation = allocator(monkeypatch, tmp_path, "satellite1", extra_terminals=[("st2", "ws-st2")]).allocate()
+    assert len(allocation["st2"]) == 1
+    assert "ws-st2" not in allocation
+    assert len(set(cores_of(allocation))) == 6
+
+
+def test_release_frees_cores(monkeypatch, tmp_path):
+    allocator(monkeypatch, tmp_path, "satellite1", cores=7).allocate()
+    with pytest.raises(CpuAllocationError):
+        allocator(monkeypatch, tmp_path, "satellite2", cores=7).allocate()
+    allocator(monkeypatch, tmp_path, "satellite1", cores=7).release()
+    assert allocator(monkeypatch, tmp_path, "satellite2", cores=7).allocate()
+
+
+def test_dead_owner_expires(monkeypatch, tmp_path):
+    finished = subprocess.Popen([sys.executable, "-c", "pass"])
+    finished.wait()
+    stale = {"satellite9": {"pid": finished.pid, "cores": {"measurement": [1, 2, 3, 4, 5, 6]}}}
+    (tmp_path / "cpusets.json").write_text(json.dumps(stale))
+    allocation = allocator(monkeypatch, tmp_path, "satellite1", cores=7).allocate()
+    assert sorted(cores_of(allocation)) == [1, 2, 3, 4, 5]
+    assert list(json.loads((tmp_path / "cpusets.json").read_text())) == ["satellite1"]
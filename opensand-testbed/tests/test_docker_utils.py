@@ -0,0 +1,26 @@
+from docker_utils import exec_batch
+from fakes import FakeDockerClient
+
+
+def test_exec_batch_splits_output_per_command():
+    client = FakeDockerClient()
+    container = client.containers.get("ws-st")
+    commands = ["ip route", "ss -tln", "pgrep -x iperf3"]
+    results = exec_batch(container, commands)
+    assert [result.command for result in results] == commands
+    assert [result.exit_code for result in results] == [0, 0, 1]
+    assert results[0].output == ""
+    assert results[1].output.splitlines()[0].startswith("State")
+    assert "0.0.0.0:5201" in results[1].output
+    # the whole batch is one exec
+    assert len(client.exec_log) == 1
+
+
+def test_exec_batch_keeps_multiline_output():
+    client = FakeDockerClient()
+    container = client.containers.get("ws-st")
+    container.exec_run("iperf3 -s", detach=True)
+    container.exec_run("iperf3 -s -p 5202", detach=True)
+    result = exec_batch(container, ["pgrep -x iperf3"])[0]
+    assert result.exit_code == 0
+    assert len(result.output.splitlines()) == 2
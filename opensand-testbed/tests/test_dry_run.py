@@ -0,0 +1,46 @@
+import docker_utils
+import fakes
+import snapshots
+import testbeds
+from docker_utils import get_docker_client
+from simulation_examples import plr_test_scenario
+
+
+def test_plr_sweep_runs_offline(monkeypatch, tmp_path):
+    # two PLR levels of the QPEP sweep: the first deploy runs the scripts, the second restores their snapshot
+    for variable, value in {"SCENARIO_NAME": "QPEP", "PLR_MIN_INDEX": "0", "PLR_MAX_INDEX": "2",
+                            "PLR_META_ITERATIONS": "1", "IPERF_ITERATIONS": "1"}.items():
+        monkeypatch.setenv(variable, value)
+    # the testbed state file and the snapshots stay out of the checkout
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(testbeds, "NetworkSnapshots",
+                        lambda testbed: snapshots.NetworkSnapshots(testbed, str(tmp_path / "snapshots")))
+    compose_calls = []
+    monkeypatch.setattr(docker_utils, "fake_compose",
+                        lambda arguments, capture=False: compose_calls.append(list(arguments)) or fakes.fake_compose(arguments, capture))
+    first_exec = len(get_docker_client().exec_log)
+
+    results = plr_test_scenario()
+
+    assert list(results) == ["0.0000001", "0.0000003"]
+    for cells in results.values():
+        for benchmark_results in cells:
+            for cell in benchmark_results.values():
+                assert all(reason is None for reason in cell["failure_reason"])
+                assert all(sent_bps == fakes.FAKE_LINK_BPS for sent_bps in cell["sent_bps"])
+    # the containers are brought up once and reused for the second level
+    assert [arguments[:2] for arguments in compose_calls if arguments[0] in ("up", "down")] == [["down", "--remove-orphans"], ["up", "-d"]]
+
+    exec_log = get_docker_client().exec_log[first_exec:]
+    commands = {}
+    for container, command, _ in exec_log:
+        commands.setdefault(container, []).append(command)
+    detached = [(container, command) for container, command, options in exec_log if options["detach"]]
+    assert any(container == "ws-gw1" and "-controlPort 4243" in command for container, command in detached)
+    assert any(container == "terminal1" and "-client" in command for container, command in detached)
+    assert sum("bash /opensand_config/configure_qpep.sh" in command for command in commands["terminal1"]) == 1
+    assert any("iptables-restore" in command for command in commands["terminal1"])
+    assert any("netem loss random 0.0000003%" in command for command in commands["gateway1"])
+    transfers = [command for command in commands["ws-st1"] if "iperf3 --no-delay -c" in command]
+    assert len(transfers) == 8
+    assert all(command.endswith(("-n 1000000", "-n 2000000", "-n 5000000")) for command in transfers)
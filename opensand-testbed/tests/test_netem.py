@@ -0,0 +1,35 @@
+import pytest
+from netem import NetemProfile
+
+
+def test_uniform_loss_has_no_queue_limit():
+    assert NetemProfile.uniform_loss(1).arguments() == "netem loss random 1%"
+    assert NetemProfile.uniform_loss(1, limit=5000).arguments() == "netem loss random 1% limit 5000"
+
+
+def test_burst_loss_gemodel():
+    # bursts of 4 packets: r = 25%, p / (p + r) = 5% gives p = 25 * 5 / 95
+    profile = NetemProfile.burst_loss(5, 4)
+    assert profile.arguments() == "netem loss gemodel " + str(round(25 * 5 / 95, 6)) + "% 25.0% 100% 0%"
+
+
+def test_delay_options_in_tc_order():
+    profile = NetemProfile(delay_ms=300, jitter_ms=10, delay_correlation=25, distribution="normal", reorder=5,
+                           loss=2, loss_correlation=50, rate="10mbit")
+    assert profile.arguments() == ("netem delay 300ms 10ms 25% distribution normal loss random 2% 50% "
+                                   "reorder 5% rate 10mbit")
+
+
+def test_replace_switches_loss_model():
+    profile = NetemProfile.uniform_loss(3, delay_ms=100).replace(gilbert_elliott=(1, 10, 100, 0))
+    assert profile.arguments() == "netem delay 100ms loss gemodel 1% 10% 100% 0%"
+    assert profile.replace(loss=3) == NetemProfile.uniform_loss(3, delay_ms=100)
+
+
+def test_invalid_profiles():
+    with pytest.raises(ValueError):
+        NetemProfile(loss=1, gilbert_elliott=(1, 10, 100, 0))
+    with pytest.raises(ValueError):
+        NetemProfile(reorder=5)
+    with pytest.raises(ValueError):
+        NetemProfile(jitter_ms=10)
@@ -0,0 +1,34 @@
+import pytest
+from fakes import FakeOpensandServer
+from opensand import OpensandController
+
+
+@pytest.fixture
+def manager():
+    server = FakeOpensandServer(terminals=1)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_status_per_host(manager):
+    controller = OpensandController(port=manager.port, min_backoff=0.01)
+    try:
+        assert controller.status() == {"SAT": "STOPPED", "GW0": "STOPPED", "ST1": "STOPPED"}
+        controller.load_scenario("delay_scenario")
+        assert controller.start(timeout=5) == {"SAT": "RUNNING", "GW0": "RUNNING", "ST1": "RUNNING"}
+        assert manager.scenario == "delay_scenario"
+        assert controller.last_status["ST1"] == "RUNNING"
+    finally:
+        controller.close()
+
+
+def test_stop_survives_a_dropped_connection(manager):
+    controller = OpensandController(port=manager.port, min_backoff=0.01)
+    try:
+        controller.start(timeout=5)
+        # the manager going away mid teardown, e.g. the satellite container restarting
+        controller.nc.close()
+        assert controller.stop(timeout=5) == {"SAT": "STOPPED", "GW0": "STOPPED", "ST1": "STOPPED"}
+    finally:
+        controller.close()
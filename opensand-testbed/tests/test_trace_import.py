@@ -0,0 +1,27 @@
+import random
+from trace_import import compress_steps, interval_series
+
+
+def test_compress_steps_stays_within_tolerance():
+    generator = random.Random(7)
+    samples = [(index, 600 + 50 * (index // 100) + generator.uniform(-3, 3)) for index in range(500)]
+    steps = compress_steps(samples, 5.0)
+    assert 5 <= len(steps) < 20
+    for time_s, value in samples:
+        step_value = [step_value for start, step_value in steps if start <= time_s][-1]
+        assert abs(value - step_value) <= 5.0
+
+
+def test_compress_steps_relative():
+    steps = compress_steps([(0, 100), (1, 104), (2, 1000), (3, 1040)], 0.05, relative=True)
+    assert steps == [(0, 102), (2, 1020)]
+    assert compress_steps([], 1.0) == []
+
+
+def test_loss_is_estimated_over_windows():
+    # one ping a second, every 50th lost: 2% loss, not a series of 0% and 100% bins
+    samples = [(time_s, None if time_s % 50 == 49 else 600.0) for time_s in range(300)]
+    loss = interval_series(samples, loss_window_s=60, min_loss_probes=50)["loss"]
+    assert [start for start, _ in loss] == [0, 60, 120, 180, 240]
+    assert all(0 < value < 5 for _, value in loss)
+    assert sum(value for _, value in loss) / len(loss) == 2.0
@@ -0,0 +1,137 @@
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+from loguru import logger
+
+# spans in this category are time spent measuring, everything else a run spends is orchestration overhead
+MEASUREMENT = "measurement"
+
+_lock = threading.Lock()
+_events = []
+_run_start = time.perf_counter()
+# spans are timed on perf_counter, this maps them onto the wall clock other tools (e.g. OpenSAND probes) stamp with
+_wall_offset = time.time() - time.perf_counter()
+
+
+def reset():
+    # starts a new run, e.g. between sweep cells that should be summarised separately
+    global _run_start
+    with _lock:
+        _events.clear()
+        _run_start = time.perf_counter()
+
+
+@contextlib.contextmanager
+def span(name, category="setup", **args):
+    # Times a phase, spans opened inside it (on the same thread) nest under it in the trace. Extra keyword arguments
+    # end up as the span's args in the trace viewer, e.g. span("iperf transfer", MEASUREMENT, bytes=file_size).
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        event = {"name": name, "cat": category, "start": start, "end": end,
+                 "tid": threading.get_ident(), "thread": threading.current_thread().name, "args": args}
+        with _lock:
+            _events.append(event)
+
+
+def timed(category="setup", name=None):
+    # decorator form of span, names the span after the method unless given a name
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            span_name = name if name is not None else function.__qualname__
+            if args and hasattr(args[0], "name") and isinstance(args[0].name, str):
+                # scenarios and benchmarks are more useful by their display name than by their class
+                span_name += " (" + args[0].name + ")"
+            with span(span_name, category):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def events():
+    with _lock:
+        return list(_events)
+
+
+def wall_time(perf_time):
+    # seconds since the epoch of a span's start or end
+    return perf_time + _wall_offset
+
+
+def _union_length(intervals):
+    total, current_start, current_end = 0.0, None, None
+    for start, end in sorted(intervals):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+
+def summary():
+    # Measurement time is the union of all measurement spans so concurrent or nested measurements are not counted
+    # twice, overhead is whatever else the run spent since it started.
+    recorded = events()
+    end = max([event["end"] for event in recorded] + [time.perf_counter()])
+    wall_time = end - _run_start
+    measurement_time = _union_length([(event["start"], event["end"]) for event in recorded
+                                      if event["cat"] == MEASUREMENT])
+    phases = {}
+    for event in recorded:
+        phase = phases.setdefault(event["name"], {"category": event["cat"], "count": 0, "total": 0.0})
+        phase["count"] += 1
+        phase["total"] += event["end"] - event["start"]
+    return {
+        "wall_time": wall_time,
+        "measurement_time": measurement_time,
+        "overhead_time": wall_time - measurement_time,
+        "measurement_share": measurement_time / wall_time if wall_time > 0 else 0.0,
+        "phases": dict(sorted(phases.items(), key=lambda item: item[1]["total"], reverse=True)),
+    }
+
+
+def log_summary(top=15):
+    run_summary = summary()
+    logger.info("Run took " + str(round(run_summary["wall_time"], 1)) + "s: " +
+                str(round(run_summary["measurement_time"], 1)) + "s measuring, " +
+                str(round(run_summary["overhead_time"], 1)) + "s overhead (" +
+                str(round(100 * run_summary["measurement_share"], 1)) + "% measurement)")
+    for phase_name, phase in list(run_summary["phases"].items())[:top]:
+        logger.info("  " + phase_name + " [" + phase["category"] + "]: " + str(round(phase["total"], 2)) + "s over " +
+                    str(phase["count"]) + " calls")
+    return run_summary
+
+
+def export_chrome_trace(path):
+    # complete ("X") events in the Trace Event Format, open the file in chrome://tracing or ui.perfetto.dev
+    pid = os.getpid()
+    trace_events = []
+    thread_names = {}
+    for event in events():
+        thread_names[event["tid"]] = event["thread"]
+        trace_events.append({
+            "name": event["name"],
+            "cat": event["cat"],
+            "ph": "X",
+            "ts": (event["start"] - _run_start) * 1e6,
+            "dur": (event["end"] - event["start"]) * 1e6,
+            "pid": pid,
+            "tid": event["tid"],
+            "args": {key: str(value) for key, value in event["args"].items()},
+        })
+    for tid, thread_name in thread_names.items():
+        trace_events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": thread_name}})
+    with open(path, "w") as trace_file:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms", "otherData": summary()}, trace_file)
+    logger.debug("Wrote timing trace to " + str(path))
+    return path
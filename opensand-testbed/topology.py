@@ -0,0 +1,126 @@
+import os
+import re
+import yaml
+from opensand_config import ScenarioConfig
+from dotenv import load_dotenv
+load_dotenv()
+
+TESTBED_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# generated per testbed directory, the compose override and every extra terminal's OpenSAND daemon.conf
+TOPOLOGY_DIRECTORY = os.path.join(TESTBED_DIRECTORY, ".topology")
+OVERRIDE_FILE = "docker-compose.terminals.yml"
+TERMINAL_DAEMON_CONFIG = os.path.join(TESTBED_DIRECTORY, "terminal", "config", "term.conf")
+# the emulation network is a /24 shared with the satellite (.2) and gateway (.3), terminal i takes .3 + i
+MAX_TERMINALS = 200
+
+
+class TerminalTopology(object):
+    # N satellite terminals behind the one gateway, each with a workstation on a LAN of its own. Terminal 1 is the
+    # compose file's terminal and ws-st, terminals 2..N run the same images from a generated compose override with
+    # their own OpenSAND daemon.conf. The LAN of terminal i is <ST_NETWORK_HEAD>.<i - 1>.0/24, so terminal 1 keeps
+    # the addresses the rest of the testbed expects.
+    def __init__(self, terminals=1, env=None, directory=TOPOLOGY_DIRECTORY):
+        if not 1 <= terminals <= MAX_TERMINALS:
+            raise ValueError("A testbed takes 1 to " + str(MAX_TERMINALS) + " terminals, not " + str(terminals))
+        self.terminals = terminals
+        self.env = env if env is not None else dict(os.environ)
+        self.directory = directory
+
+    @property
+    def override_path(self):
+        return os.path.join(self.directory, OVERRIDE_FILE)
+
+    def lan_head(self, index):
+        return str(self.env.get("ST_NETWORK_HEAD")) + "." + str(index - 1)
+
+    def emulation_address(self, index):
+        return str(self.env.get("EMU_NETWORK_HEAD")) + ".0." + str(3 + index)
+
+    def terminal_container(self, index):
+        name = str(self.env.get("ST_CONTAINER_NAME"))
+        return name if index == 1 else name + "-" + str(index)
+
+    def workstation_container(self, index):
+        name = str(self.env.get("WS_ST_CONTAINER_NAME"))
+        return name if index == 1 else name + "-" + str(index)
+
+    def terminal_list(self):
+        # (terminal container, workstation container, LAN head) of every terminal, terminal 1 first
+        return [(self.terminal_container(index), self.workstation_container(index), self.lan_head(index))
+                for index in range(1, self.terminals + 1)]
+
+    def hosts(self):
+        # the components the OpenSAND manager reports once every terminal's daemon has registered
+        return ("SAT", "GW0") + tuple("ST" + str(index) for index in range(1, self.terminals + 1))
+
+    def daemon_config(self, index):
+        # terminal/config/term.conf with the instance number and addresses of terminal index
+        with open(TERMINAL_DAEMON_CONFIG, "r") as config_file:
+            config = config_file.read()
+        settings = {
+            "instance": str(index),
+            "emu_ipv4": self.emulation_address(index) + "/24",
+            "lan_ipv4": self.lan_head(index) + ".4/24",
+            "lan_ipv6": str(self.env.get("ST_IP6_HEAD")) + ":6602:" + format(0x102 + index - 1, "x") + "::1/64",
+        }
+        for key, value in settings.items():
+            config = re.sub(r"(?m)^" + key + r"\s*=.*$", key + " = " + value, config)
+        return config
+
+    def compose_override(self, project_name):
+        # services and networks of terminals 2..N, using the images ImageBuilder tags for the compose file's terminal
+        # and ws-st
+        services, networks = {}, {}
+        for index in range(2, self.terminals + 1):
+            network = "stlan" + str(index)
+            networks[network] = {
+                "name": str(self.env.get("ST_NETWORK_NAME")) + "-" + str(index),
+                "driver": "bridge",
+                "ipam": {"driver": "default", "config": [{"subnet": self.lan_head(index) + ".0/24"}]},
+            }
+            services["terminal" + str(index)] = {
+                "container_name": self.terminal_container(index),
+                "image": project_name + "_terminal",
+                "volumes": [
+                    "./terminal/config:/opensand_config",
+                    "../src/:/root/go/src",
+                    "qpep-bin:/qpep-bin",
+                    os.path.join(self.directory, "st" + str(index), "daemon.conf") + ":/etc/opensand/daemon.conf:ro",
+                ],
+                "environment": {"GOPATH": "/root/go"},
+                "networks": {
+                    "emulation": {"ipv4_address": self.emulation_address(index), "priority": 900},
+                    network: {"ipv4_address": self.lan_head(index) + ".4", "priority": 1000},
+                },
+                "privileged": True,
+                "cap_add": ["ALL", "NET_ADMIN"],
+                "devices": ["/dev/net/tun"],
+                "sysctls": ["net.ipv6.conf.all.disable_ipv6=0"],
+            }
+            services["ws-st" + str(index)] = {
+                "container_name": self.workstation_container(index),
+                "image": project_name + "_ws-st",
+                "networks": {network: {"ipv4_address": self.lan_head(index) + ".9"}},
+                "privileged": True,
+                "cap_add": ["NET_ADMIN"],
+                "sysctls": ["net.ipv6.conf.all.disable_ipv6=1"],
+            }
+        return {"version": "2.4", "services": services, "networks": networks}
+
+    def write(self, project_name):
+        # writes the override and daemon configs, returns the override's path for COMPOSE_FILE
+        for index in range(2, self.terminals + 1):
+            os.makedirs(os.path.join(self.directory, "st" + str(index)), exist_ok=True)
+            with open(os.path.join(self.directory, "st" + str(index), "daemon.conf"), "w") as daemon_file:
+                daemon_file.write(self.daemon_config(index))
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.override_path, "w") as override_file:
+            yaml.safe_dump(self.compose_override(project_name), override_file, default_flow_style=False, sort_keys=False)
+        return self.override_path
+
+    def scenario(self, base="delay_scenario", name="multi_terminal_scenario"):
+        # base with an st<i> host and topology entry for every terminal
+        scenario = ScenarioConfig.load(base).copy(name)
+        scenario.set_terminals([self.lan_head(index) + ".0/24" for index in range(1, self.terminals + 1)],
+                               gateway_lan=str(self.env.get("GW_NETWORK_HEAD")) + ".0.0/24")
+        return scenario
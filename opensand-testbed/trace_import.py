@@ -0,0 +1,301 @@
+import gzip
+import math
+import re
+import struct
+from statistics import median
+from loguru import logger
+from link_schedule import LinkSchedule
+from opensand_config import ScenarioConfig
+
+PING_REPLY_PATTERN = re.compile(r"^(?:\[(?P<timestamp>[0-9.]+)\]\s*)?\d+ bytes from .*icmp_seq=(?P<seq>\d+).*time[=<](?P<rtt>[0-9.]+) ms")
+PING_MISSING_PATTERN = re.compile(r"^(?:\[(?P<timestamp>[0-9.]+)\]\s*)?no answer yet for icmp_seq=(?P<seq>\d+)")
+IPERF_INTERVAL_PATTERN = re.compile(r"^\[\s*(?P<stream>\d+|SUM)\]\s+(?P<start>[0-9.]+)-(?P<end>[0-9.]+)\s+sec\s+"
+                                    r"[0-9.]+ \w?Bytes\s+(?P<rate>[0-9.]+) (?P<unit>\w?)bits/sec")
+RATE_UNITS = {"": 1, "K": 1e3, "M": 1e6, "G": 1e9}
+PCAP_MAGIC = {b"\xd4\xc3\xb2\xa1": ("<", 1e-6), b"\xa1\xb2\xc3\xd4": (">", 1e-6),
+              b"\x4d\x3c\xb2\xa1": ("<", 1e-9), b"\xa1\xb2\x3c\x4d": (">", 1e-9)}
+# link layer header lengths of the capture types terminals produce: Ethernet, raw IP and Linux cooked captures
+PCAP_LINK_HEADERS = {1: 14, 101: 0, 228: 0, 113: 16}
+# probes that get no reply within this long count as lost
+PROBE_TIMEOUT_S = 5.0
+# loss is a rate, it needs many probes per estimate: a minute of 1 s pings by default
+LOSS_WINDOW_S = 60.0
+MIN_LOSS_PROBES = 50
+
+
+def _open(path):
+    # logs are read line by line (pcaps record by record), gzipped captures straight from the archive
+    if hasattr(path, "read") or not isinstance(path, str):
+        return path
+    return gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+
+
+def _lines(path):
+    source = _open(path)
+    try:
+        for line in source:
+            yield line.decode(errors="replace") if isinstance(line, bytes) else line
+    finally:
+        if source is not path:
+            source.close()
+
+
+def parse_ping(path, interval_s=1.0):
+    # Yields (time, rtt in ms) per probe from ping output, rtt None for a lost probe. Lost probes are the gaps in
+    # icmp_seq (or ping -O's "no answer yet" lines), times come from ping -D timestamps or else from the sequence.
+    last_seq = None
+    for line in _lines(path):
+        match = PING_REPLY_PATTERN.match(line) or PING_MISSING_PATTERN.match(line)
+        if match is None:
+            continue
+        seq = int(match.group("seq"))
+        rtt = float(match.group("rtt")) if match.re is PING_REPLY_PATTERN else None
+        timestamp = float(match.group("timestamp")) if match.group("timestamp") else seq * interval_s
+        if last_seq is not None and seq > last_seq + 1:
+            for missing in range(last_seq + 1, seq):
+                yield timestamp - (seq - missing) * interval_s, None
+        if last_seq is None or seq > last_seq:
+            last_seq = seq
+            yield timestamp, rtt
+
+
+def parse_iperf(path):
+    # Yields (start time, bits per second) per iperf3 report interval. Parallel streams are summed, the per test
+    # summary lines at the end (sender/receiver) are skipped.
+    current, total, has_sum = None, 0.0, False
+    for line in _lines(path):
+        if "sender" in line or "receiver" in line:
+            continue
+        match = IPERF_INTERVAL_PATTERN.match(line.strip())
+        if match is None:
+            continue
+        start = float(match.group("start"))
+        rate = float(match.group("rate")) * RATE_UNITS.get(match.group("unit"), 1)
+        if current is not None and start != current:
+            yield current, total
+            total, has_sum = 0.0, False
+        current = start
+        if match.group("stream") == "SUM":
+            total, has_sum = rate, True
+        elif not has_sum:
+            total += rate
+    if current is not None:
+        yield current, total
+
+
+def parse_pcap(path):
+    # Yields (time, captured length, rtt in ms or None) per IPv4 packet of a classic pcap. Rtts come from ICMP echo
+    # replies and TCP SYN-ACKs matched to their request, lost probes are reported as (time, 0, None) once unanswered
+    # for PROBE_TIMEOUT_S. Only the headers of each record are decoded.
+    source = _open(path)
+    try:
+        header = source.read(24)
+        if header[:4] not in PCAP_MAGIC:
+            raise ValueError("Not a classic pcap file (pcapng captures need converting with editcap -F pcap)")
+        endian, resolution = PCAP_MAGIC[header[:4]]
+        link_type = struct.unpack(endian + "I", header[20:24])[0] & 0xFFFF
+        if link_type not in PCAP_LINK_HEADERS:
+            raise ValueError("Unsupported pcap link type " + str(link_type))
+        link_header = PCAP_LINK_HEADERS[link_type]
+        outstanding = {}
+        next_expiry = None
+        while True:
+            record = source.read(16)
+            if len(record) < 16:
+                break
+            seconds, fraction, captured, _ = struct.unpack(endian + "IIII", record)
+            data = source.read(captured)
+            timestamp = seconds + fraction * resolution
+            rtt = None
+            packet = data[link_header:]
+            if len(packet) >= 20 and packet[0] >> 4 == 4:
+                header_length = (packet[0] & 0x0F) * 4
+                protocol, source_address, destination_address = packet[9], packet[12:16], packet[16:20]
+                payload = packet[header_length:]
+                probe, reply = None, None
+                if protocol == 1 and len(payload) >= 8 and payload[0] in (0, 8):
+                    key = (payload[4:8], min(source_address, destination_address), max(source_address, destination_address))
+                    probe, reply = (key, None) if payload[0] == 8 else (None, key)
+                elif protocol == 6 and len(payload) >= 14:
+                    flags = payload[13]
+                    ports = payload[0:2], payload[2:4]
+                    if flags & 0x12 == 0x02:
+                        probe = (source_address, ports[0], destination_address, ports[1])
+                    elif flags & 0x12 == 0x12:
+                        reply = (destination_address, ports[1], source_address, ports[0])
+                if probe is not None:
+                    outstanding.setdefault(probe, timestamp)
+                elif reply is not None and reply in outstanding:
+                    rtt = (timestamp - outstanding.pop(reply)) * 1000
+            if next_expiry is None or timestamp >= next_expiry:
+                # checked once a second of capture time, the probes are reported at the time they were sent
+                for key in [key for key, sent in outstanding.items() if timestamp - sent > PROBE_TIMEOUT_S]:
+                    yield outstanding.pop(key), 0, None
+                next_expiry = timestamp + 1
+            yield timestamp, captured, rtt
+    finally:
+        if source is not path:
+            source.close()
+
+
+def interval_series(samples, interval_s=1.0, lag_s=PROBE_TIMEOUT_S + 1, loss_window_s=LOSS_WINDOW_S,
+                    min_loss_probes=MIN_LOSS_PROBES):
+    # Bins a stream of (time, value) into intervals of interval_s, value being an rtt in ms, None for a lost probe or
+    # a (bytes, rtt) tuple from parse_pcap. Returns the rtt (median, ms), loss (percent of probes) and captured rate
+    # (bits per second) series relative to the first sample. Samples may arrive up to lag_s late, as parse_pcap's
+    # lost probes do, only bins older than that are closed. Loss is estimated over windows of at least loss_window_s
+    # and min_loss_probes probes rather than per bin: with one probe per bin a single lost ping would read as 100%.
+    series = {"rtt": [], "loss": [], "rate": []}
+    bins = {}
+    start = None
+    lag_bins = int(math.ceil(lag_s / interval_s))
+    # [start, probes, lost] of every loss window, the last one still filling
+    loss_windows = []
+
+    def flush(index):
+        rtts, probes, lost, captured_bytes = bins.pop(index)
+        offset = index * interval_s
+        if rtts:
+            series["rtt"].append((offset, median(rtts)))
+        if probes:
+            if not loss_windows or _window_complete(loss_windows[-1], offset, loss_window_s, min_loss_probes):
+                loss_windows.append([offset, 0, 0])
+            loss_windows[-1][1] += probes
+            loss_windows[-1][2] += lost
+        if captured_bytes:
+            series["rate"].append((offset, captured_bytes * 8 / interval_s))
+
+    for timestamp, value in samples:
+        if start is None:
+            start = timestamp
+        index = max(int((timestamp - start) // interval_s), 0)
+        rtts, probes, lost, captured_bytes = bins.get(index, ([], 0, 0, 0))
+        if isinstance(value, tuple):
+            captured, rtt = value
+            captured_bytes += captured
+            if rtt is not None:
+                rtts.append(rtt)
+                probes += 1
+            elif captured == 0:
+                lost, probes = lost + 1, probes + 1
+        elif value is None:
+            lost, probes = lost + 1, probes + 1
+        else:
+            rtts.append(value)
+            probes += 1
+        bins[index] = (rtts, probes, lost, captured_bytes)
+        for closed in sorted(closed for closed in bins if closed < index - lag_bins):
+            flush(closed)
+    for closed in sorted(bins):
+        flush(closed)
+    if len(loss_windows) > 1 and loss_windows[-1][1] < min_loss_probes:
+        # too few probes at the end of the trace for an estimate of their own
+        _, probes, lost = loss_windows.pop()
+        loss_windows[-1][1] += probes
+        loss_windows[-1][2] += lost
+    series["loss"] = [(window_start, 100.0 * lost / probes) for window_start, probes, lost in loss_windows]
+    return series
+
+
+def _window_complete(window, offset, loss_window_s, min_loss_probes):
+    window_start, probes, _ = window
+    return probes >= min_loss_probes and offset - window_start >= loss_window_s
+
+
+def rate_series(samples, interval_s=1.0):
+    # mean rate per interval of interval_s from (time, bits per second) reports
+    series = []
+    current, rates = None, []
+    for time_s, rate in samples:
+        index = int(time_s // interval_s)
+        if current is not None and index != current:
+            series.append((current * interval_s, sum(rates) / len(rates)))
+            rates = []
+        current = index
+        rates.append(rate)
+    if current is not None:
+        series.append((current * interval_s, sum(rates) / len(rates)))
+    return series
+
+
+def compress_steps(samples, tolerance, relative=False):
+    # Greedy bounded error step fit: a step lasts as long as all its samples stay within tolerance of the step's
+    # value (tolerance is a fraction of the value when relative), so the result never deviates by more than that.
+    steps = []
+    start, low, high = None, None, None
+    for time_s, value in samples:
+        if start is not None:
+            new_low, new_high = min(low, value), max(high, value)
+            middle = (new_low + new_high) / 2
+            allowed = tolerance * middle if relative else tolerance
+            if new_high - middle <= allowed:
+                low, high = new_low, new_high
+                continue
+            steps.append((start, (low + high) / 2))
+        start, low, high = time_s, value, value
+    if start is not None:
+        steps.append((start, (low + high) / 2))
+    return steps
+
+
+class ImportedTrace(object):
+    # The compressed link conditions of a measured trace: one-way delay in ms, one-way loss in percent and rate in
+    # bits per second, each as (seconds, value) steps.
+    def __init__(self, delay_steps=(), loss_steps=(), rate_steps=()):
+        self.delay_steps = list(delay_steps)
+        self.loss_steps = list(loss_steps)
+        self.rate_steps = list(rate_steps)
+
+    def delay_rows(self):
+        # satdelay.csv rows, OpenSAND takes whole milliseconds
+        return [(_format_time(time_s), int(round(delay_ms))) for time_s, delay_ms in self.delay_steps]
+
+    def link_schedule(self, include_delay=True, rate_direction="down"):
+        # the trace as a netem timeline for LinkScheduleRunner, leave out the delay when OpenSAND replays the rows
+        schedule = LinkSchedule()
+        if include_delay:
+            for time_s, delay_ms in self.delay_steps:
+                schedule.delay(time_s, int(round(delay_ms)))
+        for time_s, loss in self.loss_steps:
+            schedule.loss(time_s, round(loss, 4))
+        for time_s, rate in self.rate_steps:
+            schedule.rate(time_s, str(int(rate)) + "bit", direction=rate_direction)
+        return schedule
+
+    def materialize_scenario(self, name="trace_scenario", base="delay_scenario"):
+        scenario = ScenarioConfig.load(base).copy(name)
+        scenario.set_delay_file(self.delay_rows())
+        scenario.materialize()
+        return name
+
+
+def _format_time(time_s):
+    return int(time_s) if float(time_s).is_integer() else round(float(time_s), 3)
+
+
+def import_trace(ping=None, iperf=None, pcap=None, interval_s=1.0, delay_tolerance_ms=5.0, loss_tolerance=0.5,
+                 rate_tolerance=0.1, ping_interval_s=1.0, loss_window_s=LOSS_WINDOW_S, min_loss_probes=MIN_LOSS_PROBES):
+    # Builds an ImportedTrace from any mix of a ping log, an iperf3 interval log and a pcap (paths, optionally
+    # gzipped). Rtt and loss come from ping (or the pcap's probes if there is no ping log) and are split evenly over
+    # both directions, the rate comes from iperf (or the pcap's throughput). Delay and loss tolerances are absolute
+    # (ms, percentage points), the rate tolerance is relative. Loss is estimated per loss window (see interval_series)
+    # and the loss steps stay within loss_tolerance of those estimates.
+    series = {"rtt": [], "loss": [], "rate": []}
+    if pcap is not None:
+        series.update(interval_series(((time_s, (captured, rtt)) for time_s, captured, rtt in parse_pcap(pcap)), interval_s,
+                                      loss_window_s=loss_window_s, min_loss_probes=min_loss_probes))
+    if ping is not None:
+        ping_series = interval_series(parse_ping(ping, ping_interval_s), interval_s, loss_window_s=loss_window_s,
+                                      min_loss_probes=min_loss_probes)
+        series["rtt"], series["loss"] = ping_series["rtt"], ping_series["loss"]
+    if iperf is not None:
+        series["rate"] = rate_series(parse_iperf(iperf), interval_s)
+    # a loss of p on the round trip is 1 - sqrt(1 - p) on each way
+    one_way_loss = [(time_s, 100 * (1 - math.sqrt(max(0.0, 1 - loss / 100)))) for time_s, loss in series["loss"]]
+    trace = ImportedTrace(delay_steps=compress_steps([(time_s, rtt / 2) for time_s, rtt in series["rtt"]], delay_tolerance_ms),
+                          loss_steps=compress_steps(one_way_loss, loss_tolerance),
+                          rate_steps=compress_steps(series["rate"], rate_tolerance, relative=True))
+    logger.debug("Imported trace: " + str(len(series["rtt"])) + " rtt, " + str(len(series["loss"])) + " loss and " +
+                 str(len(series["rate"])) + " rate intervals compressed to " + str(len(trace.delay_steps)) + "/" +
+                 str(len(trace.loss_steps)) + "/" + str(len(trace.rate_steps)) + " steps")
+    return trace
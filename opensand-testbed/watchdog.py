@@ -0,0 +1,100 @@
+import threading
+import time
+from loguru import logger
+from docker_utils import container_states
+from timing import span
+
+# bytes received on every interface of the client, the transfer is alive as long as this grows
+RX_BYTES_COMMAND = "sh -c 'cat /sys/class/net/*/statistics/rx_bytes'"
+
+
+class LinkStalled(RuntimeError):
+    pass
+
+
+class Watchdog(object):
+    # Guards the transfers of a scenario's benchmarks. Each transfer's timeout follows from its size and the rate the
+    # link is expected to reach (slack times the ideal transfer time plus setup_s for the PEP/VPN handshakes), and
+    # while it runs the client's receive counter is polled: a transfer that makes no progress for stall_s is stopped
+    # right away. A failed transfer is retried after a repair, first of the routes and, if the gateway is still
+    # unreachable or the transfer stalled with the path up, by restarting the scenario's PEP.
+    def __init__(self, scenario, expected_bps=1000000, slack=4.0, setup_s=20, stall_s=30, min_timeout_s=30,
+                 max_timeout_s=600, poll_interval_s=2, retries=1):
+        self.scenario = scenario
+        self.expected_bps = expected_bps
+        self.slack = slack
+        self.setup_s = setup_s
+        self.stall_s = stall_s
+        self.min_timeout_s = min_timeout_s
+        self.max_timeout_s = max_timeout_s
+        self.poll_interval_s = poll_interval_s
+        self.retries = retries
+
+    def timeout(self, transfer_bytes):
+        ideal = transfer_bytes * 8 / self.expected_bps
+        return min(max(self.setup_s + self.slack * ideal, self.min_timeout_s), self.max_timeout_s)
+
+    def _rx_bytes(self, container):
+        exit_code, output = container.exec_run(RX_BYTES_COMMAND)
+        if exit_code != 0:
+            return None
+        return sum(int(line) for line in output.decode(errors="replace").split() if line.isdigit())
+
+    def path_alive(self, container, target, count=3):
+        # a few pings rather than one, the emulated link may be lossy
+        exit_code, _ = container.exec_run("ping -c " + str(count) + " -W 2 -i 0.5 " + str(target))
+        return exit_code == 0
+
+    def run(self, container, command, transfer_bytes, target):
+        # Runs command in container under the watchdog, returns (exit code, output, failure reason). The reason is
+        # None unless the watchdog stopped the transfer, target is the address the transfer goes to.
+        timeout = self.timeout(transfer_bytes)
+        result = {}
+
+        def transfer():
+            result["exec"] = container.exec_run("/usr/bin/timeout --signal=SIGINT " + str(int(timeout) + 5) + " " + command)
+
+        thread = threading.Thread(target=transfer, name="watched-transfer", daemon=True)
+        start = time.monotonic()
+        last_bytes, last_progress = self._rx_bytes(container), start
+        thread.start()
+        failure_reason = None
+        while True:
+            thread.join(self.poll_interval_s)
+            if not thread.is_alive():
+                break
+            now = time.monotonic()
+            received = self._rx_bytes(container)
+            if received is not None and (last_bytes is None or received > last_bytes):
+                last_bytes, last_progress = received, now
+            failures = container_states().failures_since(start)
+            if failures:
+                failure_reason = "; ".join(failure.container + ": " + failure.reason for failure in failures)
+            elif now - start > timeout:
+                failure_reason = "timeout after " + str(round(timeout)) + "s"
+            elif now - last_progress > self.stall_s:
+                failure_reason = "stalled for " + str(self.stall_s) + "s" + ("" if self.path_alive(container, target) else ", path down")
+            if failure_reason is not None:
+                logger.warning("Watchdog stopping transfer of " + str(transfer_bytes) + " bytes: " + failure_reason)
+                # SIGINT lets iperf3 still print what it measured so far
+                container.exec_run("pkill -INT -f '" + command.split()[0] + "'")
+                thread.join(10)
+                break
+        exit_code, output = result["exec"] if "exec" in result else (None, b"")
+        return exit_code, output, failure_reason
+
+    def repair(self, container, target, failure_reason):
+        # the cheapest fix that can explain the failure first, the PEP is only restarted if the routes were not it
+        testbed = self.scenario.testbed
+        with span("watchdog repair"), container_states().suspended():
+            if "path down" in str(failure_reason) or not self.path_alive(container, target):
+                logger.debug("Watchdog restoring routes")
+                testbed.connect_terminal_modem()
+                testbed.connect_terminal_workstation()
+                if self.path_alive(container, target):
+                    return "routes"
+            logger.debug("Watchdog restarting the PEP of " + self.scenario.name)
+            self.scenario.restart_pep()
+            if not self.path_alive(container, target):
+                raise LinkStalled("Path to " + str(target) + " still down after restarting " + self.scenario.name)
+            return "pep restart"
@@ -22,7 +22,16 @@ var (
 		QuicStreamTimeout: 2, MultiStream: shared.QuicConfiguration.MultiStream,
 		ConnectionRetries: 3,
 		IdleTimeout:       time.Duration(300) * time.Second}
-	quicSession             quic.Session
+	quicSession quic.Session
+	// every session the client opened that may still carry streams, guarded by quicSessionLock like quicSession,
+	// which is only held to read or publish them
+	quicSessions    = map[quic.Session]bool{}
+	quicSessionLock sync.Mutex
+	// read locked while a session is dialed and published, write locked only by WithSessionsClosed: a configuration
+	// change waits for the dials in flight and no dial starts until it is applied
+	sessionConfigLock sync.RWMutex
+	// with multistream, connections arriving while the shared session is dialed wait for it instead of dialing their own
+	sharedSessionDial       sync.Mutex
 	QuicClientConfiguration = quic.Config{
 		IdleTimeout:        time.Duration(300) * time.Second,
 		MaxIncomingStreams: 40000,
@@ -80,40 +89,13 @@ func ListenTCPConn() {
 func handleTCPConn(tcpConn net.Conn) {
 	log.Printf("Accepting TCP connection from %s with destination of %s", tcpConn.RemoteAddr().String(), tcpConn.LocalAddr().String())
 	defer tcpConn.Close()
-	var quicStream quic.Stream = nil
-	// if we allow for multiple streams in a session, lets try and open on the existing session
-	if ClientConfiguration.MultiStream {
-		//if we have already opened a quic session, lets check if we've expired our stream
-		if quicSession != nil {
-			var err error
-			log.Printf("Trying to open on existing session")
-			quicStream, err = quicSession.OpenStream()
-			// if we weren't able to open a quicStream on that session (usually inactivity timeout), we can try to open a new session
-			if err != nil {
-				log.Printf("Unable to open new stream on existing QUIC session: %s\n")
-				quicStream = nil
-			} else {
-				log.Printf("Opened a new stream: %d", quicStream.StreamID())
-			}
-		}
+	quicStream, ownSession, err := openSessionStream()
+	if err != nil {
+		return
 	}
-	// if we haven't opened a stream from multistream, we can open one with a new session
-	if quicStream == nil {
-		// open a new quicSession (with all the TLS jazz)
-		var err error
-		quicSession, err = openQuicSession()
-		// if we were unable to open a quic session, drop the TCP connection with RST
-		if err != nil {
-			return
-		}
-
-		//Open a stream to send data on this new session
-		quicStream, err = quicSession.OpenStreamSync(context.Background())
-		// if we cannot open a stream on this session, send a TCP RST and let the client decide to try again
-		if err != nil {
-			log.Printf("Unable to open QUIC stream: %s\n", err)
-			return
-		}
+	if ownSession != nil {
+		// without multistream the session is this connection's alone, the control endpoint need not close it later
+		defer untrackSession(ownSession)
 	}
 	defer quicStream.Close()
 
@@ -161,12 +143,110 @@ func handleTCPConn(tcpConn net.Conn) {
 	log.Printf("Done sending data on %d", quicStream.StreamID())
 }
 
+// Opens a stream for a proxied connection, on the shared session if multistream allows it, else on a new session.
+// The session is also returned when it is the connection's own.
+func openSessionStream() (quic.Stream, quic.Session, error) {
+	sessionConfigLock.RLock()
+	// without multistream every connection dials its own session, none of them waits for another's handshake
+	if !ClientConfiguration.MultiStream {
+		session, err := openQuicSession()
+		if err == nil {
+			trackSession(session, false)
+		}
+		sessionConfigLock.RUnlock()
+		if err != nil {
+			return nil, nil, err
+		}
+		return openStream(session, session)
+	}
+	sharedSessionDial.Lock()
+	quicSessionLock.Lock()
+	session := quicSession
+	quicSessionLock.Unlock()
+	//if we have already opened a quic session, lets check if we've expired our stream
+	if session != nil {
+		log.Printf("Trying to open on existing session")
+		quicStream, err := session.OpenStream()
+		if err == nil {
+			sharedSessionDial.Unlock()
+			sessionConfigLock.RUnlock()
+			log.Printf("Opened a new stream: %d", quicStream.StreamID())
+			return quicStream, nil, nil
+		}
+		// if we weren't able to open a quicStream on that session (usually inactivity timeout), we can try to open a new session
+		log.Printf("Unable to open new stream on existing QUIC session: %s\n", err)
+		untrackSession(session)
+	}
+	// if we haven't opened a stream from multistream, we can open one with a new session (with all the TLS jazz)
+	session, err := openQuicSession()
+	if err == nil {
+		trackSession(session, true)
+	}
+	sharedSessionDial.Unlock()
+	sessionConfigLock.RUnlock()
+	// if we were unable to open a quic session, drop the TCP connection with RST
+	if err != nil {
+		return nil, nil, err
+	}
+	return openStream(session, nil)
+}
+
+// Opens the first stream of a new session, ownSession is the session if it is the connection's alone
+func openStream(session quic.Session, ownSession quic.Session) (quic.Stream, quic.Session, error) {
+	//Open a stream to send data on this new session
+	quicStream, err := session.OpenStreamSync(context.Background())
+	// if we cannot open a stream on this session, send a TCP RST and let the client decide to try again
+	if err != nil {
+		log.Printf("Unable to open QUIC stream: %s\n", err)
+		if ownSession != nil {
+			untrackSession(ownSession)
+		}
+		return nil, nil, err
+	}
+	return quicStream, ownSession, nil
+}
+
+func trackSession(session quic.Session, multiStream bool) {
+	quicSessionLock.Lock()
+	defer quicSessionLock.Unlock()
+	quicSessions[session] = true
+	if multiStream {
+		quicSession = session
+	}
+}
+
+func untrackSession(session quic.Session) {
+	quicSessionLock.Lock()
+	defer quicSessionLock.Unlock()
+	delete(quicSessions, session)
+	if quicSession == session {
+		// expired, nothing will open streams on it again
+		quicSession = nil
+	}
+}
+
+// Closes the client's sessions and runs apply before any new one is opened, so the next connection gets a session
+// with the settings apply leaves behind. Streams still on the old sessions are cut off.
+func WithSessionsClosed(apply func()) {
+	sessionConfigLock.Lock()
+	defer sessionConfigLock.Unlock()
+	quicSessionLock.Lock()
+	defer quicSessionLock.Unlock()
+	for session := range quicSessions {
+		session.CloseWithError(0, "QPEP configuration changed")
+	}
+	quicSessions = map[quic.Session]bool{}
+	quicSession = nil
+	apply()
+}
+
 func openQuicSession() (quic.Session, error) {
 	var err error
 	var session quic.Session
 	tlsConf := &tls.Config{InsecureSkipVerify: true, NextProtos: []string{"qpep-demo"}}
 	gatewayPath := ClientConfiguration.GatewayHost + ":" + strconv.Itoa(ClientConfiguration.GatewayPort)
 	quicClientConfig := QuicClientConfiguration
+	log.Printf("Opening QUIC session with %+v", shared.GetQuicConfig())
 	for i := 0; i < ClientConfiguration.ConnectionRetries; i++ {
 		session, err = quic.DialAddr(gatewayPath, tlsConf, &quicClientConfig)
 		if err == nil {
@@ -16,8 +16,14 @@ func main() {
 	if shared.QuicConfiguration.ClientFlag {
 		fmt.Println("Running Client")
 		go client.RunClient()
+		if shared.QuicConfiguration.ControlPort != 0 {
+			go shared.RunControlServer(shared.QuicConfiguration.ControlPort, client.WithSessionsClosed)
+		}
 	} else {
 		go server.RunServer()
+		if shared.QuicConfiguration.ControlPort != 0 {
+			go shared.RunControlServer(shared.QuicConfiguration.ControlPort, server.WithSessionsClosed)
+		}
 	}
 	interruptListener := make(chan os.Signal)
 	signal.Notify(interruptListener, os.Interrupt)
@@ -25,6 +25,11 @@ var (
 	serverConfig = ServerConfig{ListenHost: "0.0.0.0", ListenPort: 4242}
 	quicListener quic.Listener
 	quicSession  quic.Session
+	// every session accepted and not yet ended, guarded by quicSessionLock
+	quicSessions    = map[quic.Session]bool{}
+	quicSessionLock sync.Mutex
+	// counts the configuration changes of WithSessionsClosed, guarded by quicSessionLock
+	configGeneration int
 )
 
 type ServerConfig struct {
@@ -55,16 +60,34 @@ func RunServer() {
 func ListenQuicSession() {
 	for {
 		var err error
+		quicSessionLock.Lock()
+		generation := configGeneration
+		quicSessionLock.Unlock()
 		quicSession, err = quicListener.Accept(context.Background())
 		if err != nil {
 			log.Printf("Unrecoverable error while accepting QUIC session: %s", err)
 			return
 		}
+		quicSessionLock.Lock()
+		if generation != configGeneration {
+			// the handshake may have run before the configuration changed, the client dials again with the new one
+			quicSessionLock.Unlock()
+			quicSession.CloseWithError(0, "QPEP configuration changed")
+			continue
+		}
+		quicSessions[quicSession] = true
+		quicSessionLock.Unlock()
+		log.Printf("Accepted QUIC session with %+v", shared.GetQuicConfig())
 		go ListenQuicConn(quicSession)
 	}
 }
 
 func ListenQuicConn(quicSession quic.Session) {
+	defer func() {
+		quicSessionLock.Lock()
+		delete(quicSessions, quicSession)
+		quicSessionLock.Unlock()
+	}()
 	for {
 		stream, err := quicSession.AcceptStream(context.Background())
 		if err != nil {
@@ -79,6 +102,19 @@ func ListenQuicConn(quicSession quic.Session) {
 	}
 }
 
+// Closes every accepted session and runs apply while no new one is taken on, so sessions the clients open
+// afterwards get the settings apply leaves behind. A session the listener accepts meanwhile is closed as well.
+func WithSessionsClosed(apply func()) {
+	quicSessionLock.Lock()
+	defer quicSessionLock.Unlock()
+	for session := range quicSessions {
+		session.CloseWithError(0, "QPEP configuration changed")
+	}
+	quicSessions = map[quic.Session]bool{}
+	configGeneration++
+	apply()
+}
+
 func HandleQuicStream(stream quic.Stream) {
 	qpepHeader, err := shared.GetQpepHeader(stream)
 	if err != nil {
@@ -0,0 +1,148 @@
+package shared
+
+import (
+	"bufio"
+	"fmt"
+	"log"
+	"net"
+	"strconv"
+	"strings"
+	"sync"
+)
+
+// Guards QuicConfiguration once the control endpoint can change it. The control endpoint only changes it while the
+// side has no sessions open (see RunControlServer), so every session runs with the settings it was opened with.
+var quicConfigurationLock sync.RWMutex
+
+// Returns a copy of the current configuration, taken wherever a session is opened
+func GetQuicConfig() QuicConfig {
+	quicConfigurationLock.RLock()
+	defer quicConfigurationLock.RUnlock()
+	return QuicConfiguration
+}
+
+// Settings the control endpoint can change, by the name of the flag that sets them at startup
+var controlSettings = map[string]func(config *QuicConfig, value string) error{
+	"acks": func(config *QuicConfig, value string) error {
+		return setPositiveInt(&config.AckElicitingPacketsBeforeAck, value)
+	},
+	"decimate": func(config *QuicConfig, value string) error {
+		return setPositiveInt(&config.AckDecimationDenominator, value)
+	},
+	"ackDelay": func(config *QuicConfig, value string) error {
+		return setPositiveInt(&config.MaxAckDelay, value)
+	},
+	"varAckDelay": func(config *QuicConfig, value string) error {
+		parsed, err := strconv.ParseFloat(value, 64)
+		if err != nil || parsed < 0 {
+			return fmt.Errorf("expected a non-negative number, got %q", value)
+		}
+		config.VarAckDelay = parsed
+		return nil
+	},
+	"minBeforeDecimation": func(config *QuicConfig, value string) error {
+		return setPositiveInt(&config.MinReceivedBeforeAckDecimation, value)
+	},
+	"congestion": func(config *QuicConfig, value string) error {
+		return setPositiveInt(&config.InitialCongestionWindowPackets, value)
+	},
+}
+
+func setPositiveInt(field *int, value string) error {
+	parsed, err := strconv.Atoi(value)
+	if err != nil || parsed < 1 {
+		return fmt.Errorf("expected a positive integer, got %q", value)
+	}
+	*field = parsed
+	return nil
+}
+
+func formatQuicConfig(config QuicConfig) string {
+	return fmt.Sprintf("acks=%d decimate=%d ackDelay=%d varAckDelay=%g minBeforeDecimation=%d congestion=%d",
+		config.AckElicitingPacketsBeforeAck, config.AckDecimationDenominator, config.MaxAckDelay, config.VarAckDelay,
+		config.MinReceivedBeforeAckDecimation, config.InitialCongestionWindowPackets)
+}
+
+// Listens on 127.0.0.1:port for line commands and answers each with one line:
+//
+//	get                          -> ok <settings>
+//	set acks=20 decimate=2 ...   -> ok <settings> (all settings are applied, or none and: error <reason>)
+//
+// withSessionsClosed runs apply, which changes the configuration, with every session of this side closed and no new
+// ones opened until it returns, so no session ever sees two configurations.
+func RunControlServer(port int, withSessionsClosed func(apply func())) {
+	listener, err := net.Listen("tcp", "127.0.0.1:"+strconv.Itoa(port))
+	if err != nil {
+		log.Fatalf("Encountered error while binding control listener: %s", err)
+		return
+	}
+	defer listener.Close()
+	log.Printf("Control endpoint listening on 127.0.0.1:%d", port)
+	for {
+		conn, err := listener.Accept()
+		if err != nil {
+			log.Printf("Unrecoverable error while accepting control connection: %s", err)
+			return
+		}
+		go handleControlConn(conn, withSessionsClosed)
+	}
+}
+
+func handleControlConn(conn net.Conn, withSessionsClosed func(apply func())) {
+	defer conn.Close()
+	scanner := bufio.NewScanner(conn)
+	for scanner.Scan() {
+		fields := strings.Fields(scanner.Text())
+		if len(fields) == 0 {
+			continue
+		}
+		var response string
+		switch fields[0] {
+		case "get":
+			response = "ok " + formatQuicConfig(GetQuicConfig())
+		case "set":
+			// a bad value is refused before any session is closed for it
+			if _, err := applyControlSettings(GetQuicConfig(), fields[1:]); err != nil {
+				response = "error " + err.Error()
+				break
+			}
+			var config QuicConfig
+			apply := func() {
+				quicConfigurationLock.Lock()
+				defer quicConfigurationLock.Unlock()
+				QuicConfiguration, _ = applyControlSettings(QuicConfiguration, fields[1:])
+				config = QuicConfiguration
+			}
+			if withSessionsClosed != nil {
+				withSessionsClosed(apply)
+			} else {
+				apply()
+			}
+			log.Printf("Control endpoint updated QUIC configuration: %s", formatQuicConfig(config))
+			response = "ok " + formatQuicConfig(config)
+		default:
+			response = "error unknown command " + fields[0]
+		}
+		if _, err := conn.Write([]byte(response + "\n")); err != nil {
+			return
+		}
+	}
+}
+
+// Returns config with the name=value assignments applied, or an error for the first one that cannot be
+func applyControlSettings(config QuicConfig, assignments []string) (QuicConfig, error) {
+	if len(assignments) == 0 {
+		return QuicConfig{}, fmt.Errorf("set needs at least one name=value")
+	}
+	for _, assignment := range assignments {
+		parts := strings.SplitN(assignment, "=", 2)
+		setting, known := controlSettings[parts[0]]
+		if len(parts) != 2 || !known {
+			return QuicConfig{}, fmt.Errorf("cannot set %q", assignment)
+		}
+		if err := setting(&config, parts[1]); err != nil {
+			return QuicConfig{}, fmt.Errorf("%s: %s", parts[0], err)
+		}
+	}
+	return config, nil
+}
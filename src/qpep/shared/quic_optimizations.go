@@ -14,6 +14,7 @@ type QuicConfig struct {
 	MinReceivedBeforeAckDecimation int
 	ClientFlag bool
 	GatewayIP string
+	ControlPort int //local control endpoint, 0 to disable
 }
 
 var ( 
@@ -30,6 +31,7 @@ func init() {
 	minReceivedBeforeAckDecimationFlag := flag.Int("minBeforeDecimation", 100, "Minimum number of packets before initiating ack decimation")
 	clientFlag := flag.Bool("client", false, "a bool")
 	gatewayFlag := flag.String("gateway", "198.18.0.254", "IP address of gateway running qpep")
+	controlPortFlag := flag.Int("controlPort", 0, "Port on 127.0.0.1 to accept runtime updates of the ack and congestion settings on, 0 disables it")
 
 	flag.Parse()
 	QuicConfiguration = QuicConfig{
@@ -42,5 +44,6 @@ func init() {
 		MinReceivedBeforeAckDecimation: *minReceivedBeforeAckDecimationFlag,
 		ClientFlag: *clientFlag,
 		GatewayIP: *gatewayFlag,
+		ControlPort: *controlPortFlag,
 	}
 }
\ No newline at end of file